@@ -0,0 +1,249 @@
+"""Admission control for the routes that move blob bytes.
+
+Uploads, downloads and exports each go through a Gate. At most ``limit``
+requests hold a slot at once, and at most ``per_user`` of them belong to the
+same user, so the rest of a worker's threads stay free for logins and
+dashboards. Requests beyond that wait in a bounded queue for up to
+``timeout`` seconds; when the queue is full, the user already has
+``per_user`` requests waiting, or the wait runs out, the request is turned
+away at once with a 503 and a Retry-After estimate.
+
+A freed slot goes straight to the longest-waiting request whose user is
+under the per-user limit. Limits are per worker process. Under threaded
+workers a waiting request holds a thread too, so keep limit plus queue size
+below --threads; under asgi.py waiting costs no thread.
+"""
+import asyncio
+import functools
+import inspect
+import math
+import os
+import threading
+import time
+from collections import Counter, deque
+
+from flask import make_response, request, session
+
+import metrics
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+ADMISSION_UPLOAD_LIMIT = int(os.getenv("ADMISSION_UPLOAD_LIMIT", "4"))
+ADMISSION_DOWNLOAD_LIMIT = int(os.getenv("ADMISSION_DOWNLOAD_LIMIT", "8"))
+ADMISSION_EXPORT_LIMIT = int(os.getenv("ADMISSION_EXPORT_LIMIT", "2"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "8"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))
+ADMISSION_PER_USER = int(os.getenv("ADMISSION_PER_USER", "2"))
+MAX_RETRY_AFTER = 60
+
+metrics.registry.counter("admission_admitted_total", "Requests given a slot.", ("gate",))
+metrics.registry.counter("admission_rejected_total", "Requests turned away with a 503.", ("gate", "reason"))
+metrics.registry.histogram("admission_wait_seconds", "Time admitted requests spent queued.", ("gate",))
+
+
+class _Waiter:
+    __slots__ = ("user", "wake", "granted")
+
+    def __init__(self, user, wake):
+        self.user = user
+        self.wake = wake
+        self.granted = False
+
+
+class Gate:
+    def __init__(self, name, limit, queue_size=ADMISSION_QUEUE_SIZE, timeout=ADMISSION_QUEUE_TIMEOUT,
+                 per_user=ADMISSION_PER_USER):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.per_user = per_user
+        self.active = 0
+        self._active_by_user = Counter()
+        self._queued_by_user = Counter()
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        # moving average of how long a slot is held, for Retry-After
+        self._hold_seconds = 1.0
+
+    def _enter(self, user, wake):
+        """Admit ``user`` now (None), queue them (a _Waiter) or give the
+        reason they are turned away. Called with the lock held."""
+        if self.active < self.limit and self._active_by_user[user] < self.per_user:
+            self.active += 1
+            self._active_by_user[user] += 1
+            return None
+        if len(self._waiters) >= self.queue_size:
+            return "queue_full"
+        if self._queued_by_user[user] >= self.per_user:
+            return "user_limit"
+        waiter = _Waiter(user, wake)
+        self._waiters.append(waiter)
+        self._queued_by_user[user] += 1
+        return waiter
+
+    def _dequeue(self, waiter):
+        self._waiters.remove(waiter)
+        self._queued_by_user[waiter.user] -= 1
+        if not self._queued_by_user[waiter.user]:
+            del self._queued_by_user[waiter.user]
+
+    def _dispatch(self):
+        while self.active < self.limit:
+            waiter = next((w for w in self._waiters if self._active_by_user[w.user] < self.per_user), None)
+            if waiter is None:
+                return
+            self._dequeue(waiter)
+            self.active += 1
+            self._active_by_user[waiter.user] += 1
+            waiter.granted = True
+            waiter.wake()
+
+    def _settle(self, waiter, start, reason="timeout"):
+        with self._lock:
+            if not waiter.granted:
+                self._dequeue(waiter)
+        if waiter.granted:
+            return self._admitted(start)
+        return self._rejected(reason)
+
+    def _admitted(self, start):
+        metrics.registry.inc("admission_admitted_total", (self.name,))
+        metrics.registry.observe("admission_wait_seconds", time.monotonic() - start, (self.name,))
+        return True
+
+    def _rejected(self, reason):
+        metrics.registry.inc("admission_rejected_total", (self.name, reason))
+        return False
+
+    def acquire(self, user):
+        """Take a slot for ``user``, queueing up to ``timeout`` seconds.
+        Returns False when the request should get a 503."""
+        start = time.monotonic()
+        event = threading.Event()
+        with self._lock:
+            waiter = self._enter(user, event.set)
+        if waiter is None:
+            return self._admitted(start)
+        if isinstance(waiter, str):
+            return self._rejected(waiter)
+        event.wait(self.timeout)
+        return self._settle(waiter, start)
+
+    async def aacquire(self, user):
+        """acquire() for coroutines: waiting does not block a thread."""
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        with self._lock:
+            waiter = self._enter(user, wake)
+        if waiter is None:
+            return self._admitted(start)
+        if isinstance(waiter, str):
+            return self._rejected(waiter)
+        try:
+            await asyncio.wait({future}, timeout=self.timeout)
+        except asyncio.CancelledError:
+            # the client went away while queued; hand back a slot granted meanwhile
+            if self._settle(waiter, start, "cancelled"):
+                self.release(user, start)
+            raise
+        return self._settle(waiter, start)
+
+    def release(self, user, held_since):
+        with self._lock:
+            self._hold_seconds = 0.8 * self._hold_seconds + 0.2 * (time.monotonic() - held_since)
+            self.active -= 1
+            self._active_by_user[user] -= 1
+            if not self._active_by_user[user]:
+                del self._active_by_user[user]
+            self._dispatch()
+
+    def retry_after(self):
+        """Seconds until a slot is likely to be free for one more request."""
+        with self._lock:
+            ahead = len(self._waiters) + 1
+            hold = self._hold_seconds
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(hold * ahead / self.limit)))
+
+    def stats(self):
+        with self._lock:
+            return {"limit": self.limit, "active": self.active, "queued": len(self._waiters),
+                    "users": len(self._active_by_user)}
+
+
+GATES = {
+    "upload": Gate("upload", ADMISSION_UPLOAD_LIMIT),
+    "download": Gate("download", ADMISSION_DOWNLOAD_LIMIT),
+    "export": Gate("export", ADMISSION_EXPORT_LIMIT, per_user=1),
+}
+
+
+@metrics.registry.collector
+def _gauges():
+    stats = {name: gate.stats() for name, gate in GATES.items()}
+    return [
+        ("admission_limit", "Slots per gate.", {(("gate", n),): s["limit"] for n, s in stats.items()}),
+        ("admission_active", "Requests holding a slot.", {(("gate", n),): s["active"] for n, s in stats.items()}),
+        ("admission_queue_depth", "Requests waiting for a slot.",
+         {(("gate", n),): s["queued"] for n, s in stats.items()}),
+    ]
+
+
+def user_key(session, remote_addr):
+    return session.get("email") or remote_addr or "anonymous"
+
+
+def busy_message(gate):
+    return "Server busy, please try again shortly", {"Retry-After": str(gate.retry_after())}
+
+
+def limit(gates):
+    """Run the view holding a slot of a gate; ``gates`` is a gate name or a
+    {method: gate name} dict, methods not in it are not limited."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            name = gates.get(request.method) if isinstance(gates, dict) else gates
+            if not ADMISSION_ENABLED or name is None:
+                return view(*args, **kwargs)
+            gate = GATES[name]
+            user = user_key(session, request.remote_addr)
+            if not gate.acquire(user):
+                body, headers = busy_message(gate)
+                return body, 503, headers
+            start = time.monotonic()
+            try:
+                response = make_response(view(*args, **kwargs))
+            except BaseException:
+                gate.release(user, start)
+                raise
+            _release_when_sent(response, lambda: gate.release(user, start))
+            return response
+        return wrapper
+    return decorator
+
+
+def _release_when_sent(response, release):
+    """Call ``release`` once the server is done with the response body."""
+    bodyless = request.method == "HEAD" or response.status_code < 200 or response.status_code in (204, 304)
+    if not response.direct_passthrough or bodyless:
+        # werkzeug wraps the body in an iterator that calls response.close()
+        response.call_on_close(release)
+    elif inspect.isgenerator(response.response):
+        # passthrough bodies go to the server as they are, without that wrapper
+        response.response = _release_after(response.response, release)
+    else:
+        # a file for the server's sendfile; the transfer no longer needs the slot
+        release()
+
+
+def _release_after(chunks, release):
+    try:
+        yield from chunks
+    finally:
+        chunks.close()
+        release()
@@ -0,0 +1,97 @@
+import re
+
+EXPECTED_PER_STUDENT = 3
+STOPWORDS = frozenset(['the','and','of','in','a','an','for','to','on','by','with','cert','certificate','doc','document','pdf','jpg','png'])
+_TOKEN_RE = re.compile(r"[^A-Za-z0-9]+")
+
+
+def filename_keywords(filename):
+    parts = _TOKEN_RE.split((filename or '').lower())
+    return tuple(p for p in parts if p and p not in STOPWORDS and len(p) >= 2)
+
+
+def _scope(student_filter):
+    sql = ' WHERE s.mentor_email = ?'
+    if student_filter:
+        sql += ' AND s.email = ?'
+    return sql
+
+
+def mentor_analytics(db, mentor, student_filter=None, expected_per_student=EXPECTED_PER_STUDENT):
+    """Build the analytics dict for staff/manage_documents.html.
+
+    Reads the summary tables maintained by stats.py, so the cost grows with
+    the number of mentored students rather than with their document history.
+    """
+    params = (mentor, student_filter) if student_filter else (mentor,)
+    where = _scope(student_filter)
+
+    students = db.execute(
+        'SELECT s.id, s.email, st.uploads, st.latest_filename, st.latest_uploaded_at FROM students s'
+        ' LEFT JOIN student_doc_stats st ON st.student_email = s.email' + where, params
+    ).fetchall()
+
+    cert_counts_by_student = {}
+    for email, cert_type, count in db.execute(
+        'SELECT c.student_email, c.cert_type, c.count FROM student_cert_stats c'
+        ' JOIN students s ON s.email = c.student_email' + where, params
+    ):
+        cert_counts_by_student.setdefault(email, {})[cert_type] = count
+
+    students_stats = []
+    total_uploads = 0
+    cert_type_agg = {}
+    per_student_latest = {}
+    for s in students:
+        email = s[1]
+        uploads = s[2] or 0
+        cert_counts = cert_counts_by_student.get(email, {})
+        for ct, count in cert_counts.items():
+            cert_type_agg[ct] = cert_type_agg.get(ct, 0) + count
+        score = int(min(100, (uploads / expected_per_student) * 100)) if expected_per_student > 0 else 0
+        students_stats.append({'email': email, 'uploads': uploads, 'cert_counts': cert_counts, 'score': score})
+        total_uploads += uploads
+        if uploads:
+            per_student_latest[email] = {'filename': s[3] or '', 'uploaded_at': s[4]}
+
+    avg_uploads = (total_uploads / len(students)) if students else 0
+    top_cert_types = sorted(cert_type_agg.items(), key=lambda x: x[1], reverse=True)[:5]
+
+    # the five newest uploads can only belong to the five students with the
+    # newest latest upload, so only their documents are read
+    recent_students = sorted(per_student_latest, key=lambda e: per_student_latest[e]['uploaded_at'] or '', reverse=True)[:5]
+    recent_uploads = []
+    if recent_students:
+        placeholders = ','.join('?' * len(recent_students))
+        recent_uploads = [
+            {'filename': r[0] or '', 'student': r[1], 'uploaded_at': r[2]}
+            for r in db.execute(
+                'SELECT filename, student_email, uploaded_at FROM documents'
+                f' WHERE student_email IN ({placeholders}) ORDER BY uploaded_at DESC LIMIT 5',
+                recent_students,
+            )
+        ]
+
+    if student_filter:
+        top_keywords = db.execute(
+            'SELECT keyword, count FROM student_keyword_stats WHERE student_email = ? ORDER BY count DESC, keyword LIMIT 10',
+            (student_filter,),
+        ).fetchall() if students else []
+    else:
+        top_keywords = db.execute(
+            'SELECT keyword, count FROM mentor_keyword_stats WHERE mentor_email = ? ORDER BY count DESC, keyword LIMIT 10',
+            (mentor,),
+        ).fetchall()
+
+    return {
+        'total_students': len(students),
+        'total_uploads': total_uploads,
+        'avg_uploads': round(avg_uploads, 2),
+        'top_cert_types': top_cert_types,
+        'students_stats': students_stats,
+        'summary': {
+            'top_keywords': top_keywords,
+            'recent_uploads': recent_uploads,
+            'per_student_latest': per_student_latest,
+        }
+    }
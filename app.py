@@ -1,5 +1,7 @@
-from azure.storage.blob import BlobServiceClient
 import os
+import hashlib
+import sqlite3
+import click
 from dotenv import load_dotenv
 import logging
 
@@ -7,39 +9,49 @@ import logging
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
-from flask import Flask, render_template, request, redirect, session, flash, Response
-import sqlite3
-
-app = Flask(__name__)
-app.secret_key = "secret123"  # change later
+from flask import Blueprint, Flask, render_template, request, redirect, session, flash, Response, jsonify, send_file
+
+import db as db_pool
+from db import get_db
+from migrations import MigrationError, run_migrations, schema_is_current
+from analytics import mentor_analytics
+import stats
+from pagination import InvalidCursor, document_filters, document_page, user_page, page_url, wants_json
+from downloads import blob_response
+from storage import StorageNotFound, get_storage, verify_signed_request
+import direct_upload
+import resumable
+import dedup
+import importer
+import jobs
+import cache
+import search
+import verification
+import export
+import previews
+import metrics
+import admission
+import profiling
+import reconcile
+import upload_pipeline
+
+# routes are collected on a blueprint and attached in create_app()
+bp = Blueprint("main", __name__, cli_group=None)
+
+# redirect downloads to a short-lived storage URL instead of proxying bytes
+DIRECT_DOWNLOADS = os.getenv("STORAGE_DIRECT_DOWNLOADS", "0") == "1"
 
-
-blob_service = BlobServiceClient(
-    account_url=f"https://{os.getenv('AZURE_STORAGE_ACCOUNT')}.blob.core.windows.net",
-    credential=os.getenv("AZURE_STORAGE_KEY")
-)
 container = os.getenv("AZURE_CONTAINER")
 
-
-def get_db():
-    return sqlite3.connect("auth.db")
+# migrate on a worker's first request instead of requiring "flask init-db"
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "0") == "1"
 
 
-# Ensure admins table exists and seed an initial admin if none
+# Apply pending schema migrations and seed an initial admin if none
 def ensure_admin_table():
     db = get_db()
+    run_migrations(db)
     cur = db.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS admins (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE,
-            password TEXT
-        )
-        """
-    )
-    db.commit()
-
     cur.execute("SELECT COUNT(*) FROM admins")
     count = cur.fetchone()[0]
     if count == 0:
@@ -47,54 +59,53 @@ def ensure_admin_table():
         cur.execute("INSERT INTO admins (email, password) VALUES (?, ?)", ("admin@college.com", "admin123"))
         db.commit()
 
-ensure_admin_table()
+
+_schema_checked = False
+
+
+@bp.before_app_request
+def check_schema():
+    # once per worker: a single read of schema_version on the first request
+    global _schema_checked
+    if _schema_checked:
+        return None
+    if not schema_is_current(get_db()):
+        if not AUTO_MIGRATE:
+            logging.error('Database schema is out of date; run "flask init-db"')
+            return 'Database not initialized; run "flask init-db"', 503
+        ensure_admin_table()
+    _schema_checked = True
+    return None
 
 
 # helper to provide staff list to templates
 def get_staff_list():
     db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT * FROM staff")
-    return cur.fetchall()
+    return cache.cached(db, "staff", "list", lambda: tuple(db.execute("SELECT id, email FROM staff").fetchall()))
 
 
 def get_students_list():
     db = get_db()
-    cur = db.cursor()
-    cur.execute("SELECT id, email FROM students")
-    return cur.fetchall()
+    return cache.cached(db, "students", "list", lambda: tuple(db.execute("SELECT id, email FROM students").fetchall()))
 
 
-@app.context_processor
+@bp.app_context_processor
 def inject_helpers():
     return {
         "get_staff_list": get_staff_list,
         "get_students_list": get_students_list,
         "AZURE_STORAGE_ACCOUNT": os.getenv('AZURE_STORAGE_ACCOUNT'),
         "AZURE_CONTAINER": container,
+        "page_url": page_url,
     }
 
 
-def ensure_verification_columns():
-    db = get_db()
-    cur = db.cursor()
-    # add columns if they don't exist
-    try:
-        cur.execute("ALTER TABLE documents ADD COLUMN verified INTEGER DEFAULT 0")
-    except Exception:
-        pass
-    try:
-        cur.execute("ALTER TABLE documents ADD COLUMN verifier TEXT")
-    except Exception:
-        pass
-    try:
-        cur.execute("ALTER TABLE documents ADD COLUMN verified_at TIMESTAMP")
-    except Exception:
-        pass
-    db.commit()
+@bp.app_errorhandler(InvalidCursor)
+def invalid_cursor(e):
+    return "Invalid page cursor", 400
 
 
-@app.route('/admin/create_staff', methods=['POST'])
+@bp.route('/admin/create_staff', methods=['POST'])
 def admin_create_staff():
     if session.get('role') != 'admin':
         return redirect('/login')
@@ -106,13 +117,17 @@ def admin_create_staff():
 
     db = get_db()
     cur = db.cursor()
-    cur.execute("INSERT INTO staff (email, password) VALUES (?, ?)", (email, password))
+    try:
+        cur.execute("INSERT INTO staff (email, password) VALUES (?, ?)", (email, password))
+    except sqlite3.IntegrityError:
+        return "A staff account with that email already exists", 400
+    cache.invalidate(db, 'staff')
     db.commit()
 
     return redirect('/dashboard')
 
 
-@app.route('/admin/staff/<int:staff_id>', methods=['GET', 'POST'])
+@bp.route('/admin/staff/<int:staff_id>', methods=['GET', 'POST'])
 def admin_staff_detail(staff_id):
     if session.get('role') != 'admin':
         return redirect('/login')
@@ -123,15 +138,21 @@ def admin_staff_detail(staff_id):
     if request.method == 'POST':
         if request.form.get('delete'):
             cur.execute('DELETE FROM staff WHERE id=?', (staff_id,))
+            cache.invalidate(db, 'staff')
             db.commit()
             return redirect('/dashboard')
 
         email = request.form.get('email')
         password = request.form.get('password')
-        if password:
-            cur.execute('UPDATE staff SET email=?, password=? WHERE id=?', (email, password, staff_id))
-        else:
-            cur.execute('UPDATE staff SET email=? WHERE id=?', (email, staff_id))
+        try:
+            if password:
+                cur.execute('UPDATE staff SET email=?, password=? WHERE id=?', (email, password, staff_id))
+            else:
+                cur.execute('UPDATE staff SET email=? WHERE id=?', (email, staff_id))
+        except sqlite3.IntegrityError:
+            db.rollback()
+            return 'A staff account with that email already exists', 400
+        cache.invalidate(db, 'staff')
         db.commit()
         return redirect(f'/admin/staff/{staff_id}')
 
@@ -139,7 +160,7 @@ def admin_staff_detail(staff_id):
     return render_template('admin/staff_detail.html', staff=staff)
 
 
-@app.route('/admin/student/<int:student_id>', methods=['GET', 'POST'])
+@bp.route('/admin/student/<int:student_id>', methods=['GET', 'POST'])
 def admin_student_detail(student_id):
     if session.get('role') != 'admin':
         return redirect('/login')
@@ -148,17 +169,29 @@ def admin_student_detail(student_id):
     cur = db.cursor()
 
     if request.method == 'POST':
+        row = cur.execute('SELECT email FROM students WHERE id=?', (student_id,)).fetchone()
+        old_email = row[0] if row else None
         if request.form.get('delete'):
             cur.execute('DELETE FROM students WHERE id=?', (student_id,))
+            stats.refresh_student(db, old_email)
+            cache.invalidate(db, 'students')
             db.commit()
             return redirect('/dashboard')
 
         email = request.form.get('email')
         password = request.form.get('password')
-        if password:
-            cur.execute('UPDATE students SET email=?, password=? WHERE id=?', (email, password, student_id))
-        else:
-            cur.execute('UPDATE students SET email=? WHERE id=?', (email, student_id))
+        try:
+            if password:
+                cur.execute('UPDATE students SET email=?, password=? WHERE id=?', (email, password, student_id))
+            else:
+                cur.execute('UPDATE students SET email=? WHERE id=?', (email, student_id))
+        except sqlite3.IntegrityError:
+            db.rollback()
+            return 'A student account with that email already exists', 400
+        if email != old_email:
+            stats.refresh_student(db, old_email)
+            stats.refresh_student(db, email)
+        cache.invalidate(db, 'students')
         db.commit()
         return redirect(f'/admin/student/{student_id}')
 
@@ -166,23 +199,85 @@ def admin_student_detail(student_id):
     return render_template('admin/student_detail.html', student=student)
 
 
-@app.route('/admin/manage_staffs')
+@bp.route('/admin/db_stats')
+def admin_db_stats():
+    if session.get('role') != 'admin':
+        return redirect('/login')
+    return jsonify(db_pool.pool.stats())
+
+
+@metrics.registry.collector
+def runtime_gauges():
+    out = metrics.gauges('db_pool', 'SQLite connection pool.', db_pool.pool.stats(),
+                         counters=('created', 'timeouts', 'checkouts', 'wait_total_ms'))
+    out += metrics.gauges('cache', 'Read-through user cache.', cache.stats(),
+                          counters=('hits', 'misses', 'evictions', 'expirations', 'errors', 'loads',
+                                    'invalidations', 'syncs'))
+    out += metrics.gauges('preview_cache', 'Local preview disk cache.', previews.disk_cache.stats(),
+                          counters=('hits', 'misses', 'evictions'))
+    out += metrics.gauges('uploads', 'Upload pipeline totals.', upload_pipeline.totals(),
+                          counters=('uploads', 'single_put', 'blocks', 'bytes', 'seconds', 'failures'))
+    counts = get_db().execute('SELECT type, status, COUNT(*) FROM jobs GROUP BY type, status').fetchall()
+    out.append(('jobs', 'Background jobs by type and status.',
+                {(('type', t), ('status', st)): n for t, st, n in counts}))
+    return out
+
+
+@bp.route('/admin/cache_stats')
+def admin_cache_stats():
+    if session.get('role') != 'admin':
+        return redirect('/login')
+    return jsonify(cache.stats())
+
+
+@bp.route('/admin/profiles')
+def admin_profiles():
+    if session.get('role') != 'admin':
+        return redirect('/login')
+    routes = profiling.recent(get_db(), request.args.get('per_route', 10, type=int))
+    return render_template('admin/profiles.html', routes=routes, sample_rate=profiling.PROFILE_SAMPLE_RATE)
+
+
+@bp.route('/admin/profiles/<int:profile_id>')
+def admin_profile_download(profile_id):
+    if session.get('role') != 'admin':
+        return redirect('/login')
+    found = profiling.artifact(get_db(), profile_id)
+    if not found:
+        flash('Profile not found', 'danger')
+        return redirect('/admin/profiles')
+    path, mode, name = found
+    if request.args.get('view') == 'text':
+        if mode == 'cprofile':
+            text = profiling.text_report(path)
+        else:
+            with open(path) as f:
+                text = f.read()
+        return Response(text, mimetype='text/plain')
+    return send_file(os.path.abspath(path), as_attachment=True, download_name=name)
+
+
+@bp.route('/admin/manage_staffs')
 def admin_manage_staffs():
     if session.get('role') != 'admin':
         return redirect('/login')
-    staff_list = get_staff_list()
+    staff_list = user_page(get_db(), 'staff', 'id, email', request.args)
+    if wants_json(request.args):
+        return jsonify(staff_list.to_json())
     return render_template('admin/manage_staffs.html', staff_list=staff_list)
 
 
-@app.route('/admin/manage_students')
+@bp.route('/admin/manage_students')
 def admin_manage_students():
     if session.get('role') != 'admin':
         return redirect('/login')
-    students_list = get_students_list()
+    students_list = user_page(get_db(), 'students', 'id, email, mentor_email', request.args)
+    if wants_json(request.args):
+        return jsonify(students_list.to_json())
     return render_template('admin/manage_students.html', students_list=students_list)
 
 
-@app.route('/admin/students/template')
+@bp.route('/admin/students/template')
 def admin_students_template():
     if session.get('role') != 'admin':
         return redirect('/login')
@@ -190,7 +285,7 @@ def admin_students_template():
     return Response(csv_content, mimetype='text/csv', headers={'Content-Disposition': 'attachment; filename=students_template.csv'})
 
 
-@app.route('/admin/students/import', methods=['POST'])
+@bp.route('/admin/students/import', methods=['POST'])
 def admin_students_import():
     if session.get('role') != 'admin':
         return redirect('/login')
@@ -200,34 +295,43 @@ def admin_students_import():
         flash('No file provided', 'danger')
         return redirect('/admin/manage_students')
 
-    import io, csv
+    return _import_accounts(file, 'students', '/admin/manage_students')
 
-    try:
-        stream = io.StringIO(file.stream.read().decode('utf-8'))
-    except Exception:
-        flash('Failed to read uploaded file. Ensure it is a UTF-8 CSV.', 'danger')
-        return redirect('/admin/manage_students')
-
-    reader = csv.DictReader(stream)
-    db = get_db()
-    cur = db.cursor()
-    added = 0
-    for row in reader:
-        email = row.get('email') or row.get('Email') or row.get('EMAIL')
-        password = row.get('password') or row.get('Password') or row.get('PASSWORD')
-        if not email or not password:
-            continue
-        try:
-            cur.execute("INSERT INTO students (email, password, mentor_email) VALUES (?, ?, ?)", (email.strip(), password.strip(), None))
-            added += 1
-        except Exception as e:
-            logging.warning(f"Skipping {email}: {e}")
-    db.commit()
-    flash(f'Imported {added} students', 'success')
-    return redirect('/admin/manage_students')
 
+def _import_accounts(file, table, back):
+    if jobs.ENABLED:
+        db = get_db()
+        job_id = jobs.enqueue(db, "import_accounts", {"spool": jobs.spool(file.stream, ".csv"), "table": table},
+                              created_by=session.get('email'))
+        db.commit()
+        if wants_json(request.args):
+            return _accepted(job_id)
+        flash(f'Import queued as job {job_id}; see /jobs/{job_id} for the report', 'info')
+        return redirect(back)
 
-@app.route('/admin/staffs/template')
+    try:
+        report = importer.import_csv(get_db(), file.stream, table)
+    except UnicodeDecodeError:
+        flash('Failed to read uploaded file; nothing was imported. Ensure it is a UTF-8 CSV.', 'danger')
+        return redirect(back)
+    if wants_json(request.args):
+        return jsonify(report.to_json())
+    noun = 'students' if table == 'students' else 'staff'
+    flash(report.summary(noun), 'success' if not report.errors and not report.stopped else 'warning')
+    for line, email, message in report.errors[:10]:
+        flash(f'Line {line}: {message}' + (f' ({email})' if email else ''), 'danger')
+    if len(report.errors) > 10:
+        flash(f'... and {report.skipped - 10} more invalid rows', 'danger')
+    return redirect(back)
+
+
+@jobs.register("import_accounts", concurrency=1, max_attempts=1)
+def import_accounts_job(payload):
+    with open(payload["spool"], "rb") as f:
+        return importer.import_csv(get_db(), f, payload["table"]).to_json()
+
+
+@bp.route('/admin/staffs/template')
 def admin_staffs_template():
     if session.get('role') != 'admin':
         return redirect('/login')
@@ -235,7 +339,7 @@ def admin_staffs_template():
     return Response(csv_content, mimetype='text/csv', headers={'Content-Disposition': 'attachment; filename=staffs_template.csv'})
 
 
-@app.route('/admin/staffs/import', methods=['POST'])
+@bp.route('/admin/staffs/import', methods=['POST'])
 def admin_staffs_import():
     if session.get('role') != 'admin':
         return redirect('/login')
@@ -245,40 +349,16 @@ def admin_staffs_import():
         flash('No file provided', 'danger')
         return redirect('/admin/manage_staffs')
 
-    import io, csv
-
-    try:
-        stream = io.StringIO(file.stream.read().decode('utf-8'))
-    except Exception:
-        flash('Failed to read uploaded file. Ensure it is a UTF-8 CSV.', 'danger')
-        return redirect('/admin/manage_staffs')
-
-    reader = csv.DictReader(stream)
-    db = get_db()
-    cur = db.cursor()
-    added = 0
-    for row in reader:
-        email = row.get('email') or row.get('Email') or row.get('EMAIL')
-        password = row.get('password') or row.get('Password') or row.get('PASSWORD')
-        if not email or not password:
-            continue
-        try:
-            cur.execute("INSERT INTO staff (email, password) VALUES (?, ?)", (email.strip(), password.strip()))
-            added += 1
-        except Exception as e:
-            logging.warning(f"Skipping {email}: {e}")
-    db.commit()
-    flash(f'Imported {added} staff users', 'success')
-    return redirect('/admin/manage_staffs')
+    return _import_accounts(file, 'staff', '/admin/manage_staffs')
 
-@app.route("/")
+@bp.route("/")
 def home():
     # If already authenticated, send user to their dashboard instead of showing public home
     if "role" in session:
         return redirect("/dashboard")
     return render_template("home.html")
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     # Prevent logged-in users from seeing the login page
     if request.method == "GET" and "role" in session:
@@ -313,7 +393,7 @@ def login():
     return render_template('login.html')
 
 
-@app.after_request
+@bp.after_app_request
 def add_no_cache_headers(response):
     # Prevent caching of HTML pages so back-button after logout won't show protected content
     try:
@@ -326,7 +406,7 @@ def add_no_cache_headers(response):
         pass
     return response
 
-@app.route("/dashboard")
+@bp.route("/dashboard")
 def dashboard():
     if "role" not in session:
         return redirect("/login")
@@ -338,7 +418,7 @@ def dashboard():
         return render_template('student/dashboard.html')
 
 
-@app.route("/create_student", methods=["POST"])
+@bp.route("/create_student", methods=["POST"])
 def create_student():
     # Allow staff or admin to create student accounts
     role = session.get("role")
@@ -359,15 +439,21 @@ def create_student():
 
     db = get_db()
     cur = db.cursor()
-    cur.execute(
-        "INSERT INTO students (email, password, mentor_email) VALUES (?, ?, ?)",
-        (email, password, mentor_email),
-    )
+    try:
+        cur.execute(
+            "INSERT INTO students (email, password, mentor_email) VALUES (?, ?, ?)",
+            (email, password, mentor_email),
+        )
+    except sqlite3.IntegrityError:
+        return "A student account with that email already exists", 400
+    stats.refresh_new_students(db, [email])
+    cache.invalidate(db, "students")
     db.commit()
 
     return redirect("/dashboard")
     
-@app.route("/upload", methods=["GET", "POST"])
+@bp.route("/upload", methods=["GET", "POST"])
+@admission.limit({"POST": "upload"})
 def upload():
     if session.get("role") != "student":
         return redirect("/login")
@@ -377,43 +463,351 @@ def upload():
         cert_type = request.form.get("cert_type")
 
         # quick environment checks to give clearer errors
-        if not container:
-            logging.error("AZURE_CONTAINER environment variable is not set")
-            return "Server misconfigured: AZURE_CONTAINER not set", 500
-
-        if not os.getenv("AZURE_STORAGE_ACCOUNT"):
-            logging.error("AZURE_STORAGE_ACCOUNT environment variable is not set")
-            return "Server misconfigured: AZURE_STORAGE_ACCOUNT not set", 500
+        storage = get_storage()
+        problem = storage.config_error()
+        if problem:
+            logging.error(f"Storage backend misconfigured: {problem}")
+            return f"Server misconfigured: {problem}", 500
 
         if not file or not getattr(file, 'filename', None):
             return "No file provided", 400
 
-        blob_client = blob_service.get_blob_client(container=container, blob=file.filename)
-        blob_client.upload_blob(file, overwrite=True)
+        # the original filename is display metadata only; bytes are stored
+        # once per distinct content and re-uploads skip the transfer
+        content_hash, size = dedup.hash_stream(file.stream)
+        blob_key = dedup.content_key(content_hash)
+        db = get_db()
+        job_id = None
+        if not dedup.is_stored(db, content_hash):
+            if jobs.ENABLED:
+                # hand the transfer to a worker; the spooled copy outlives
+                # werkzeug's temp file
+                job_id = jobs.enqueue(db, "store_blob", {
+                    "spool": jobs.spool(file.stream),
+                    "key": blob_key,
+                    "content_hash": content_hash,
+                    "size": size,
+                    "content_type": file.mimetype,
+                }, created_by=session["email"])
+            else:
+                storage.put(blob_key, file.stream, size=size, content_type=file.mimetype)
+
+        record_document(db, session["email"], file.filename, cert_type, content_hash, size, stored=job_id is None)
+
+        if job_id:
+            return _accepted(job_id)
+        return "Uploaded successfully"
+
+    return render_template('student/upload.html', resumable_min_size=resumable.CHUNK_SIZE)
+
+
+def record_document(db, email, filename, cert_type, content_hash, size, stored=True):
+    """Insert an uploaded document whose blob is stored (or, with
+    ``stored=False``, queued) and commit; shared with the async upload in
+    asgi.py."""
+    blob_key = dedup.content_key(content_hash)
+    dedup.add_ref(db, content_hash, blob_key, size, stored)
+    cur = db.execute(
+        "INSERT INTO documents (student_email, filename, cert_type, blob_key, content_hash, size) VALUES (?, ?, ?, ?, ?, ?)",
+        (email, filename, cert_type, blob_key, content_hash, size)
+    )
+    stats.record_upload(db, cur.lastrowid)
+    if jobs.ENABLED:
+        jobs.enqueue(db, "render_preview", {"id": cur.lastrowid, "key": blob_key, "content_hash": content_hash},
+                     created_by=email)
+    db.commit()
+    return cur.lastrowid
+
+
+def _stored_blob_digest(payload):
+    # jobs queued before the digest was part of the payload: it ends the key
+    return payload.get("content_hash") or payload["key"].rsplit("/", 1)[-1]
+
+
+def store_blob_failed(payload):
+    """Leave the blob marked unstored unless another upload wrote it
+    meanwhile, so the next upload of the same content transfers it again."""
+    digest = _stored_blob_digest(payload)
+    try:
+        get_storage().head(payload["key"])
+        stored = True
+    except StorageNotFound:
+        stored = False
+        logging.error(f"Blob {digest} could not be stored; its documents have no content until it is uploaded again")
+    db = get_db()
+    dedup.mark_stored(db, digest, stored)
+    db.commit()
+
 
+@jobs.register("store_blob", concurrency=4, max_attempts=5, on_failure=store_blob_failed)
+def store_blob_job(payload):
+    with open(payload["spool"], "rb") as f:
+        result = get_storage().put(payload["key"], f, size=payload["size"], content_type=payload["content_type"])
+    db = get_db()
+    dedup.mark_stored(db, _stored_blob_digest(payload))
+    db.commit()
+    return result
+
+
+def _accepted(job_id):
+    response = jsonify(job_id=job_id, status_url=f"/jobs/{job_id}")
+    response.status_code = 202
+    response.headers["Location"] = f"/jobs/{job_id}"
+    return response
+
+
+@bp.route("/jobs/<int:job_id>")
+def job_status(job_id):
+    if not session.get("role"):
+        return jsonify(error="login required"), 401
+    job = jobs.status(get_db(), job_id)
+    if not job or (session.get("role") != "admin" and job["created_by"] != session.get("email")):
+        return jsonify(error="not found"), 404
+    return jsonify(job)
+
+
+@bp.route("/upload/sas", methods=["POST"])
+def upload_sas():
+    # step 1 of a direct upload: hand out a short-lived write URL
+    if session.get("role") != "student":
+        return jsonify(error="login required"), 401
+
+    storage = get_storage()
+    problem = storage.config_error()
+    if problem:
+        logging.error(f"Storage backend misconfigured: {problem}")
+        return jsonify(error=f"Server misconfigured: {problem}"), 500
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(error="expected a JSON object"), 400
+    filename = data.get("filename")
+    if not isinstance(filename, str) or not filename:
+        return jsonify(error="filename must be a non-empty string"), 400
+    size = data.get("size")
+    if size is not None and (not isinstance(size, int) or isinstance(size, bool) or size < 0):
+        return jsonify(error="size must be a non-negative integer"), 400
+    if size is not None and size > direct_upload.MAX_UPLOAD_SIZE:
+        return jsonify(error=f"size must be at most {direct_upload.MAX_UPLOAD_SIZE} bytes"), 413
+    for name in ("sha256", "cert_type", "content_type"):
+        if data.get(name) is not None and not isinstance(data[name], str):
+            return jsonify(error=f"{name} must be a string"), 400
+
+    # the student already uploaded these exact bytes (hash verified by the
+    # server at the time): record the document without any transfer
+    content_hash = data.get("sha256")
+    if content_hash:
         db = get_db()
-        db.execute(
-            "INSERT INTO documents (student_email, filename, cert_type) VALUES (?, ?, ?)",
-            (session["email"], file.filename, cert_type)
-        )
-        db.commit()
+        owned = db.execute(
+            "SELECT size FROM documents WHERE content_hash=? AND student_email=? LIMIT 1",
+            (content_hash, session["email"])
+        ).fetchone()
+        if owned and dedup.is_stored(db, content_hash):
+            doc_id = record_document(db, session["email"], filename, data.get("cert_type"), content_hash, owned[0])
+            return jsonify(duplicate=True, id=doc_id), 201
+
+    blob_key = direct_upload.new_blob_key(filename)
+    content_type = data.get("content_type")
+    return jsonify(
+        upload_url=storage.presign(blob_key, "w", content_type=content_type),
+        method="PUT",
+        headers=storage.upload_headers(),
+        upload_token=direct_upload.issue_token(session["email"], blob_key, filename, data.get("cert_type"), size),
+    )
 
-        return "Uploaded successfully"
 
-    return render_template('student/upload.html')
+@bp.route("/upload/finalize", methods=["POST"])
+def upload_finalize():
+    # step 2 of a direct upload: record the document once the blob is there
+    if session.get("role") != "student":
+        return jsonify(error="login required"), 401
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(error="expected a JSON object"), 400
+    if data.get("cert_type") is not None and not isinstance(data["cert_type"], str):
+        return jsonify(error="cert_type must be a string"), 400
+    pending = direct_upload.read_token(data.get("upload_token"), session["email"])
+    if not pending:
+        return jsonify(error="invalid or expired upload token"), 400
+
+    db = get_db()
+    existing = db.execute("SELECT id FROM documents WHERE blob_key=?", (pending["key"],)).fetchone()
+    if existing:
+        return jsonify(id=existing[0])
+
+    storage = get_storage()
+    try:
+        info = storage.head(pending["key"])
+    except StorageNotFound:
+        return jsonify(error="upload not found in storage"), 409
+    if info.size > direct_upload.MAX_UPLOAD_SIZE or (pending["size"] is not None and info.size != pending["size"]):
+        storage.delete(pending["key"])
+        return jsonify(error="uploaded size does not match"), 400
+
+    doc_id = record_stored_blob(db, session["email"], pending["filename"], data.get("cert_type") or pending["cert_type"],
+                                pending["key"], info.size)
+    db.commit()
+    return jsonify(id=doc_id), 201
+
+
+def record_stored_blob(db, email, filename, cert_type, blob_key, size):
+    """Insert a document for a blob the client uploaded under its own key;
+    the caller commits."""
+    cur = db.execute(
+        "INSERT INTO documents (student_email, filename, cert_type, blob_key, size) VALUES (?, ?, ?, ?, ?)",
+        (email, filename, cert_type, blob_key, size)
+    )
+    stats.record_upload(db, cur.lastrowid)
+    if jobs.ENABLED:
+        jobs.enqueue(db, "render_preview", {"id": cur.lastrowid, "key": blob_key}, created_by=email)
+    return cur.lastrowid
+
+
+# Resumable uploads: open a session, PUT the chunks (each with its SHA-256 in
+# X-Chunk-SHA256), ask the session what is missing after a drop, finalize.
+
+@bp.route("/upload/sessions", methods=["POST"])
+def upload_session_create():
+    if session.get("role") != "student":
+        return jsonify(error="login required"), 401
+
+    storage = get_storage()
+    problem = storage.config_error()
+    if problem:
+        logging.error(f"Storage backend misconfigured: {problem}")
+        return jsonify(error=f"Server misconfigured: {problem}"), 500
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify(error="expected a JSON object"), 400
+    try:
+        upload = resumable.create(get_db(), session["email"], data.get("filename"), data.get("size"),
+                                  cert_type=data.get("cert_type"), content_type=data.get("content_type"),
+                                  chunk_size=data.get("chunk_size"))
+    except resumable.SessionError as e:
+        return jsonify(error=str(e)), e.status
+    response = jsonify(resumable.progress(get_db(), upload))
+    response.status_code = 201
+    response.headers["Location"] = f"/upload/sessions/{upload['id']}"
+    return response
+
+
+@bp.route("/upload/sessions/<session_id>", methods=["GET", "DELETE"])
+def upload_session(session_id):
+    if session.get("role") != "student":
+        return jsonify(error="login required"), 401
+    db = get_db()
+    upload = resumable.get(db, session_id, session["email"])
+    if not upload:
+        return jsonify(error="upload session not found"), 404
+    if request.method == "DELETE":
+        try:
+            resumable.abort(db, get_storage(), upload)
+        except resumable.SessionError as e:
+            return jsonify(error=str(e)), e.status
+        return "", 204
+    return jsonify(resumable.progress(db, upload))
+
+
+@bp.route("/upload/sessions/<session_id>/chunks/<int:index>", methods=["PUT"])
+@admission.limit('upload')
+def upload_session_chunk(session_id, index):
+    if session.get("role") != "student":
+        return jsonify(error="login required"), 401
+    db = get_db()
+    upload = resumable.get(db, session_id, session["email"])
+    if not upload:
+        return jsonify(error="upload session not found"), 404
+    try:
+        expected = resumable.chunk_length(upload, index)
+    except resumable.SessionError as e:
+        return jsonify(error=str(e)), e.status
+    # refuse a body of the wrong size before reading it
+    if request.content_length != expected:
+        return jsonify(error=f"chunk {index} must be sent with Content-Length: {expected}"), 400
+    try:
+        stored = resumable.store_chunk(db, get_storage(), upload, index, request.get_data(cache=False),
+                                       request.headers.get("X-Chunk-SHA256"))
+    except resumable.SessionError as e:
+        return jsonify(error=str(e)), e.status
+    return jsonify(index=index, stored=stored), 201 if stored else 200
+
 
-@app.route("/documents")
+@bp.route("/upload/sessions/<session_id>/finalize", methods=["POST"])
+@admission.limit('upload')
+def upload_session_finalize(session_id):
+    if session.get("role") != "student":
+        return jsonify(error="login required"), 401
+    data = request.get_json(silent=True) or {}
+    cert_type = data.get("cert_type") if isinstance(data, dict) else None
+    if cert_type is not None and not isinstance(cert_type, str):
+        return jsonify(error="cert_type must be a string"), 400
+    db = get_db()
+    # claimed in its own short transaction: the block commit is a storage
+    # round trip and must not hold SQLite's write lock
+    upload = resumable.claim(db, session_id, session["email"])
+    if upload is None:
+        upload = resumable.get(db, session_id, session["email"])
+        if not upload:
+            return jsonify(error="upload session not found"), 404
+        if upload["document_id"] is not None:
+            return jsonify(id=upload["document_id"])
+        return jsonify(error="upload is already being finalized"), 409
+    try:
+        size = resumable.commit(db, get_storage(), upload)
+    except resumable.SessionError as e:
+        resumable.unclaim(db, session_id)
+        return jsonify(error=str(e)), e.status
+    except Exception:
+        resumable.unclaim(db, session_id)
+        raise
+    doc_id = record_stored_blob(db, session["email"], upload["filename"], cert_type or upload["cert_type"],
+                                upload["blob_key"], size)
+    resumable.close(db, session_id, doc_id)
+    db.commit()
+    return jsonify(id=doc_id), 201
+
+@bp.route("/documents")
 def documents():
     if session.get("role") != "staff":
         return redirect("/login")
 
     db = get_db()
-    docs = db.execute("SELECT * FROM documents").fetchall()
+    docs = document_page(db, request.args)
+    if wants_json(request.args):
+        return jsonify(docs.to_json())
 
     return render_template('staff/documents.html', docs=docs)
 
 
-@app.route('/staff/manage_students')
+@bp.route("/documents/search")
+def documents_search():
+    role = session.get("role")
+    if role not in ("staff", "admin"):
+        return redirect("/login")
+
+    # staff search their own students unless they ask for every document,
+    # which they can already list on /documents
+    mentor = session.get("email") if role == "staff" and request.args.get("scope") != "all" else None
+    db = get_db()
+    results = search.search_page(db, request.args, mentor)
+    if wants_json(request.args):
+        if results is None:
+            return jsonify(error="q is required"), 400
+        return jsonify(results.to_json())
+
+    top_terms = []
+    if mentor:
+        top_terms = db.execute(
+            "SELECT keyword, count FROM mentor_keyword_stats WHERE mentor_email = ? ORDER BY count DESC, keyword LIMIT 10",
+            (mentor,),
+        ).fetchall()
+    return render_template('staff/search.html', docs=results, top_terms=top_terms,
+                           max_ranked=search.SEARCH_MAX_RANKED)
+
+
+@bp.route('/staff/manage_students')
 def staff_manage_students():
     if session.get('role') != 'staff':
         return redirect('/login')
@@ -421,18 +815,20 @@ def staff_manage_students():
     db = get_db()
     mentor = session.get('email')
     # show all students and their mentor (if any) so staff can map themselves
-    students = db.execute('SELECT id, email, mentor_email FROM students ORDER BY email').fetchall()
+    students = user_page(db, 'students', 'id, email, mentor_email', request.args)
+    if wants_json(request.args):
+        return jsonify(students.to_json())
 
     return render_template('staff/manage_students.html', students=students, mentor=mentor)
 
-@app.route('/staff/map_student/<int:student_id>', methods=['POST'])
+@bp.route('/staff/map_student/<int:student_id>', methods=['POST'])
 def staff_map_student(student_id):
     if session.get('role') != 'staff':
         return redirect('/login')
 
     db = get_db()
     cur = db.cursor()
-    row = cur.execute('SELECT mentor_email FROM students WHERE id=?', (student_id,)).fetchone()
+    row = cur.execute('SELECT mentor_email, email FROM students WHERE id=?', (student_id,)).fetchone()
     if not row:
         flash('Student not found', 'danger')
         return redirect('/staff/manage_students')
@@ -440,6 +836,8 @@ def staff_map_student(student_id):
     current = row[0]
     if current is None:
         cur.execute('UPDATE students SET mentor_email=? WHERE id=?', (session.get('email'), student_id))
+        stats.refresh_student(db, row[1])
+        cache.invalidate(db, 'students')
         db.commit()
         flash('Student mapped to you', 'success')
     else:
@@ -448,14 +846,14 @@ def staff_map_student(student_id):
     return redirect('/staff/manage_students')
 
 
-@app.route('/staff/unmap_student/<int:student_id>', methods=['POST'])
+@bp.route('/staff/unmap_student/<int:student_id>', methods=['POST'])
 def staff_unmap_student(student_id):
     if session.get('role') != 'staff':
         return redirect('/login')
 
     db = get_db()
     cur = db.cursor()
-    row = cur.execute('SELECT mentor_email FROM students WHERE id=?', (student_id,)).fetchone()
+    row = cur.execute('SELECT mentor_email, email FROM students WHERE id=?', (student_id,)).fetchone()
     if not row:
         flash('Student not found', 'danger')
         return redirect('/staff/manage_students')
@@ -466,12 +864,14 @@ def staff_unmap_student(student_id):
         return redirect('/staff/manage_students')
 
     cur.execute('UPDATE students SET mentor_email=NULL WHERE id=?', (student_id,))
+    stats.refresh_student(db, row[1])
+    cache.invalidate(db, 'students')
     db.commit()
     flash('Student unmapped successfully', 'success')
     return redirect('/staff/manage_students')
 
 
-@app.route('/staff/manage_documents')
+@bp.route('/staff/manage_documents')
 def staff_manage_documents():
     if session.get('role') != 'staff':
         return redirect('/login')
@@ -480,153 +880,148 @@ def staff_manage_documents():
     mentor = session.get('email')
     # optional student filter via query param
     student_filter = request.args.get('student')
-    docs = db.execute('''
-        SELECT d.id, d.student_email, d.filename, d.cert_type, d.uploaded_at
-        FROM documents d
-        JOIN students s ON s.email = d.student_email
-        WHERE s.mentor_email = ?
-        ''' + (" AND d.student_email = ?" if student_filter else "") + '''
-        ORDER BY d.uploaded_at DESC
-    ''', (mentor,) if not student_filter else (mentor, student_filter)).fetchall()
-
-    # Simple analytics (lightweight "ML-like" insights): per-student upload counts,
-    # cert-type distributions, and basic scoring (uploads vs expected).
+    where = ['s.mentor_email = ?']
+    params = [mentor]
     if student_filter:
-        students = db.execute('SELECT id, email FROM students WHERE mentor_email = ? AND email = ?', (mentor, student_filter)).fetchall()
-    else:
-        students = db.execute('SELECT id, email FROM students WHERE mentor_email = ?', (mentor,)).fetchall()
-    expected_per_student = 3
-    students_stats = []
-    total_uploads = 0
-    cert_type_agg = {}
-
-    for s in students:
-        email = s[1]
-        cur = db.execute('SELECT COUNT(*), GROUP_CONCAT(cert_type) FROM documents WHERE student_email = ?', (email,))
-        row = cur.fetchone()
-        uploads = row[0] if row and row[0] is not None else 0
-        cert_types_concat = row[1] or ''
-        # build cert-type counts
-        cert_counts = {}
-        if cert_types_concat:
-            for ct in cert_types_concat.split(','):
-                ct = (ct or '').strip()
-                if not ct:
-                    continue
-                cert_counts[ct] = cert_counts.get(ct, 0) + 1
-                cert_type_agg[ct] = cert_type_agg.get(ct, 0) + 1
-
-        score = int(min(100, (uploads / expected_per_student) * 100)) if expected_per_student > 0 else 0
-        students_stats.append({'email': email, 'uploads': uploads, 'cert_counts': cert_counts, 'score': score})
-        total_uploads += uploads
-
-    avg_uploads = (total_uploads / len(students)) if students else 0
-    # top cert types
-    top_cert_types = sorted(cert_type_agg.items(), key=lambda x: x[1], reverse=True)[:5]
-
-    # Simple file-based summarization (keywords from filenames, recent uploads)
-    import re
-    stopwords = set(['the','and','of','in','a','an','for','to','on','by','with','cert','certificate','doc','document','pdf','jpg','png'])
-
-    keyword_counts = {}
-    recent_uploads = []
-    per_student_latest = {}
-
-    for d in docs:
-        filename = d[2] or ''
-        email = d[1]
-        uploaded_at = d[4]
-        # recent uploads list (docs already ordered desc)
-        if len(recent_uploads) < 5:
-            recent_uploads.append({'filename': filename, 'student': email, 'uploaded_at': uploaded_at})
-
-        # per-student latest
-        if email not in per_student_latest:
-            per_student_latest[email] = {'filename': filename, 'uploaded_at': uploaded_at}
-
-        # extract keywords from filename
-        parts = re.split(r"[^A-Za-z0-9]+", filename.lower())
-        for p in parts:
-            if not p or p in stopwords or len(p) < 2:
-                continue
-            keyword_counts[p] = keyword_counts.get(p, 0) + 1
-
-    top_keywords = sorted(keyword_counts.items(), key=lambda x: x[1], reverse=True)[:10]
-
-    analytics = {
-        'total_students': len(students),
-        'total_uploads': total_uploads,
-        'avg_uploads': round(avg_uploads, 2),
-        'top_cert_types': top_cert_types,
-        'students_stats': students_stats,
-        'summary': {
-            'top_keywords': top_keywords,
-            'recent_uploads': recent_uploads,
-            'per_student_latest': per_student_latest,
-        }
-    }
+        where.append('d.student_email = ?')
+        params.append(student_filter)
+    docs = document_page(db, request.args, 'FROM documents d JOIN students s ON s.email = d.student_email', where, params)
+    if wants_json(request.args):
+        return jsonify(docs.to_json())
+
+    # per-student upload counts, cert-type distributions and filename keywords
+    analytics = mentor_analytics(db, mentor, student_filter)
 
     return render_template('staff/manage_documents.html', docs=docs, analytics=analytics)
 
 
-@app.route('/documents/download/<int:doc_id>')
+@bp.route('/documents/download/<int:doc_id>')
+@admission.limit('download')
 def documents_download(doc_id):
     if session.get('role') not in ('staff', 'admin', 'student'):
         return redirect('/login')
 
     db = get_db()
-    row = db.execute('SELECT filename FROM documents WHERE id=?', (doc_id,)).fetchone()
+    row = db.execute('SELECT filename, COALESCE(blob_key, filename) FROM documents WHERE id=?', (doc_id,)).fetchone()
     if not row:
         flash('Document not found', 'danger')
         return redirect('/dashboard')
 
-    filename = row[0]
-    if not container:
-        flash('Server not configured for blob container', 'danger')
+    filename, blob_key = row
+    storage = get_storage()
+    if storage.config_error():
+        flash('Server not configured for blob storage', 'danger')
         return redirect('/dashboard')
 
     try:
-        blob_client = blob_service.get_blob_client(container=container, blob=filename)
-        stream = blob_client.download_blob().readall()
-        return Response(stream, mimetype='application/octet-stream', headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+        if DIRECT_DOWNLOADS:
+            return redirect(storage.presign(blob_key, download_name=filename))
+        return blob_response(storage, blob_key, filename)
     except Exception as e:
         logging.exception('Failed to download blob')
         flash('Failed to download file', 'danger')
         return redirect('/dashboard')
 
 
-@app.route('/documents/view/<int:doc_id>')
+@bp.route('/documents/view/<int:doc_id>')
 def documents_view(doc_id):
     if session.get('role') not in ('staff', 'admin', 'student'):
         return redirect('/login')
 
     db = get_db()
-    row = db.execute('SELECT filename FROM documents WHERE id=?', (doc_id,)).fetchone()
+    row = db.execute('SELECT COALESCE(blob_key, filename) FROM documents WHERE id=?', (doc_id,)).fetchone()
     if not row:
         flash('Document not found', 'danger')
         return redirect('/dashboard')
 
-    filename = row[0]
-    # Prefer direct blob URL for browser viewing
-    account = os.getenv('AZURE_STORAGE_ACCOUNT')
-    if account and container:
-        url = f"https://{account}.blob.core.windows.net/{container}/{filename}"
-        return redirect(url)
+    blob_key = row[0]
+    # Prefer a short-lived direct storage URL for browser viewing
+    storage = get_storage()
+    if not storage.config_error():
+        return redirect(storage.url(blob_key))
     else:
         return redirect('/documents')
 
 
-@app.route('/documents/verify/<int:doc_id>', methods=['POST'])
+@bp.route('/documents/preview/<int:doc_id>')
+def documents_preview(doc_id):
+    if session.get('role') not in ('staff', 'admin', 'student'):
+        return redirect('/login')
+
+    width = request.args.get('w', previews.DEFAULT_WIDTH, type=int)
+    if width not in previews.PREVIEW_WIDTHS:
+        return f"w must be one of {', '.join(map(str, previews.PREVIEW_WIDTHS))}", 400
+
+    db = get_db()
+    row = db.execute('SELECT COALESCE(blob_key, filename), content_hash FROM documents WHERE id=?', (doc_id,)).fetchone()
+    if not row:
+        return "Not found", 404
+
+    storage = get_storage()
+    try:
+        key, data = previews.get_preview(storage, doc_id, row[0], row[1], width)
+    except StorageNotFound:
+        key, data = None, None
+    if data is None:
+        response = Response(previews.PLACEHOLDER_SVG, mimetype='image/svg+xml')
+        if key == previews.marker_key(doc_id, row[1]):
+            response.headers['Cache-Control'] = 'private, max-age=86400'
+        else:
+            # not cached for long: the original may still be on its way
+            response.headers['Cache-Control'] = 'private, max-age=60'
+        return response
+
+    # a preview never changes once rendered
+    response = Response(data, mimetype='image/jpeg')
+    response.set_etag(hashlib.sha1(key.encode()).hexdigest())
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response.make_conditional(request)
+
+
+@jobs.register("render_preview", concurrency=2, max_attempts=5)
+def render_preview_job(payload):
+    # raises StorageNotFound (and is retried) until store_blob has run
+    key, data = previews.get_preview(get_storage(), payload["id"], payload["key"], payload.get("content_hash"))
+    return {"key": key, "size": len(data) if data else 0}
+
+
+@bp.route('/storage/<path:key>', methods=['GET', 'PUT'])
+@admission.limit({'GET': 'download', 'PUT': 'upload'})
+def storage_object(key):
+    # signed URLs handed out by the local and memory backends' presign()
+    storage = get_storage()
+    if request.method == 'PUT':
+        if not verify_signed_request(key, request.args, 'w'):
+            return "Invalid or expired link", 403
+        if request.content_length and request.content_length > direct_upload.MAX_UPLOAD_SIZE:
+            return "Upload too large", 413
+        storage.put(key, request.stream, size=request.content_length, content_type=request.mimetype or None)
+        return "", 201
+
+    if not verify_signed_request(key, request.args, 'r'):
+        return "Invalid or expired link", 403
+    download_name = request.args.get('dl')
+    try:
+        if download_name:
+            return blob_response(storage, key, download_name)
+        return blob_response(storage, key, key.rsplit('/', 1)[-1], disposition='inline')
+    except StorageNotFound:
+        return "Not found", 404
+
+
+@bp.route('/documents/verify/<int:doc_id>', methods=['POST'])
 def documents_verify(doc_id):
     if session.get('role') not in ('staff', 'admin'):
         return redirect('/login')
 
-    ensure_verification_columns()
     db = get_db()
     cur = db.cursor()
     verifier = session.get('email')
     try:
+        row = cur.execute('SELECT student_email, verified FROM documents WHERE id=?', (doc_id,)).fetchone()
         cur.execute('UPDATE documents SET verified=1, verifier=?, verified_at=CURRENT_TIMESTAMP WHERE id=?', (verifier, doc_id))
+        if row and not row[1]:
+            stats.record_verified(db, row[0], 1)
         db.commit()
         flash('Document verified', 'success')
     except Exception:
@@ -636,18 +1031,76 @@ def documents_verify(doc_id):
     return redirect(request.referrer or '/dashboard')
 
 
-@app.route("/my-documents")
+@bp.route('/documents/verify/batch', methods=['POST'])
+def documents_verify_batch():
+    role = session.get('role')
+    if role not in ('staff', 'admin'):
+        return jsonify(error='login required'), 401
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify(error='expected a JSON object'), 400
+    # staff act on their own students' documents; admins on any
+    mentor = session.get('email') if role == 'staff' else None
+    try:
+        result = verification.apply(get_db(), data.get('action', 'verify'), session.get('email'),
+                                    ids=data.get('ids'), filters=data.get('filter'), mentor=mentor)
+    except verification.BatchError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(result)
+
+
+@bp.route('/documents/export')
+@admission.limit('export')
+def documents_export():
+    role = session.get('role')
+    if role not in ('staff', 'admin'):
+        return redirect('/login')
+
+    student = request.args.get('student')
+    mentor = session.get('email') if role == 'staff' else request.args.get('mentor')
+    if not student and not mentor:
+        return 'student or mentor is required', 400
+
+    from_sql = 'FROM documents d'
+    where, params = [], []
+    if mentor:
+        from_sql += ' JOIN students s ON s.email = d.student_email'
+        where.append('s.mentor_email = ?')
+        params.append(mentor)
+    if student:
+        where.append('d.student_email = ?')
+        params.append(student)
+    where, params = document_filters(request.args, where, params)
+    rows = export.export_documents(get_db(), where, params, from_sql)
+    if not rows:
+        return 'No documents to export', 404
+    if len(rows) > export.MAX_EXPORT_DOCUMENTS:
+        return f'More than {export.MAX_EXPORT_DOCUMENTS} documents; narrow the export with filters', 400
+
+    name = export.folder_name(student or mentor)
+    return Response(
+        export.stream_zip(get_storage(), rows, manifest=request.args.get('manifest') != '0'),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="export-{name}.zip"'},
+        direct_passthrough=True,
+    )
+
+
+@bp.route("/my-documents")
 def my_documents():
     if session.get("role") != "student":
         return redirect("/login")
 
     db = get_db()
-    docs = db.execute("SELECT * FROM documents WHERE student_email=?", (session["email"],)).fetchall()
+    docs = document_page(db, request.args, where=['d.student_email = ?'], params=[session["email"]])
+    if wants_json(request.args):
+        return jsonify(docs.to_json())
 
     return render_template('student/documents.html', docs=docs)
 
 
-@app.route("/profile")
+@bp.route("/profile")
 def profile():
     if "role" not in session:
         return redirect("/login")
@@ -655,18 +1108,120 @@ def profile():
     db = get_db()
     role = session.get("role")
     user = None
+    email = session.get("email")
     if role == "student":
-        user = db.execute("SELECT email, mentor_email FROM students WHERE email=?", (session.get("email"),)).fetchone()
+        user = cache.cached(db, "students", email, lambda: db.execute(
+            "SELECT email, mentor_email FROM students WHERE email=?", (email,)).fetchone())
     else:
-        user = db.execute("SELECT email FROM staff WHERE email=?", (session.get("email"),)).fetchone()
+        user = cache.cached(db, "staff", email, lambda: db.execute(
+            "SELECT email FROM staff WHERE email=?", (email,)).fetchone())
 
     return render_template('shared/profile.html', role=role, user=user)
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     session.clear()
     return redirect("/login")
 
+@bp.cli.command('stats-rebuild')
+def stats_rebuild_command():
+    """Recompute the dashboard summary tables from documents."""
+    stats.rebuild(get_db())
+    print('Summary tables rebuilt')
+
+
+@bp.cli.command('search-rebuild')
+def search_rebuild_command():
+    """Rebuild the document full-text index."""
+    search.rebuild(get_db())
+    print('Search index rebuilt')
+
+
+@bp.cli.command('stats-check')
+def stats_check_command():
+    """Compare the dashboard summary tables with documents."""
+    problems = stats.check(get_db())
+    for table, key, stored, expected in problems[:50]:
+        print(f'{table} {key}: stored={stored} expected={expected}')
+    if problems:
+        raise SystemExit(f'{len(problems)} mismatches; run "flask stats-rebuild"')
+    print('Summary tables are consistent')
+
+
+@bp.cli.command('blobs-gc')
+def blobs_gc_command():
+    """Delete content-addressed blobs that no document references."""
+    removed = dedup.collect_garbage(get_db(), get_storage())
+    print(f'Removed {removed} unreferenced blobs')
+
+
+@bp.cli.command('upload-sessions-gc')
+@click.option('--ttl-hours', default=resumable.SESSION_TTL / 3600, show_default=True,
+              help='Remove sessions untouched for this long.')
+def upload_sessions_gc_command(ttl_hours):
+    """Remove abandoned resumable upload sessions and their staged blocks."""
+    removed = resumable.collect_expired(get_db(), get_storage(), ttl=ttl_hours * 3600)
+    print(f'Removed {removed} expired upload sessions')
+
+
+@bp.cli.command('reconcile')
+@click.option('--delete-orphans', is_flag=True, help='Delete blobs that nothing refers to.')
+@click.option('--delete-dangling', is_flag=True, help='Delete documents whose blob is missing or whose student is gone.')
+@click.option('--resume', is_flag=True, help='Continue the latest unfinished run from its checkpoint.')
+@click.option('--min-age-hours', default=reconcile.RECONCILE_MIN_AGE_HOURS, show_default=True,
+              help='Leave blobs and documents younger than this alone.')
+@click.option('--rate', default=reconcile.RECONCILE_RATE, show_default=True, help='Blobs listed per second (0: no limit).')
+@click.option('--delete-rate', default=reconcile.RECONCILE_DELETE_RATE, show_default=True,
+              help='Deletes per second (0: no limit).')
+@click.option('--concurrency', default=reconcile.RECONCILE_CONCURRENCY, show_default=True, help='Parallel deletes.')
+@click.option('--report', type=click.Path(dir_okay=False), help='Append every finding to this JSON lines file.')
+def reconcile_command(delete_orphans, delete_dangling, resume, min_age_hours, rate, delete_rate, concurrency, report):
+    """Compare the blob container with the documents table."""
+    storage = get_storage()
+    problem = storage.config_error()
+    if problem:
+        raise SystemExit(problem)
+    counts = reconcile.Reconciler(
+        get_db(), storage, delete_orphans=delete_orphans, delete_dangling=delete_dangling,
+        min_age_hours=min_age_hours, rate=rate, delete_rate=delete_rate, concurrency=concurrency, report=report,
+    ).run(resume=resume)
+    for name, value in counts.items():
+        print(f'{name}: {value}')
+
+
+@bp.cli.command('jobs-worker')
+@click.option('--processes', default=2, show_default=True, help='Number of worker processes.')
+def jobs_worker_command(processes):
+    """Run background job workers until interrupted."""
+    jobs.run_workers(processes)
+
+
+@bp.cli.command('init-db')
+def init_db_command():
+    """Apply pending migrations and seed the initial admin."""
+    try:
+        ensure_admin_table()
+    except MigrationError as e:
+        raise SystemExit(str(e))
+    print('Database is up to date')
+
+
+def create_app():
+    """Build the application. Nothing here touches the database or storage:
+    connections and clients are opened on first use in each worker, and
+    migrations run through "flask init-db"."""
+    app = Flask(__name__)
+    app.secret_key = "secret123"  # change later
+    db_pool.init_app(app)
+    metrics.init_app(app)
+    profiling.init_app(app)
+    app.register_blueprint(bp)
+    return app
+
+
+app = create_app()
+
+
 if __name__ == "__main__":
     app.run()
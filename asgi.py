@@ -0,0 +1,428 @@
+"""ASGI entry point: blob transfers on asyncio, everything else on Flask.
+
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker --workers 2
+    uvicorn asgi:app --workers 2
+
+The sync deployment (``gunicorn app:app``) is unchanged. Here the routes that
+spend their time waiting on storage run as coroutines, so one worker keeps
+hundreds of transfers in flight instead of one per process:
+
+* ``POST /upload``
+* ``GET /documents/download/<id>`` (when downloads are proxied)
+* ``GET/PUT /storage/<key>``, the signed URLs ``/documents/view/<id>``
+  redirects to on the local and memory backends
+
+Storage is reached through the backends' async methods (the Azure SDK's aio
+client when aiohttp is installed, threads otherwise) and SQLite through short
+calls on a thread pool the size of the connection pool. Every other request,
+and any of the above that ends in a redirect or a flash message, is handed to
+the Flask app on ASGI_WSGI_THREADS threads.
+"""
+import asyncio
+import contextvars
+import hashlib
+import io
+import os
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+from werkzeug.wrappers import Request
+
+import admission
+import app as flask_module
+import db as db_pool
+import dedup
+import direct_upload
+import jobs
+import metrics
+from downloads import plan
+from storage import StorageNotFound, get_storage, verify_signed_request
+
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "16"))
+# threads for storage backends without a native async client
+ASGI_BLOB_THREADS = int(os.getenv("ASGI_BLOB_THREADS", "64"))
+RECEIVE_SPOOL_SIZE = 1024 * 1024
+
+flask_app = flask_module.app
+_executors = {}
+
+
+def _executor(name, size):
+    # created lazily so every worker process gets its own threads
+    pool = _executors.get(name)
+    if pool is None:
+        pool = _executors[name] = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"asgi-{name}")
+    return pool
+
+
+async def run_db(fn, *args):
+    """Run ``fn(db, *args)`` with a pooled connection on a DB thread."""
+    def call():
+        conn = db_pool.pool.acquire()
+        try:
+            return fn(conn, *args)
+        finally:
+            db_pool.pool.release(conn)
+    ctx = contextvars.copy_context()  # keeps per-request query metrics
+    return await asyncio.get_running_loop().run_in_executor(_executor("db", db_pool.POOL_SIZE), ctx.run, call)
+
+
+# -- plumbing -----------------------------------------------------------------
+
+def _environ(scope, body=None):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client")
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1] or 80),
+        "REMOTE_ADDR": client[0] if client else "",
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body if body is not None else io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name, value = name.decode("latin-1"), value.decode("latin-1")
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+            if key in environ:
+                value = environ[key] + ("; " if key == "HTTP_COOKIE" else ", ") + value
+            environ[key] = value
+    return environ
+
+
+def _session(req):
+    return flask_app.session_interface.open_session(flask_app, req) or {}
+
+
+async def _start(send, status, headers):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in headers.items()],
+    })
+
+
+async def _respond(send, status, body, content_type="text/html; charset=utf-8", headers=None):
+    body = body.encode() if isinstance(body, str) else body
+    headers = dict(headers or {}, **{"Content-Type": content_type, "Content-Length": str(len(body))})
+    if content_type.startswith("text/html"):
+        # what add_no_cache_headers does for Flask's HTML responses
+        headers.update({"Cache-Control": "no-store, no-cache, must-revalidate, max-age=0", "Pragma": "no-cache", "Expires": "0"})
+    await _start(send, status, headers)
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _read_body(receive, out, limit=None):
+    """Copy the request body into ``out``; returns its size, or None when
+    the client went away or the body exceeds ``limit``."""
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if limit is not None and size > limit:
+            return None
+        out.write(chunk)
+        if not message.get("more_body"):
+            return size
+
+
+async def _send_blob(scope, receive, send, req, storage, key, info, filename, disposition):
+    status, headers, span = plan(req, info, filename, disposition)
+    if span is None or span[1] == 0 or scope["method"] == "HEAD":
+        await _start(send, status, headers)
+        await send({"type": "http.response.body", "body": b""})
+        return status
+
+    # stop reading from storage as soon as the client disconnects
+    gone = asyncio.Event()
+
+    async def watch():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        gone.set()
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        await _start(send, status, headers)
+        async for chunk in storage.aget_stream(key, offset=span[0], length=span[1], etag=info.etag):
+            if gone.is_set():
+                return 499
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        watcher.cancel()
+    return status
+
+
+# -- async routes -------------------------------------------------------------
+# Each returns the response status, or None to let Flask answer the request
+# instead (only ever before the body has been read).
+
+async def download(scope, receive, send, req, doc_id):
+    if _session(req).get("role") not in ("staff", "admin", "student") or flask_module.DIRECT_DOWNLOADS:
+        return None
+    storage = get_storage()
+    if storage.config_error():
+        return None
+    row = await run_db(lambda db: db.execute(
+        "SELECT filename, COALESCE(blob_key, filename) FROM documents WHERE id=?", (doc_id,)).fetchone())
+    if not row:
+        return None
+    filename, key = row
+    try:
+        info = await storage.ahead(key)
+    except StorageNotFound:
+        return None
+    return await _send_blob(scope, receive, send, req, storage, key, info, filename, "attachment")
+
+
+async def storage_get(scope, receive, send, req, key):
+    with flask_app.app_context():
+        if not verify_signed_request(key, req.args, "r"):
+            return None
+    storage = get_storage()
+    try:
+        info = await storage.ahead(key)
+    except StorageNotFound:
+        return None
+    name = req.args.get("dl")
+    return await _send_blob(scope, receive, send, req, storage, key, info, name or key.rsplit("/", 1)[-1],
+                            "attachment" if name else "inline")
+
+
+async def storage_put(scope, receive, send, req, key):
+    with flask_app.app_context():
+        if not verify_signed_request(key, req.args, "w"):
+            return None
+    if req.content_length and req.content_length > direct_upload.MAX_UPLOAD_SIZE:
+        return None
+    with tempfile.SpooledTemporaryFile(RECEIVE_SPOOL_SIZE) as body:
+        size = await _read_body(receive, body, direct_upload.MAX_UPLOAD_SIZE)
+        if size is None:
+            await _respond(send, 413, "Upload too large")
+            return 413
+        body.seek(0)
+        await get_storage().aput(key, body, size=size, content_type=req.mimetype or None)
+    await _respond(send, 201, b"")
+    return 201
+
+
+async def upload(scope, receive, send, req, _=None):
+    session = _session(req)
+    boundary = req.mimetype_params.get("boundary")
+    if session.get("role") != "student" or req.mimetype != "multipart/form-data" or not boundary:
+        return None
+    storage = get_storage()
+    if storage.config_error():
+        return None
+
+    decoder = MultipartDecoder(boundary.encode(), max_form_memory_size=flask_app.config.get("MAX_FORM_MEMORY_SIZE"))
+    fields, current, field_data = {}, None, []
+    filename = mimetype = None
+    digest, size = hashlib.sha256(), 0
+    with tempfile.SpooledTemporaryFile(RECEIVE_SPOOL_SIZE) as spool:
+        done = False
+        while not done:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return 499
+            decoder.receive_data(message.get("body", b""))
+            if not message.get("more_body"):
+                decoder.receive_data(None)
+            while True:
+                try:
+                    event = decoder.next_event()
+                except ValueError:
+                    await _respond(send, 400, "Invalid multipart body")
+                    return 400
+                if isinstance(event, NeedData):
+                    break
+                if isinstance(event, File):
+                    current = "file" if event.name == "file" and filename is None else None
+                    if current:
+                        filename, mimetype = event.filename, event.headers.get("Content-Type")
+                elif isinstance(event, Field):
+                    current, field_data = event.name, []
+                elif isinstance(event, Data):
+                    if current == "file":
+                        digest.update(event.data)
+                        spool.write(event.data)
+                        size += len(event.data)
+                        if size > direct_upload.MAX_UPLOAD_SIZE:
+                            await _respond(send, 413, "Upload too large")
+                            return 413
+                    elif current is not None:
+                        field_data.append(event.data)
+                        if not event.more_data:
+                            fields[current] = b"".join(field_data).decode("utf-8", "replace")
+                elif isinstance(event, Epilogue):
+                    done = True
+                    break
+            if not message.get("more_body"):
+                done = True
+
+        if not filename:
+            await _respond(send, 400, "No file provided")
+            return 400
+
+        content_hash = digest.hexdigest()
+        blob_key = dedup.content_key(content_hash)
+        spool.seek(0)
+        job_payload = None
+        if not await run_db(dedup.is_stored, content_hash):
+            if jobs.ENABLED:
+                path = await asyncio.to_thread(jobs.spool, spool)
+                job_payload = {"spool": path, "key": blob_key, "content_hash": content_hash, "size": size,
+                               "content_type": mimetype}
+            else:
+                await storage.aput(blob_key, spool, size=size, content_type=mimetype)
+
+    def record(db):
+        job_id = jobs.enqueue(db, "store_blob", job_payload, created_by=session["email"]) if job_payload else None
+        flask_module.record_document(db, session["email"], filename, fields.get("cert_type"), content_hash, size,
+                                     stored=job_payload is None)
+        return job_id
+
+    job_id = await run_db(record)
+    if job_id:
+        await _respond(send, 202, f'{{"job_id": {job_id}, "status_url": "/jobs/{job_id}"}}\n',
+                       "application/json", {"Location": f"/jobs/{job_id}"})
+        return 202
+    await _respond(send, 200, "Uploaded successfully")
+    return 200
+
+
+# (method, path pattern, handler, argument type, route name for metrics, admission gate)
+ROUTES = [
+    ("POST", re.compile(r"/upload"), upload, None, "/upload", "upload"),
+    ("GET", re.compile(r"/documents/download/(\d+)"), download, int, "/documents/download/<int:doc_id>", "download"),
+    ("GET", re.compile(r"/storage/(.+)"), storage_get, str, "/storage/<path:key>", "download"),
+    ("HEAD", re.compile(r"/storage/(.+)"), storage_get, str, "/storage/<path:key>", None),
+    ("PUT", re.compile(r"/storage/(.+)"), storage_put, str, "/storage/<path:key>", "upload"),
+]
+
+
+def _match(method, path):
+    for route_method, pattern, handler, convert, name, gate in ROUTES:
+        m = pattern.fullmatch(path) if route_method == method else None
+        if m:
+            return handler, convert(m.group(1)) if convert else None, name, gate
+    return None
+
+
+async def _admitted(scope, receive, send, req, handler, arg, gate):
+    """Run ``handler`` holding a slot of ``gate``, or answer 503 when the
+    gate turns the request away."""
+    if gate is None or not admission.ADMISSION_ENABLED:
+        return await handler(scope, receive, send, req, arg)
+    gate = admission.GATES[gate]
+    user = admission.user_key(_session(req), req.remote_addr)
+    if not await gate.aacquire(user):
+        body, headers = admission.busy_message(gate)
+        await _respond(send, 503, body, "text/plain; charset=utf-8", headers)
+        return 503
+    start = time.monotonic()
+    try:
+        return await handler(scope, receive, send, req, arg)
+    finally:
+        gate.release(user, start)
+
+
+# -- WSGI fallback ------------------------------------------------------------
+
+async def call_flask(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    pool = _executor("wsgi", ASGI_WSGI_THREADS)
+    body = tempfile.SpooledTemporaryFile(RECEIVE_SPOOL_SIZE)
+    if await _read_body(receive, body) is None:
+        body.close()
+        return
+    body.seek(0)
+    environ = _environ(scope, body)
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+        return lambda data: None
+
+    def call():
+        result = flask_app(environ, start_response)
+        return result, iter(result)
+
+    result, chunks = await loop.run_in_executor(pool, call)
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": started["status"],
+            "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in started["headers"]],
+        })
+        while True:
+            # streamed bodies (exports) are produced on the pool, chunk by chunk
+            chunk = await loop.run_in_executor(pool, next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(result, "close"):
+            await loop.run_in_executor(pool, result.close)
+        body.close()
+
+
+# -- entry point --------------------------------------------------------------
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=ASGI_BLOB_THREADS, thread_name_prefix="asgi-blob"))
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            for pool in _executors.values():
+                pool.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    matched = _match(scope["method"], scope["path"])
+    if matched:
+        handler, arg, route, gate = matched
+        req = Request(_environ(scope))
+        token = metrics.begin_request() if metrics.METRICS_ENABLED else None
+        status = await _admitted(scope, receive, send, req, handler, arg, gate)
+        if status is not None:
+            if token:
+                metrics.end_request(token, scope["method"], route, req.full_path.rstrip("?"), status)
+            return
+        if token:
+            metrics.cancel_request(token)  # Flask counts this one itself
+    await call_flask(scope, receive, send)
@@ -0,0 +1,86 @@
+"""Compare the summary-table analytics with the original per-student loop.
+
+    python -m benchmarks.bench_analytics [--sizes 10000 100000] [--students 300]
+"""
+import argparse
+import json
+import re
+
+from analytics import mentor_analytics
+from benchmarks.common import drop_db, scratch_db, seed, timeit
+
+
+def legacy_analytics(db, mentor):
+    # the implementation staff_manage_documents used before analytics.py
+    docs = db.execute('''
+        SELECT d.id, d.student_email, d.filename, d.cert_type, d.uploaded_at
+        FROM documents d
+        JOIN students s ON s.email = d.student_email
+        WHERE s.mentor_email = ?
+        ORDER BY d.uploaded_at DESC
+    ''', (mentor,)).fetchall()
+    students = db.execute('SELECT id, email FROM students WHERE mentor_email = ?', (mentor,)).fetchall()
+    expected_per_student = 3
+    students_stats = []
+    total_uploads = 0
+    cert_type_agg = {}
+    for s in students:
+        email = s[1]
+        row = db.execute('SELECT COUNT(*), GROUP_CONCAT(cert_type) FROM documents WHERE student_email = ?', (email,)).fetchone()
+        uploads = row[0] if row and row[0] is not None else 0
+        cert_counts = {}
+        for ct in (row[1] or '').split(','):
+            ct = ct.strip()
+            if not ct:
+                continue
+            cert_counts[ct] = cert_counts.get(ct, 0) + 1
+            cert_type_agg[ct] = cert_type_agg.get(ct, 0) + 1
+        score = int(min(100, (uploads / expected_per_student) * 100))
+        students_stats.append({'email': email, 'uploads': uploads, 'cert_counts': cert_counts, 'score': score})
+        total_uploads += uploads
+    top_cert_types = sorted(cert_type_agg.items(), key=lambda x: x[1], reverse=True)[:5]
+    stopwords = set(['the','and','of','in','a','an','for','to','on','by','with','cert','certificate','doc','document','pdf','jpg','png'])
+    keyword_counts = {}
+    per_student_latest = {}
+    for d in docs:
+        filename = d[2] or ''
+        if d[1] not in per_student_latest:
+            per_student_latest[d[1]] = {'filename': filename, 'uploaded_at': d[4]}
+        for p in re.split(r"[^A-Za-z0-9]+", filename.lower()):
+            if not p or p in stopwords or len(p) < 2:
+                continue
+            keyword_counts[p] = keyword_counts.get(p, 0) + 1
+    top_keywords = sorted(keyword_counts.items(), key=lambda x: x[1], reverse=True)[:10]
+    return total_uploads, top_cert_types, top_keywords
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--students", type=int, default=300)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        db, path = scratch_db()
+        try:
+            # every student belongs to one mentor: the worst case for this page
+            mentor = seed(db, staff=1, students=args.students, documents=size)[0]
+            new = mentor_analytics(db, mentor)
+            legacy = legacy_analytics(db, mentor)
+            assert new['total_uploads'] == legacy[0]
+            assert sorted(new['top_cert_types']) == sorted(legacy[1])
+            results.append({
+                "documents": size,
+                "students": args.students,
+                "legacy": timeit(lambda: legacy_analytics(db, mentor), args.repeat),
+                "summary_tables": timeit(lambda: mentor_analytics(db, mentor), args.repeat),
+            })
+        finally:
+            drop_db(db, path)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
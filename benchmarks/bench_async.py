@@ -0,0 +1,184 @@
+"""Concurrent transfers a single worker sustains: sync gunicorn vs asgi.py.
+
+    python -m benchmarks.bench_async --latency-ms 100 --concurrency 1 10 50 100 200 400
+
+Both modes serve one worker process over the same seeded database, with blobs
+in a MemoryStorage that waits --latency-ms on every call, standing in for the
+round trip to Azure (slept in the sync worker, awaited in the async one). At
+each concurrency level that many clients download or upload back to back for
+--duration seconds; the report is completed transfers per second and their
+latency. Requires gunicorn and uvicorn.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from benchmarks.common import drop_db, scratch_db, seed
+from benchmarks.loadtest import ROOT, _free_port, _http_call, _multipart, download_targets, install_storage, percentile
+
+
+def sync_app():
+    """gunicorn entry point: ``benchmarks.bench_async:sync_app()``."""
+    from app import app
+    install_storage(os.environ["AUTH_DB_PATH"], int(os.environ["BENCH_BLOBS"]), float(os.environ["BENCH_LATENCY_MS"]))
+    return app
+
+
+def async_app():
+    """uvicorn factory: ``--factory benchmarks.bench_async:async_app``."""
+    import asgi
+    install_storage(os.environ["AUTH_DB_PATH"], int(os.environ["BENCH_BLOBS"]), float(os.environ["BENCH_LATENCY_MS"]))
+    return asgi.app
+
+
+def start_server(mode, args, db_path, port):
+    env = dict(os.environ, AUTH_DB_PATH=db_path, STORAGE_BACKEND="memory", BACKGROUND_JOBS="0", ADMISSION_ENABLED="0",
+               BENCH_BLOBS=str(args.blobs), BENCH_LATENCY_MS=str(args.latency_ms), PYTHONPATH=ROOT)
+    if mode == "sync":
+        cmd = [sys.executable, "-m", "gunicorn", "--preload", "--workers", "1", "--threads", str(args.sync_threads),
+               "--bind", f"127.0.0.1:{port}", "--log-level", "warning", "--timeout", "300", "--backlog", "4096",
+               "benchmarks.bench_async:sync_app()"]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "--factory", "benchmarks.bench_async:async_app", "--host", "127.0.0.1",
+               "--port", str(port), "--log-level", "warning", "--backlog", "4096", "--no-access-log"]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"{mode} server exited with status {proc.returncode}")
+        try:
+            import socket
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit(f"{mode} server did not start within 60s")
+
+
+def login(port, role, email, password):
+    import http.client
+    from urllib.parse import urlencode
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    body = urlencode({"role": role, "email": email, "password": password}).encode()
+    status, cookie = _http_call(conn, "POST", "/login", body, {"Content-Type": "application/x-www-form-urlencoded"})
+    conn.close()
+    if status != 302 or not cookie:
+        raise SystemExit(f"could not log in as {role} {email}")
+    return cookie
+
+
+async def fetch(port, method, path, headers, body=b""):
+    """One request on a fresh connection; returns the status. The body is
+    read and discarded."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        head = f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\nContent-Length: {len(body)}\r\n"
+        head += "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+        writer.write(head.encode("latin-1") + b"\r\n" + body)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        while await reader.read(256 * 1024):
+            pass
+        return status
+    finally:
+        writer.close()
+
+
+async def run_level(port, scenario, concurrency, duration, cookies, download_ids, upload_bytes):
+    samples = []
+    stop = time.monotonic() + duration
+    # unseeded: identical payloads across runs would be deduplicated instead of stored
+    rng = random.Random()
+
+    def request():
+        if scenario == "download":
+            return "GET", f"/documents/download/{rng.choice(download_ids)}", {"Cookie": cookies["staff"]}, b"", 200
+        _, path, body, headers = _multipart("/upload", {"cert_type": "Internship"},
+                                            ("file", "bench.pdf", rng.randbytes(upload_bytes)))
+        return "POST", path, dict(headers, Cookie=cookies["student"]), body, 200
+
+    async def client():
+        while time.monotonic() < stop:
+            method, path, headers, body, expected = request()
+            start = time.perf_counter()
+            try:
+                status = await fetch(port, method, path, headers, body)
+            except (OSError, ValueError, IndexError):
+                status = None
+            if time.monotonic() <= stop:
+                samples.append(((time.perf_counter() - start) * 1000, status == expected))
+
+    tasks = [asyncio.ensure_future(client()) for _ in range(concurrency)]
+    # transfers still queued when the window closes are not counted
+    await asyncio.wait(tasks, timeout=duration + 1)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    latencies = sorted(ms for ms, _ in samples)
+    return {
+        "concurrency": concurrency,
+        "completed": len(samples),
+        "errors": sum(1 for _, ok in samples if not ok),
+        "transfers_per_sec": round(len(samples) / duration, 1),
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="+", choices=("sync", "async"), default=["sync", "async"])
+    parser.add_argument("--scenarios", nargs="+", choices=("download", "upload"), default=["download", "upload"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 100, 200, 400])
+    parser.add_argument("--latency-ms", type=float, default=100.0, help="simulated storage round trip")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per concurrency level")
+    parser.add_argument("--blobs", type=int, default=50)
+    parser.add_argument("--upload-kb", type=int, default=64)
+    parser.add_argument("--sync-threads", type=int, default=1, help="threads in the sync worker (gthread when > 1)")
+    parser.add_argument("--out", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    db, path = scratch_db()
+    seed(db, staff=5, students=200, documents=2000)
+    db.close()
+    download_ids = [doc_id for doc_id, _ in download_targets(path, args.blobs)]
+    results = {"latency_ms": args.latency_ms, "duration": args.duration, "sync_threads": args.sync_threads, "modes": {}}
+    try:
+        for mode in args.modes:
+            port = _free_port()
+            server = start_server(mode, args, path, port)
+            try:
+                cookies = {
+                    "staff": login(port, "staff", "staff0@college.com", "pw"),
+                    "student": login(port, "student", "student0@college.com", "pw"),
+                }
+                for scenario in args.scenarios:
+                    levels = []
+                    for concurrency in args.concurrency:
+                        level = asyncio.run(run_level(port, scenario, concurrency, args.duration, cookies,
+                                                      download_ids, args.upload_kb * 1024))
+                        print(json.dumps({"mode": mode, "scenario": scenario, **level}), flush=True)
+                        levels.append(level)
+                    results["modes"].setdefault(mode, {})[scenario] = levels
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+    finally:
+        import sqlite3
+        drop_db(sqlite3.connect(path), path)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
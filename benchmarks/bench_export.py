@@ -0,0 +1,98 @@
+"""Throughput and memory of the streaming ZIP export.
+
+    python -m benchmarks.bench_export --total-mb 3072
+
+"disk" streams sparse files from LocalDiskStorage and reports the peak Python
+heap, which should stay near EXPORT_PREFETCH * (EXPORT_PREFETCH_CHUNKS + 1)
+chunks however large the archive is. (RSS is not used: it also counts the
+page cache mapped by LocalDiskStorage's mmap reads.) "latency" exports many small blobs from a MemoryStorage with a
+simulated per-request latency and compares read-ahead depths.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import export
+from storage import LocalDiskStorage, MemoryStorage
+
+
+def rows_for(keys, size):
+    return [(i, f"student{i % 7}@college.com", f"cert_{i}.pdf", "NPTEL", "2025-01-01 10:00:00", 1, None, key, size, "0" * 64)
+            for i, key in enumerate(keys)]
+
+
+def drain(storage, rows):
+    start = time.perf_counter()
+    total = 0
+    for chunk in export.stream_zip(storage, rows):
+        total += len(chunk)
+    return total, time.perf_counter() - start
+
+
+def disk(total_mb, file_mb):
+    root = tempfile.mkdtemp(prefix="bench-export-")
+    try:
+        storage = LocalDiskStorage(root)
+        count = max(1, total_mb // file_mb)
+        keys = []
+        for i in range(count):
+            key = f"blobs/{i}.pdf"
+            path = os.path.join(root, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.truncate(file_mb * 1024 * 1024)
+            keys.append(key)
+        tracemalloc.start()
+        try:
+            total, seconds = drain(storage, rows_for(keys, file_mb * 1024 * 1024))
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return {
+            "mode": "disk",
+            "files": count,
+            "archive_mb": round(total / 1024 / 1024, 1),
+            "seconds": round(seconds, 2),
+            "mb_per_s": round(total / 1024 / 1024 / seconds, 1),
+            "heap_peak_mb": round(peak / 1024 / 1024, 1),
+        }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def latency(count, blob_kb, latency_ms, depths):
+    storage = MemoryStorage(latency=latency_ms / 1000)
+    keys = []
+    for i in range(count):
+        key = f"blobs/{i}.pdf"
+        storage._set(key, os.urandom(blob_kb * 1024))
+        keys.append(key)
+    results = []
+    for depth in depths:
+        export.EXPORT_PREFETCH = depth
+        _, seconds = drain(storage, rows_for(keys, blob_kb * 1024))
+        results.append({"mode": "latency", "blobs": count, "latency_ms": latency_ms, "prefetch": depth,
+                        "seconds": round(seconds, 2), "blobs_per_s": round(count / seconds, 1)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--total-mb", type=int, default=3072)
+    parser.add_argument("--file-mb", type=int, default=64)
+    parser.add_argument("--blobs", type=int, default=200)
+    parser.add_argument("--latency-ms", type=int, default=20)
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    results = [disk(args.total_mb, args.file_mb)]
+    results += latency(args.blobs, 256, args.latency_ms, args.depths)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
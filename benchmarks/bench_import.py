@@ -0,0 +1,92 @@
+"""Rows/sec of the batched CSV importer against the original per-row loop.
+
+Each size is imported into a fresh database, then imported again so the
+second pass measures the upsert (update) path.
+
+    python -m benchmarks.bench_import --sizes 1000 10000 100000
+"""
+import argparse
+import csv
+import io
+import json
+import random
+import time
+
+import importer
+from benchmarks.common import drop_db, scratch_db
+
+
+def make_csv(rows, rng):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["email", "password"])
+    for i in range(rows):
+        roll = rng.random()
+        if roll < 0.01:
+            writer.writerow([f"student{i}.college.com", "pw"])
+        elif roll < 0.02:
+            writer.writerow([f"student{i}@college.com", ""])
+        else:
+            writer.writerow([f"student{i}@college.com", f"pw{i}"])
+    return out.getvalue().encode("utf-8")
+
+
+def legacy_import(db, data):
+    """The importer as it was: decode everything, one execute per row."""
+    reader = csv.DictReader(io.StringIO(data.decode("utf-8")))
+    cur = db.cursor()
+    added = 0
+    for row in reader:
+        email = row.get('email') or row.get('Email') or row.get('EMAIL')
+        password = row.get('password') or row.get('Password') or row.get('PASSWORD')
+        if not email or not password:
+            continue
+        try:
+            cur.execute("INSERT INTO students (email, password, mentor_email) VALUES (?, ?, ?)", (email.strip(), password.strip(), None))
+            added += 1
+        except Exception:
+            pass
+    db.commit()
+    return added
+
+
+def measure(fn, rows):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    return {"seconds": round(elapsed, 3), "rows_per_sec": int(rows / elapsed)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--batch-size", type=int, default=importer.IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        data = make_csv(size, random.Random(size))
+        run = lambda db: importer.import_csv(db, io.BytesIO(data), "students", args.batch_size)
+        entry = {"rows": size}
+
+        db, path = scratch_db()
+        try:
+            entry["legacy"] = measure(lambda: legacy_import(db, data), size)
+        finally:
+            drop_db(db, path)
+
+        db, path = scratch_db()
+        try:
+            entry["batched_insert"] = measure(lambda: run(db), size)
+            # same file again: every valid row takes the upsert path
+            entry["batched_upsert"] = measure(lambda: run(db), size)
+            report = run(db)
+            entry["report"] = {"inserted": report.inserted, "updated": report.updated, "skipped": report.skipped}
+        finally:
+            drop_db(db, path)
+        results.append(entry)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
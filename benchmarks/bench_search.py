@@ -0,0 +1,76 @@
+"""Latency of FTS5 document search against a LIKE scan of the same corpus.
+
+    python -m benchmarks.bench_search --documents 1000000
+
+Seeding a million documents (including the FTS index, built by the insert
+trigger) takes a minute or two; pass --db to keep the database around and
+reuse it on the next run.
+"""
+import argparse
+import json
+import os
+
+import search
+from benchmarks.common import drop_db, scratch_db, seed, timeit
+
+
+def like_search(db, term, mentor=None):
+    """What a search without the index would have to do."""
+    sql = ("SELECT d.id, d.student_email, d.filename, d.cert_type, d.uploaded_at FROM documents d"
+           " JOIN students s ON s.email = d.student_email"
+           " WHERE (d.filename LIKE ? OR d.cert_type LIKE ? OR d.student_email LIKE ?)")
+    params = [f"%{term}%"] * 3
+    if mentor:
+        sql += " AND s.mentor_email = ?"
+        params.append(mentor)
+    return db.execute(sql + " ORDER BY d.uploaded_at DESC LIMIT 50", params).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=1000000)
+    parser.add_argument("--students", type=int, default=3000)
+    parser.add_argument("--staff", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--db", help="reuse (or create) this database file")
+    args = parser.parse_args()
+
+    existing = args.db and os.path.exists(args.db)
+    db, path = scratch_db(args.db)
+    try:
+        if existing:
+            mentor = db.execute("SELECT mentor_email FROM students ORDER BY id LIMIT 1").fetchone()[0]
+        else:
+            mentor = seed(db, staff=args.staff, students=args.students, documents=args.documents)[0]
+        documents = db.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+        cases = [
+            ("common word", {"q": "scan"}),
+            ("prefix", {"q": "intern"}),
+            ("two words", {"q": "python nptel"}),
+            ("student email", {"q": "student1234"}),
+            ("common word, newest", {"q": "scan", "sort": "newest"}),
+        ]
+        results = []
+        for name, query in cases:
+            for scope in ("mentor", "all"):
+                owner = mentor if scope == "mentor" else None
+                first = search.search_page(db, query, owner)
+                entry = {"case": name, "scope": scope, "first_page": timeit(lambda: search.search_page(db, query, owner), args.repeat)}
+                if first.next_cursor:
+                    deeper = dict(query, cursor=first.next_cursor)
+                    entry["second_page"] = timeit(lambda: search.search_page(db, deeper, owner), args.repeat)
+                if "sort" not in query:
+                    term = query["q"].split()[0]
+                    entry["like_scan"] = timeit(lambda: like_search(db, term, owner), min(args.repeat, 3))
+                results.append(entry)
+        print(json.dumps({"documents": documents, "students": args.students, "results": results}, indent=2))
+    finally:
+        if args.db:
+            db.close()
+        else:
+            drop_db(db, path)
+
+
+if __name__ == "__main__":
+    main()
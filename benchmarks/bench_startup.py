@@ -0,0 +1,139 @@
+"""Cold-start cost of a worker, checked against a time budget.
+
+Every sample runs in a fresh interpreter, like a new gunicorn worker on a
+scaled-out instance:
+
+* ``import``       -- ``import app`` (module imports plus create_app())
+* ``first_request``-- the first GET /login in that process, which opens the
+  first pooled connection and checks the schema
+* ``ready``        -- launching ``gunicorn app:app`` with one worker until it
+  answers GET /login (needs gunicorn)
+
+The biggest imports are listed from ``python -X importtime``. Exits non-zero
+when a median is over its budget.
+
+    python -m benchmarks.bench_startup --repeat 10 --import-budget-ms 250
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from benchmarks.common import drop_db, scratch_db
+from benchmarks.loadtest import ROOT, _free_port
+
+PROBE = """
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+status = app.app.test_client().get("/login").status_code
+done = time.perf_counter()
+assert status == 200, status
+print((imported - start) * 1000, (done - imported) * 1000)
+"""
+
+
+def _env(db_path):
+    return dict(os.environ, AUTH_DB_PATH=db_path, STORAGE_BACKEND="memory", BACKGROUND_JOBS="0", PYTHONPATH=ROOT)
+
+
+def probe(db_path):
+    out = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, env=_env(db_path),
+                         capture_output=True, text=True, check=True).stdout
+    import_ms, first_ms = map(float, out.split())
+    return import_ms, first_ms
+
+
+def ready(db_path):
+    port = _free_port()
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "--workers", "1", "--bind", f"127.0.0.1:{port}",
+                             "--log-level", "warning", "app:app"], cwd=ROOT, env=_env(db_path))
+    try:
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise SystemExit(f"gunicorn exited with status {proc.returncode}")
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=5) as conn:
+                    conn.sendall(b"GET /login HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n")
+                    if conn.recv(64).startswith(b"HTTP/1.1 200"):
+                        return (time.perf_counter() - start) * 1000
+            except OSError:
+                pass
+            time.sleep(0.005)
+        raise SystemExit("gunicorn did not answer within 30s")
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+def heaviest_imports(db_path, limit):
+    """Modules imported directly by app.py, by cumulative time."""
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=ROOT, env=_env(db_path),
+                         capture_output=True, text=True, check=True).stderr
+    # a module's imports are listed before it, one indent level deeper
+    children, rows = [], []
+    for line in err.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children.append((name.strip(), round(int(cumulative) / 1000, 1)))
+        elif depth == 0:
+            if name.strip() == "app":
+                rows = children
+            children = []
+    return sorted(rows, key=lambda row: -row[1])[:limit]
+
+
+def median(samples):
+    samples = sorted(samples)
+    return round(samples[len(samples) // 2], 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--import-budget-ms", type=float, default=250.0)
+    parser.add_argument("--first-request-budget-ms", type=float, default=100.0)
+    parser.add_argument("--ready-budget-ms", type=float, default=1500.0)
+    parser.add_argument("--skip-gunicorn", action="store_true")
+    parser.add_argument("--top", type=int, default=10, help="how many of the heaviest imports to list")
+    args = parser.parse_args()
+
+    db, path = scratch_db()
+    db.close()
+    try:
+        probes = [probe(path) for _ in range(args.repeat)]
+        results = {
+            "import": {"median_ms": median([p[0] for p in probes]), "max_ms": round(max(p[0] for p in probes), 1),
+                       "budget_ms": args.import_budget_ms},
+            "first_request": {"median_ms": median([p[1] for p in probes]),
+                              "max_ms": round(max(p[1] for p in probes), 1),
+                              "budget_ms": args.first_request_budget_ms},
+        }
+        if not args.skip_gunicorn:
+            samples = [ready(path) for _ in range(args.repeat)]
+            results["ready"] = {"median_ms": median(samples), "max_ms": round(max(samples), 1),
+                                "budget_ms": args.ready_budget_ms}
+        results["heaviest_imports_ms"] = heaviest_imports(path, args.top)
+    finally:
+        import sqlite3
+        drop_db(sqlite3.connect(path), path)
+
+    print(json.dumps(results, indent=2))
+    over = [name for name, r in results.items() if isinstance(r, dict) and r["median_ms"] > r["budget_ms"]]
+    if over:
+        raise SystemExit(f"over budget: {', '.join(over)}")
+
+
+if __name__ == "__main__":
+    main()
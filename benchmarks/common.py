@@ -0,0 +1,88 @@
+"""Shared helpers for the benchmark scripts.
+
+Run the scripts from the repository root as modules, e.g.
+``python -m benchmarks.bench_analytics``.
+"""
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import stats
+from migrations import run_migrations
+
+CERT_TYPES = [
+    ("Bonafide", 30), ("Internship", 20), ("Marksheet", 18), ("Course Completion", 12),
+    ("Hackathon", 8), ("Sports", 5), ("NPTEL", 4), ("Workshop", 3),
+]
+FILENAME_WORDS = ["bonafide", "internship", "marksheet", "sem", "final", "scan", "offer", "letter",
+                  "nptel", "course", "python", "azure", "hackathon", "winner", "sports", "workshop"]
+
+
+def scratch_db(path=None):
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix=".db", prefix="bench-")
+        os.close(fd)
+        os.unlink(path)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=OFF")
+    run_migrations(db)
+    return db, path
+
+
+def drop_db(db, path):
+    db.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.unlink(path + suffix)
+
+
+def seed(db, staff=10, students=300, documents=10000, mentor_share=None, rng=None):
+    """Insert synthetic staff/students/documents and return the mentor emails.
+
+    ``mentor_share`` maps every student to the first mentor when set to 1.0,
+    which is the worst case for the per-mentor staff pages.
+    """
+    rng = rng or random.Random(42)
+    mentors = [f"staff{i}@college.com" for i in range(staff)]
+    db.executemany("INSERT INTO staff (email, password) VALUES (?, ?)", [(m, "pw") for m in mentors])
+
+    student_rows = []
+    for i in range(students):
+        if mentor_share is not None and rng.random() < mentor_share:
+            mentor = mentors[0]
+        else:
+            mentor = rng.choice(mentors)
+        student_rows.append((f"student{i}@college.com", "pw", mentor))
+    db.executemany("INSERT INTO students (email, password, mentor_email) VALUES (?, ?, ?)", student_rows)
+
+    types = [t for t, _ in CERT_TYPES]
+    weights = [w for _, w in CERT_TYPES]
+
+    def docs():
+        for i in range(documents):
+            email = student_rows[rng.randrange(students)][0]
+            words = rng.sample(FILENAME_WORDS, 3)
+            filename = "_".join(words) + (".pdf" if i % 3 else ".jpg")
+            uploaded_at = f"2025-{1 + i % 12:02d}-{1 + i % 28:02d} {i % 24:02d}:{i % 60:02d}:{(i * 7) % 60:02d}"
+            yield (email, filename, rng.choices(types, weights)[0], uploaded_at)
+
+    db.executemany(
+        "INSERT INTO documents (student_email, filename, cert_type, uploaded_at) VALUES (?, ?, ?, ?)",
+        docs(),
+    )
+    db.commit()
+    stats.rebuild(db)
+    return mentors
+
+
+def timeit(fn, repeat=5):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {"min_ms": round(samples[0], 3), "median_ms": round(samples[len(samples) // 2], 3)}
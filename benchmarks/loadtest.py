@@ -0,0 +1,433 @@
+"""Load test of the real routes on a seeded scratch database, with the
+in-memory blob stand-in instead of Azure.
+
+    python -m benchmarks.loadtest --mode client --requests 3000
+    python -m benchmarks.loadtest --mode http --workers 4 --clients 16 --duration 30
+    python -m benchmarks.loadtest --compare old.json new.json
+
+``client`` drives the app in this process through the Flask test client and
+measures the application alone. ``http`` serves the same data with gunicorn
+and runs --clients load-generator processes against it, each a closed loop of
+requests, so the server and the network stack are included. Both report
+per-scenario p50/p95/p99 latency and throughput and write them as JSON
+(default benchmarks/results/<mode>-<commit>.json). --compare prints the change
+between two result files and exits non-zero when a scenario regressed by more
+than --threshold percent.
+"""
+import argparse
+import http.client
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+import uuid
+
+from benchmarks.common import drop_db, scratch_db, seed
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+ADMIN = ("admin@college.com", "admin123")
+PASSWORD = "pw"
+
+# name: (weight, role, expected status)
+SCENARIOS = {
+    "login": (8, None, 302),
+    "dashboard": (20, "student", 200),
+    "staff_manage_documents": (20, "staff", 200),
+    "documents": (20, "staff", 200),
+    "documents_download": (20, "staff", 200),
+    "upload": (10, "student", 200),
+    "import_students": (2, "admin", 200),
+}
+
+
+class Client:
+    """Identity and request builders of one simulated user."""
+
+    def __init__(self, index, args, download_ids):
+        self.index = index
+        self.rng = random.Random(args.seed + index)
+        self.staff = f"staff{index % args.staff}@college.com"
+        self.student = f"student{index % args.students}@college.com"
+        self.download_ids = download_ids
+        self.upload_bytes = args.upload_kb * 1024
+        self.import_rows = args.import_rows
+        self.sent = 0
+
+    def credentials(self, role):
+        if role == "admin":
+            return ADMIN
+        return (self.staff if role == "staff" else self.student), PASSWORD
+
+    def pick(self, names, weights):
+        return self.rng.choices(names, weights)[0]
+
+    def build(self, name):
+        """(method, path, body, headers) for one request of scenario ``name``."""
+        self.sent += 1
+        if name == "login":
+            email, password = self.credentials("staff")
+            return _form("/login", {"role": "staff", "email": email, "password": password})
+        if name == "dashboard":
+            return "GET", "/dashboard", None, {}
+        if name == "staff_manage_documents":
+            return "GET", "/staff/manage_documents", None, {}
+        if name == "documents":
+            return "GET", "/documents", None, {}
+        if name == "documents_download":
+            return "GET", f"/documents/download/{self.rng.choice(self.download_ids)}", None, {}
+        if name == "upload":
+            # unique bytes, so every upload is a real transfer and not a dedup hit
+            data = self.rng.randbytes(self.upload_bytes)
+            return _multipart("/upload", {"cert_type": "Internship"}, ("file", f"load_{self.sent}.pdf", data))
+        if name == "import_students":
+            tag = f"{self.index}-{self.sent}-{uuid.uuid4().hex[:6]}"
+            rows = "".join(f"load{tag}-{i}@college.com,{PASSWORD}\n" for i in range(self.import_rows))
+            return _multipart("/admin/students/import?format=json", {}, ("file", "students.csv", ("email,password\n" + rows).encode()))
+        raise ValueError(name)
+
+
+def _form(path, fields):
+    from urllib.parse import urlencode
+    return "POST", path, urlencode(fields).encode(), {"Content-Type": "application/x-www-form-urlencoded"}
+
+
+def _multipart(path, fields, file):
+    boundary = uuid.uuid4().hex
+    out = io.BytesIO()
+    for key, value in fields.items():
+        out.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode())
+    field, filename, data = file
+    out.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+              f"Content-Type: application/octet-stream\r\n\r\n".encode())
+    out.write(data)
+    out.write(f"\r\n--{boundary}--\r\n".encode())
+    return "POST", path, out.getvalue(), {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+def _mix(only):
+    names = [n for n in SCENARIOS if not only or n in only]
+    return names, [SCENARIOS[n][0] for n in names]
+
+
+# -- data ---------------------------------------------------------------------
+
+def download_targets(db_path, count):
+    db = sqlite3.connect(db_path)
+    try:
+        return db.execute("SELECT id, COALESCE(blob_key, filename) FROM documents ORDER BY id LIMIT ?", (count,)).fetchall()
+    finally:
+        db.close()
+
+
+def blob_sizes(count, rng):
+    # scanned certificates: mostly 50-400 KB, a tail of multi-megabyte PDFs
+    return [min(int(rng.lognormvariate(math.log(150_000), 0.8)), 4 * 1024 * 1024) for _ in range(count)]
+
+
+def install_storage(db_path, blobs, latency_ms):
+    """Use a MemoryStorage holding a blob for each of the first ``blobs``
+    documents, so downloads have something to serve."""
+    import storage
+    backend = storage.MemoryStorage(latency=latency_ms / 1000)
+    targets = download_targets(db_path, blobs)
+    rng = random.Random(7)
+    for (doc_id, key), size in zip(targets, blob_sizes(len(targets), rng)):
+        backend.put(key, io.BytesIO(rng.randbytes(size)), size=size, content_type="application/pdf")
+    storage.set_storage(backend)
+    return [doc_id for doc_id, _ in targets]
+
+
+def serve():
+    """gunicorn entry point for --mode http (``benchmarks.loadtest:serve()``);
+    run with --preload so every worker inherits the seeded blobs."""
+    from app import app
+    install_storage(os.environ["AUTH_DB_PATH"], int(os.environ["LOADTEST_BLOBS"]),
+                    float(os.getenv("LOADTEST_STORAGE_LATENCY_MS", "0")))
+    return app
+
+
+# -- results ------------------------------------------------------------------
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_samples)))
+    return round(sorted_samples[rank - 1], 3)
+
+
+def summarize(samples, elapsed):
+    """``samples`` is a list of (scenario, ms, ok)."""
+    by_name = {}
+    for name, ms, ok in samples:
+        by_name.setdefault(name, []).append((ms, ok))
+    scenarios = {}
+    for name, entries in sorted(by_name.items()):
+        latencies = sorted(ms for ms, _ in entries)
+        scenarios[name] = {
+            "requests": len(entries),
+            "errors": sum(1 for _, ok in entries if not ok),
+            "rps": round(len(entries) / elapsed, 2),
+            "mean_ms": round(sum(latencies) / len(latencies), 3),
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": round(latencies[-1], 3),
+        }
+    latencies = sorted(ms for _, ms, _ in samples)
+    total = {
+        "requests": len(samples),
+        "errors": sum(1 for _, _, ok in samples if not ok),
+        "seconds": round(elapsed, 3),
+        "rps": round(len(samples) / elapsed, 2) if elapsed else 0,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+    }
+    return scenarios, total
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(old_path, new_path, threshold):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['commit']} -> {new['commit']} ({new['mode']})")
+    print(f"{'scenario':<24}{'p50':>10}{'p95':>10}{'p99':>10}{'rps':>10}")
+    regressions = []
+    for name in sorted(set(old["scenarios"]) & set(new["scenarios"])):
+        a, b = old["scenarios"][name], new["scenarios"][name]
+        change = {k: (b[k] - a[k]) / a[k] * 100 if a[k] else 0.0 for k in ("p50_ms", "p95_ms", "p99_ms", "rps")}
+        print(f"{name:<24}" + "".join(f"{change[k]:>+9.1f}%" for k in ("p50_ms", "p95_ms", "p99_ms", "rps")))
+        if change["p95_ms"] > threshold or change["rps"] < -threshold:
+            regressions.append(name)
+    if regressions:
+        print(f"regressed by more than {threshold}%: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+# -- in-process ---------------------------------------------------------------
+
+def run_client_mode(args, download_ids):
+    from app import app
+    client = Client(0, args, download_ids)
+    sessions = {}
+    for role in ("staff", "student", "admin"):
+        sessions[role] = app.test_client()
+        email, password = client.credentials(role)
+        r = sessions[role].post("/login", data={"role": role, "email": email, "password": password})
+        if r.status_code != 302:
+            raise SystemExit(f"could not log in as {role} {email}")
+    anonymous = app.test_client()
+    names, weights = _mix(args.only)
+
+    def request(name):
+        method, path, body, headers = client.build(name)
+        role = SCENARIOS[name][1]
+        c = sessions[role] if role else anonymous
+        response = c.open(path, method=method, data=body, headers=headers)
+        response.get_data()  # drain streamed bodies
+        response.close()
+        return response.status_code
+
+    for _ in range(args.warmup_requests):
+        request(client.pick(names, weights))
+    samples = []
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        name = client.pick(names, weights)
+        t0 = time.perf_counter()
+        status = request(name)
+        samples.append((name, (time.perf_counter() - t0) * 1000, status == SCENARIOS[name][2]))
+    return samples, time.perf_counter() - start
+
+
+# -- over HTTP ----------------------------------------------------------------
+
+def _http_call(conn, method, path, body, headers):
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    response.read()
+    cookie = None
+    for key, value in response.getheaders():
+        if key.lower() == "set-cookie" and value.startswith("session="):
+            cookie = value.split(";", 1)[0]
+    return response.status, cookie
+
+
+def _http_client(spec):
+    index, port, args, download_ids = spec
+    client = Client(index, args, download_ids)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    cookies = {}
+    for role in ("staff", "student", "admin"):
+        email, password = client.credentials(role)
+        _, path, body, headers = _form("/login", {"role": role, "email": email, "password": password})
+        status, cookies[role] = _http_call(conn, "POST", path, body, headers)
+        if status != 302 or not cookies[role]:
+            raise RuntimeError(f"could not log in as {role} {email}")
+    names, weights = _mix(args.only)
+    samples = []
+    start = time.monotonic()
+    measure_from = start + args.warmup
+    stop = measure_from + args.duration
+    while True:
+        now = time.monotonic()
+        if now >= stop:
+            break
+        name = client.pick(names, weights)
+        method, path, body, headers = client.build(name)
+        role = SCENARIOS[name][1]
+        if role:
+            headers = dict(headers, Cookie=cookies[role])
+        t0 = time.perf_counter()
+        try:
+            status, cookie = _http_call(conn, method, path, body, headers)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            status, cookie = None, None
+        elapsed = (time.perf_counter() - t0) * 1000
+        if role and cookie:
+            cookies[role] = cookie
+        if now >= measure_from:
+            samples.append((name, elapsed, status == SCENARIOS[name][2]))
+    conn.close()
+    return samples
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(args, db_path, port):
+    env = dict(os.environ, AUTH_DB_PATH=db_path, STORAGE_BACKEND="memory", BACKGROUND_JOBS="0", ADMISSION_ENABLED="0",
+               LOADTEST_BLOBS=str(args.blobs), LOADTEST_STORAGE_LATENCY_MS=str(args.storage_latency_ms),
+               PYTHONPATH=ROOT)
+    cmd = [sys.executable, "-m", "gunicorn", "--preload", "--workers", str(args.workers),
+           "--bind", f"127.0.0.1:{port}", "--log-level", "warning", "--timeout", "120"]
+    if args.threads > 1:
+        cmd += ["--threads", str(args.threads)]
+    proc = subprocess.Popen(cmd + ["benchmarks.loadtest:serve()"], cwd=ROOT, env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"gunicorn exited with status {proc.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("gunicorn did not start within 60s")
+
+
+def run_http_mode(args, db_path, download_ids):
+    port = _free_port()
+    server = start_gunicorn(args, db_path, port)
+    try:
+        specs = [(i, port, args, download_ids) for i in range(args.clients)]
+        with multiprocessing.get_context("spawn").Pool(args.clients) as pool:
+            results = pool.map(_http_client, specs)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return [s for samples in results for s in samples], args.duration
+
+
+# -- main ---------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("client", "http"), default="client")
+    parser.add_argument("--staff", type=int, default=30)
+    parser.add_argument("--students", type=int, default=3000)
+    parser.add_argument("--documents", type=int, default=50000)
+    parser.add_argument("--db", help="reuse (or create) this database file")
+    parser.add_argument("--blobs", type=int, default=100, help="documents that get a blob to download")
+    parser.add_argument("--storage-latency-ms", type=float, default=0.0, help="simulated per-call storage latency")
+    parser.add_argument("--upload-kb", type=int, default=64)
+    parser.add_argument("--import-rows", type=int, default=100)
+    parser.add_argument("--only", nargs="+", choices=sorted(SCENARIOS), help="run only these scenarios")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=2000, help="client mode: measured requests")
+    parser.add_argument("--warmup-requests", type=int, default=100, help="client mode: unmeasured requests first")
+    parser.add_argument("--workers", type=int, default=4, help="http mode: gunicorn workers")
+    parser.add_argument("--threads", type=int, default=1, help="http mode: threads per gunicorn worker")
+    parser.add_argument("--clients", type=int, default=8, help="http mode: load-generator processes")
+    parser.add_argument("--duration", type=float, default=20.0, help="http mode: measured seconds")
+    parser.add_argument("--warmup", type=float, default=3.0, help="http mode: unmeasured seconds first")
+    parser.add_argument("--out", help="result file (default benchmarks/results/<mode>-<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=10.0, help="--compare: allowed regression in percent")
+    args = parser.parse_args()
+
+    if args.compare:
+        raise SystemExit(compare(*args.compare, args.threshold))
+
+    existing = args.db and os.path.exists(args.db)
+    db, path = scratch_db(args.db)
+    if not existing:
+        seed(db, staff=args.staff, students=args.students, documents=args.documents)
+        db.execute("INSERT INTO admins (email, password) VALUES (?, ?)", ADMIN)
+        db.commit()
+    documents = db.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+    db.close()
+
+    try:
+        if args.mode == "client":
+            # configure the app before its first import
+            os.environ.update(AUTH_DB_PATH=path, STORAGE_BACKEND="memory", BACKGROUND_JOBS="0", ADMISSION_ENABLED="0")
+            download_ids = install_storage(path, args.blobs, args.storage_latency_ms)
+            samples, elapsed = run_client_mode(args, download_ids)
+        else:
+            download_ids = [doc_id for doc_id, _ in download_targets(path, args.blobs)]
+            samples, elapsed = run_http_mode(args, path, download_ids)
+    finally:
+        if not args.db:
+            drop_db(sqlite3.connect(path), path)
+
+    scenarios, total = summarize(samples, elapsed)
+    commit = git_commit()
+    result = {
+        "commit": commit,
+        "mode": args.mode,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "dataset": {"staff": args.staff, "students": args.students, "documents": documents, "blobs": args.blobs},
+        "config": {k: v for k, v in vars(args).items() if k not in ("compare", "threshold", "out", "db")},
+        "scenarios": scenarios,
+        "total": total,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, f"{args.mode}-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps({"scenarios": scenarios, "total": total}, indent=2))
+    print(f"results written to {out}")
+
+
+if __name__ == "__main__":
+    main()
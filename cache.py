@@ -0,0 +1,218 @@
+"""Read-through cache for small, hot lookups (user lists, profiles).
+
+Values live in a per-process LRU with a TTL and, when CACHE_SHARED_PATH is
+set, in a SQLite file shared by every gunicorn worker on the host. Writers
+call invalidate() in the same transaction as their change: it bumps the
+namespace's generation in ``cache_generations``, and cache keys include the
+generation, so superseded entries are never read again and simply age out.
+Workers re-read the generations at most every CACHE_SYNC_INTERVAL seconds,
+which bounds how long another worker can serve a stale value.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", "1.0"))
+CACHE_SHARED_PATH = os.getenv("CACHE_SHARED_PATH")
+
+MISSING = object()
+
+
+def _tuples(value):
+    # JSON turns rows into lists; give shared-tier hits the same shape as a
+    # fresh load
+    if isinstance(value, list):
+        return tuple(_tuples(v) for v in value)
+    return value
+
+
+class LRUCache:
+    """Thread-safe LRU with a per-entry TTL."""
+
+    def __init__(self, maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] < time.monotonic():
+                del self._data[key]
+                self._stats["expirations"] += 1
+                item = None
+            if item is None:
+                self._stats["misses"] += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._data)
+        stats["maxsize"] = self.maxsize
+        return stats
+
+
+class SharedCache:
+    """JSON values in a SQLite file visible to all workers on the host.
+
+    Errors are logged and reported as misses; the cache never fails a request.
+    """
+
+    PURGE_EVERY = 256
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+        self._sets = 0
+        self._stats = {"hits": 0, "misses": 0, "errors": 0}
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            # never share a connection opened by the gunicorn master
+            self._pid = os.getpid()
+            self._conn = sqlite3.connect(self.path, timeout=1.0, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=OFF")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+            )
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            try:
+                row = self._connection().execute(
+                    "SELECT value FROM cache_entries WHERE key = ? AND expires_at > ?", (key, time.time())
+                ).fetchone()
+            except sqlite3.Error as e:
+                self._stats["errors"] += 1
+                logging.warning(f"Shared cache read failed: {e}")
+                row = None
+            self._stats["hits" if row else "misses"] += 1
+        return _tuples(json.loads(row[0])) if row else MISSING
+
+    def set(self, key, value, ttl):
+        payload = json.dumps(value)
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, payload, time.time() + ttl),
+                )
+                self._sets += 1
+                if self._sets % self.PURGE_EVERY == 0:
+                    conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),))
+            except sqlite3.Error as e:
+                self._stats["errors"] += 1
+                logging.warning(f"Shared cache write failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class ReadThroughCache:
+    def __init__(self, maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL, shared_path=CACHE_SHARED_PATH,
+                 sync_interval=CACHE_SYNC_INTERVAL):
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        self.local = LRUCache(maxsize, ttl)
+        self.shared = SharedCache(shared_path) if shared_path else None
+        self._generations = {}
+        self._synced_at = float("-inf")
+        self._lock = threading.Lock()
+        self._stats = {"loads": 0, "invalidations": 0, "syncs": 0}
+
+    def _generation(self, db, namespace):
+        now = time.monotonic()
+        if now - self._synced_at >= self.sync_interval:
+            generations = dict(db.execute("SELECT namespace, generation FROM cache_generations").fetchall())
+            with self._lock:
+                self._generations = generations
+                self._synced_at = now
+                self._stats["syncs"] += 1
+        return self._generations.get(namespace, 0)
+
+    def get_or_load(self, db, namespace, key, loader, ttl=None):
+        """Return the cached value for (namespace, key), calling ``loader()``
+        on a miss. Values must be JSON-serialisable when the shared tier is
+        enabled."""
+        full_key = f"{namespace}:{self._generation(db, namespace)}:{key}"
+        value = self.local.get(full_key)
+        if value is not MISSING:
+            return value
+        if self.shared:
+            value = self.shared.get(full_key)
+            if value is not MISSING:
+                self.local.set(full_key, value, ttl)
+                return value
+        value = loader()
+        with self._lock:
+            self._stats["loads"] += 1
+        self.local.set(full_key, value, ttl)
+        if self.shared:
+            self.shared.set(full_key, value, self.ttl if ttl is None else ttl)
+        return value
+
+    def invalidate(self, db, *namespaces):
+        """Retire every cached value in ``namespaces``; the caller commits."""
+        db.executemany(
+            "INSERT INTO cache_generations (namespace, generation) VALUES (?, 1)"
+            " ON CONFLICT (namespace) DO UPDATE SET generation = generation + 1",
+            [(n,) for n in namespaces],
+        )
+        with self._lock:
+            # re-read on the next lookup instead of waiting for the interval
+            self._synced_at = float("-inf")
+            self._stats["invalidations"] += len(namespaces)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["local"] = self.local.stats()
+        if self.shared:
+            stats["shared"] = self.shared.stats()
+        return stats
+
+
+store = ReadThroughCache()
+
+
+def cached(db, namespace, key, loader, ttl=None):
+    return store.get_or_load(db, namespace, key, loader, ttl)
+
+
+def invalidate(db, *namespaces):
+    store.invalidate(db, *namespaces)
+
+
+def stats():
+    return store.stats()
@@ -0,0 +1,144 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import g
+
+import metrics
+
+DB_PATH = os.getenv("AUTH_DB_PATH", "auth.db")
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+# sqlite3 keeps this many compiled statements per connection; because pooled
+# connections live for the whole worker, hot queries are prepared only once.
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    pass
+
+
+class ConnectionPool:
+    """Bounded per-worker pool of SQLite connections.
+
+    At most ``size`` connections are checked out at once; callers beyond that
+    wait up to ``timeout`` seconds and then get a PoolTimeout.
+    """
+
+    def __init__(self, path=DB_PATH, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # called on first use and again in a forked child, so a gunicorn worker
+        # never reuses connections opened by the master process
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._stats = {
+            "created": 0,
+            "checkouts": 0,
+            "in_use": 0,
+            "timeouts": 0,
+            "wait_total_ms": 0.0,
+            "wait_max_ms": 0.0,
+        }
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT_MS / 1000.0,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            factory=metrics.TimedConnection if metrics.METRICS_ENABLED else sqlite3.Connection,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-8000")
+        with self._lock:
+            self._stats["created"] += 1
+        return conn
+
+    def acquire(self):
+        if os.getpid() != self._pid:
+            with self._lock:
+                if os.getpid() != self._pid:
+                    self._reset()
+
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise PoolTimeout(f"no database connection available after {self.timeout}s")
+        waited_ms = (time.perf_counter() - start) * 1000
+
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._slots.release()
+                raise
+
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["in_use"] += 1
+            self._stats["wait_total_ms"] += waited_ms
+            self._stats["wait_max_ms"] = max(self._stats["wait_max_ms"], waited_ms)
+        return conn
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+        except sqlite3.Error:
+            # broken connection: drop it, a fresh one is opened on next checkout
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        finally:
+            with self._lock:
+                self._stats["in_use"] -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["size"] = self.size
+        stats["idle"] = self._idle.qsize()
+        checkouts = stats["checkouts"]
+        stats["wait_avg_ms"] = round(stats["wait_total_ms"] / checkouts, 3) if checkouts else 0.0
+        stats["wait_total_ms"] = round(stats["wait_total_ms"], 3)
+        stats["wait_max_ms"] = round(stats["wait_max_ms"], 3)
+        return stats
+
+
+pool = ConnectionPool()
+
+
+def get_db():
+    # one pooled connection per request/app context, returned in close_db()
+    if "db" not in g:
+        g.db = pool.acquire()
+    return g.db
+
+
+def close_db(exc=None):
+    conn = g.pop("db", None)
+    if conn is not None:
+        pool.release(conn)
+
+
+def init_app(app):
+    app.teardown_appcontext(close_db)
@@ -0,0 +1,104 @@
+"""Content-addressed blob storage with reference counting.
+
+Uploads are stored under ``sha256/<aa>/<bb>/<digest>``, so identical
+certificates share one blob. The ``blobs`` table counts how many documents
+point at each digest; a blob whose count drops to zero is only removed by
+collect_garbage() after a grace period, which keeps a concurrent re-upload of
+the same content from racing the delete.
+"""
+import hashlib
+import logging
+
+import previews
+from storage import StorageNotFound
+
+HASH_CHUNK_SIZE = 1024 * 1024
+GC_GRACE_SECONDS = 3600
+
+
+def content_key(digest):
+    return f"sha256/{digest[:2]}/{digest[2:4]}/{digest}"
+
+
+def hash_stream(stream):
+    """Return (hex sha256, size) of a seekable stream and rewind it."""
+    start = stream.tell()
+    h = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        h.update(chunk)
+        size += len(chunk)
+    stream.seek(start)
+    return h.hexdigest(), size
+
+
+def is_stored(db, digest):
+    """True when a live blob with this digest has been written, so the
+    transfer can be skipped. A blob still waiting on its store_blob job does
+    not count: if that job fails for good, the bytes never arrive."""
+    row = db.execute("SELECT refcount, stored FROM blobs WHERE content_hash = ?", (digest,)).fetchone()
+    return bool(row and row[0] > 0 and row[1])
+
+
+def add_ref(db, digest, blob_key, size, stored=True):
+    """Count one more document pointing at ``digest``; ``stored`` is False
+    while the bytes are only queued for upload."""
+    db.execute(
+        "INSERT INTO blobs (content_hash, blob_key, size, refcount, stored) VALUES (?, ?, ?, 1, ?)"
+        " ON CONFLICT (content_hash) DO UPDATE SET refcount = refcount + 1, released_at = NULL,"
+        " stored = MAX(stored, excluded.stored)",
+        (digest, blob_key, size, int(stored)),
+    )
+
+
+def mark_stored(db, digest, stored=True):
+    db.execute("UPDATE blobs SET stored = ? WHERE content_hash = ?", (int(stored), digest))
+
+
+def release_ref(db, digest):
+    """Drop one reference; the blob becomes collectable at zero."""
+    if not digest:
+        return
+    db.execute(
+        "UPDATE blobs SET refcount = MAX(refcount - 1, 0),"
+        " released_at = CASE WHEN refcount <= 1 THEN CURRENT_TIMESTAMP ELSE released_at END"
+        " WHERE content_hash = ?",
+        (digest,),
+    )
+
+
+def collect_garbage(db, storage, grace_seconds=GC_GRACE_SECONDS, limit=500):
+    """Delete unreferenced blobs released more than ``grace_seconds`` ago.
+
+    Each blob is removed while holding the database write lock, so an upload
+    that wants to reuse it either sees the row and keeps it alive first or
+    finds it gone and uploads again.
+    """
+    candidates = db.execute(
+        "SELECT content_hash FROM blobs WHERE refcount = 0"
+        " AND released_at <= datetime('now', ?) LIMIT ?",
+        (f"-{int(grace_seconds)} seconds", limit),
+    ).fetchall()
+    removed = 0
+    if db.in_transaction:
+        db.commit()
+    for (digest,) in candidates:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT blob_key, refcount FROM blobs WHERE content_hash = ?", (digest,)).fetchone()
+            if row and row[1] == 0:
+                for key in [row[0]] + previews.artifact_keys(digest):
+                    try:
+                        storage.delete(key)
+                    except StorageNotFound:
+                        pass
+                db.execute("DELETE FROM blobs WHERE content_hash = ?", (digest,))
+                removed += 1
+            db.commit()
+        except Exception:
+            db.rollback()
+            logging.exception(f"Failed to collect blob {digest}")
+    return removed
@@ -0,0 +1,50 @@
+"""Direct-to-storage uploads.
+
+The browser asks for a short-lived write URL, PUTs the file straight to
+storage and then calls finalize. Between the two calls the pending upload is
+described by a signed token rather than a database row, so abandoned
+uploads leave nothing behind but the blob.
+"""
+import os
+import uuid
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+from storage import PRESIGN_TTL
+
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(50 * 1024 * 1024)))
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt="direct-upload")
+
+
+def new_blob_key(filename):
+    name = secure_filename(filename or "") or "upload"
+    return f"documents/{uuid.uuid4().hex}/{name}"
+
+
+def issue_token(email, blob_key, filename, cert_type, size=None):
+    return _serializer().dumps({
+        "email": email,
+        "key": blob_key,
+        "filename": filename,
+        "cert_type": cert_type,
+        "size": size,
+    })
+
+
+def read_token(token, email):
+    """Return the pending upload for ``token`` if it was issued to ``email``
+    and has not expired, else None."""
+    if not isinstance(token, str):
+        return None
+    try:
+        data = _serializer().loads(token or "", max_age=PRESIGN_TTL * 2)
+    except BadSignature:
+        return None
+    if data.get("email") != email:
+        return None
+    return data
@@ -0,0 +1,85 @@
+"""Streamed, range-aware responses for blob downloads.
+
+Bodies are yielded chunk by chunk from the storage backend, so a worker holds
+at most one chunk (BLOB_DOWNLOAD_CHUNK_SIZE) per request no matter how large
+the certificate is. Backends with a local file hand it to ``send_file`` so the
+WSGI server can use sendfile(2).
+"""
+from flask import Response, request, send_file
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import http_date, is_resource_modified, quote_etag
+
+import metrics
+
+
+def _requested_range(req, size, etag, last_modified):
+    """Return (start, stop) for a satisfiable single Range, None for the full
+    body, or False when the range cannot be satisfied."""
+    rng = req.range
+    if rng is None or rng.units != "bytes" or len(rng.ranges) != 1:
+        return None
+    if_range = req.if_range
+    if if_range.etag and if_range.etag != etag:
+        return None
+    if if_range.date and last_modified and last_modified.replace(microsecond=0) > if_range.date:
+        return None
+    bounds = rng.range_for_length(size)
+    return bounds if bounds else False
+
+
+def plan(req, info, filename, disposition="attachment"):
+    """Status, headers and the (start, length) byte span to send for a
+    request ``req`` (a werkzeug Request) for the blob described by ``info``.
+    The span is None when there is no body (304 and 416)."""
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": quote_etag(info.etag),
+        "Content-Disposition": f'{disposition}; filename="{filename}"',
+        "Content-Type": info.content_type or "application/octet-stream",
+    }
+    if info.last_modified:
+        headers["Last-Modified"] = http_date(info.last_modified)
+
+    if not is_resource_modified(req.environ, etag=info.etag, last_modified=info.last_modified):
+        return 304, headers, None
+
+    start, stop, status = 0, info.size, 200
+    bounds = _requested_range(req, info.size, info.etag, info.last_modified)
+    if bounds is False:
+        headers["Content-Range"] = f"bytes */{info.size}"
+        return 416, headers, None
+    if bounds:
+        start, stop = bounds
+        status = 206
+        headers["Content-Range"] = ContentRange("bytes", start, stop, info.size).to_header()
+    headers["Content-Length"] = str(stop - start)
+    return status, headers, (start, stop - start)
+
+
+def blob_response(storage, key, filename, disposition="attachment"):
+    """Build a streaming Response for ``key`` honouring Range, If-Range,
+    If-None-Match and If-Modified-Since."""
+    info = storage.head(key)
+    mimetype = info.content_type or "application/octet-stream"
+
+    path = storage.local_path(key)
+    if path:
+        # werkzeug handles conditionals and ranges; the WSGI file wrapper lets
+        # gunicorn serve the body with os.sendfile
+        response = send_file(path, mimetype=mimetype, as_attachment=disposition == "attachment",
+                             download_name=filename, etag=info.etag, last_modified=info.last_modified)
+        if response.status_code in (200, 206):
+            metrics.record_sendfile(storage.name, response.content_length or 0)
+        return response
+
+    status, headers, span = plan(request, info, filename, disposition)
+    if span is None:
+        return Response(status=status, headers=headers)
+    start, length = span
+    if length == 0:
+        return Response(b"", status=status, headers=headers)
+
+    # pinned to the etag we just advertised so a concurrent overwrite cannot
+    # splice two versions into one response
+    chunks = storage.get_stream(key, offset=start, length=length, etag=info.etag)
+    return Response(chunks, status=status, headers=headers, direct_passthrough=True)
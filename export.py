@@ -0,0 +1,194 @@
+"""Streaming ZIP export of documents.
+
+The archive is produced while it is being sent: zipfile writes into a sink
+that the response generator drains after every chunk, so nothing is spooled
+to disk and memory stays bounded no matter how large the export is. Blobs are
+read ahead by a small pool of threads; each read-ahead holds at most
+EXPORT_PREFETCH_CHUNKS chunks, so the worst case is roughly
+EXPORT_PREFETCH * EXPORT_PREFETCH_CHUNKS * BLOB_DOWNLOAD_CHUNK_SIZE bytes.
+"""
+import csv
+import hashlib
+import io
+import logging
+import os
+import queue
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.utils import secure_filename
+
+from storage import StorageNotFound
+
+EXPORT_PREFETCH = int(os.getenv("EXPORT_PREFETCH", "4"))
+EXPORT_PREFETCH_CHUNKS = int(os.getenv("EXPORT_PREFETCH_CHUNKS", "2"))
+# certificates are PDFs and images that do not deflate; "deflated" trades
+# CPU for smaller archives of other content
+EXPORT_COMPRESSION = zipfile.ZIP_DEFLATED if os.getenv("EXPORT_COMPRESSION") == "deflated" else zipfile.ZIP_STORED
+MAX_EXPORT_DOCUMENTS = int(os.getenv("MAX_EXPORT_DOCUMENTS", "20000"))
+
+EXPORT_COLUMNS = "d.id, d.student_email, d.filename, d.cert_type, d.uploaded_at, d.verified, d.verifier, COALESCE(d.blob_key, d.filename), d.size, d.content_hash"
+MANIFEST_HEADER = ["path", "student", "filename", "cert_type", "uploaded_at", "verified", "verifier", "size", "sha256", "status"]
+
+_END = object()
+
+
+class _Sink(io.RawIOBase):
+    """Write-only, non-seekable buffer; zipfile falls back to data
+    descriptors for it instead of seeking back to patch headers."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class _ReadAhead:
+    """Reads one blob on a pool thread into a bounded queue of chunks."""
+
+    def __init__(self, storage, key, cancelled):
+        self.storage = storage
+        self.key = key
+        self.cancelled = cancelled
+        self.chunks = queue.Queue(EXPORT_PREFETCH_CHUNKS)
+
+    def _put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.chunks.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self):
+        try:
+            for chunk in self.storage.get_stream(self.key):
+                if not self._put(chunk):
+                    return
+            self._put(_END)
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self):
+        while True:
+            item = self.chunks.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+def export_documents(db, where, params, from_sql="FROM documents d"):
+    """Rows to export, oldest first. The list is read up front so the
+    database connection is not held while the archive streams."""
+    sql = f"SELECT {EXPORT_COLUMNS} {from_sql}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return db.execute(sql + f" ORDER BY d.student_email, d.id LIMIT {MAX_EXPORT_DOCUMENTS + 1}", params).fetchall()
+
+
+def _date_time(uploaded_at):
+    try:
+        t = time.strptime((uploaded_at or "")[:19], "%Y-%m-%d %H:%M:%S")
+        return t[:6] if t.tm_year >= 1980 else (1980, 1, 1, 0, 0, 0)
+    except ValueError:
+        return time.localtime()[:6]
+
+
+def folder_name(email):
+    return secure_filename((email or "").replace("@", "_at_")) or "unknown"
+
+
+def _archive_path(row):
+    name = secure_filename(row[2] or "") or "document"
+    return f"{folder_name(row[1])}/{row[0]}_{name}"
+
+
+def stream_zip(storage, rows, manifest=True):
+    """Yield the bytes of a ZIP containing ``rows`` (from export_documents)
+    and, optionally, a manifest.csv describing every entry."""
+    sink = _Sink()
+    cancelled = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=EXPORT_PREFETCH, thread_name_prefix="export")
+    pending = deque()
+    upcoming = iter(rows)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(MANIFEST_HEADER)
+
+    def schedule():
+        while len(pending) < EXPORT_PREFETCH:
+            row = next(upcoming, None)
+            if row is None:
+                return
+            reader = _ReadAhead(storage, row[7], cancelled)
+            pool.submit(reader.run)
+            pending.append((row, reader))
+
+    try:
+        with zipfile.ZipFile(sink, "w", compression=EXPORT_COMPRESSION, allowZip64=True) as zf:
+            schedule()
+            while pending:
+                row, reader = pending.popleft()
+                schedule()
+                path = _archive_path(row)
+                chunks = iter(reader)
+                try:
+                    first = next(chunks, b"")
+                except StorageNotFound:
+                    writer.writerow([path, row[1], row[2], row[3], row[4], int(bool(row[5])), row[6] or "", "", "", "missing"])
+                    continue
+                info = zipfile.ZipInfo(path, _date_time(row[4]))
+                info.compress_type = EXPORT_COMPRESSION
+                info.file_size = row[8] or 0
+                # the sizes go in a data descriptor after the body; zip64
+                # fields are needed up front when the size may pass 2 GiB
+                digest = None if row[9] else hashlib.sha256()
+                size = 0
+                with zf.open(info, "w", force_zip64=row[8] is None) as entry:
+                    for chunk in _chain(first, chunks):
+                        entry.write(chunk)
+                        size += len(chunk)
+                        if digest:
+                            digest.update(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+                writer.writerow([path, row[1], row[2], row[3], row[4], int(bool(row[5])), row[6] or "", size,
+                                 row[9] or digest.hexdigest(), "ok"])
+                yield sink.drain()
+            if manifest:
+                zf.writestr(zipfile.ZipInfo("manifest.csv", time.localtime()[:6]), out.getvalue(),
+                            compress_type=zipfile.ZIP_DEFLATED)
+        yield sink.drain()
+    except GeneratorExit:
+        logging.info("Export cancelled by client")
+        raise
+    except Exception:
+        # headers are long gone; the client sees a truncated archive
+        logging.exception("Export failed")
+        raise
+    finally:
+        cancelled.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _chain(first, rest):
+    if first:
+        yield first
+    yield from rest
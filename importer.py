@@ -0,0 +1,151 @@
+"""Streaming CSV import for student and staff accounts.
+
+The upload is decoded incrementally and handled in batches: each batch is
+validated, normalised and written with one ``executemany`` upsert in its own
+transaction, so the write lock is released between batches and memory stays
+flat however large the intake file is. Bytes that are not UTF-8 stop the
+import; the rows before them stay imported and the report says where it
+stopped.
+"""
+import csv
+import io
+import os
+import re
+
+import cache
+import stats
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+MAX_REPORTED_ERRORS = 1000
+EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+")
+
+# table -> (insert columns, columns refreshed on conflict)
+TABLES = {
+    "students": (("email", "password", "mentor_email"), ("password",)),
+    "staff": (("email", "password"), ("password",)),
+}
+
+
+class ImportReport:
+    """Outcome of an import; ``errors`` holds (line, email, message)."""
+
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.errors = []
+        # why the import ended before the end of the file, if it did
+        self.stopped = None
+
+    def error(self, line, email, message):
+        self.skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, email, message))
+
+    def summary(self, noun):
+        text = f"Imported {self.inserted} new {noun}, updated {self.updated}"
+        if self.skipped:
+            text += f", skipped {self.skipped} invalid rows"
+        if self.stopped:
+            text += f"; stopped early, {self.stopped}, later rows were not imported"
+        return text
+
+    def to_json(self):
+        return {
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "skipped": self.skipped,
+            "stopped": self.stopped,
+            "errors": [{"line": line, "email": email, "error": message} for line, email, message in self.errors],
+        }
+
+
+def _columns(header):
+    # header names are matched case-insensitively, as the old importer did
+    names = [(h or "").strip().lower() for h in header]
+    return tuple(names.index(n) if n in names else None for n in ("email", "password"))
+
+
+def _validate(batch, email_at, password_at, report):
+    """Normalise a batch of (line, row) pairs into parameter tuples. Later
+    rows for the same email win, matching what the upsert would do."""
+    rows = {}
+    fullmatch = EMAIL_RE.fullmatch
+    for line, row in batch:
+        email = row[email_at].strip() if email_at < len(row) else ""
+        password = row[password_at].strip() if password_at < len(row) else ""
+        if not email:
+            if any(row):
+                report.error(line, None, "missing email")
+        elif not fullmatch(email):
+            report.error(line, email, "invalid email")
+        elif not password:
+            report.error(line, email, "missing password")
+        else:
+            rows[email] = (line, email, password)
+    return list(rows.values())
+
+
+def _write_batch(db, table, rows, report):
+    columns, refresh = TABLES[table]
+    emails = [email for _, email, _ in rows]
+    marks = ",".join("?" * len(emails))
+    existing = {r[0] for r in db.execute(f"SELECT email FROM {table} WHERE email IN ({marks})", emails)}
+
+    sql = (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        f" ON CONFLICT (email) DO UPDATE SET "
+        + ", ".join(f"{c} = excluded.{c}" for c in refresh)
+    )
+    params = [(email, password, None)[:len(columns)] for _, email, password in rows]
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.executemany(sql, params)
+        new = [email for email in emails if email not in existing]
+        if table == "students":
+            stats.refresh_new_students(db, new)
+        cache.invalidate(db, table)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    report.inserted += len(new)
+    report.updated += len(rows) - len(new)
+
+
+def import_csv(db, stream, table, batch_size=IMPORT_BATCH_SIZE):
+    """Import ``email,password`` rows from a binary ``stream`` into ``table``
+    ("students" or "staff"); returns an ImportReport.
+
+    Raises UnicodeDecodeError when the header is not UTF-8. Bad bytes
+    further on end the import with ``report.stopped`` set; the rows before
+    them are committed.
+    """
+    report = ImportReport()
+    if db.in_transaction:
+        db.commit()
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    try:
+        reader = csv.reader(text)
+        email_at, password_at = _columns(next(reader, []))
+        if email_at is None or password_at is None:
+            report.error(1, None, "header must contain email and password columns")
+            return report
+        batch = []
+        try:
+            for row in reader:
+                batch.append((reader.line_num, row))
+                if len(batch) >= batch_size:
+                    rows = _validate(batch, email_at, password_at, report)
+                    if rows:
+                        _write_batch(db, table, rows, report)
+                    batch = []
+        except UnicodeDecodeError:
+            report.stopped = f"the file is not valid UTF-8 after line {reader.line_num}"
+        rows = _validate(batch, email_at, password_at, report)
+        if rows:
+            _write_batch(db, table, rows, report)
+    finally:
+        # leave the underlying upload open for werkzeug to clean up
+        text.detach()
+    return report
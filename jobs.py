@@ -0,0 +1,246 @@
+"""Background jobs backed by the ``jobs`` table.
+
+Routes enqueue work in the same transaction as the rows it belongs to and
+answer 202 with the job id; ``flask jobs-worker`` runs a pool of worker
+processes that claim jobs with ``BEGIN IMMEDIATE``, so no broker is needed.
+Failed jobs are retried with exponential backoff, and each job type caps how
+many of its jobs may run at once across all workers.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+ENABLED = os.getenv("BACKGROUND_JOBS", "0").lower() in ("1", "true", "yes")
+SPOOL_DIR = os.getenv("JOB_SPOOL_DIR", "job_spool")
+POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+# a running job whose worker has not finished it within this many seconds
+# is assumed lost (killed worker) and handed out again
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", "900"))
+RETRY_BASE_SECONDS = int(os.getenv("JOB_RETRY_BASE_SECONDS", "5"))
+RETRY_MAX_SECONDS = 3600
+
+HANDLERS = {}
+
+
+class Handler:
+    def __init__(self, fn, concurrency, max_attempts, on_failure=None):
+        self.fn = fn
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.on_failure = on_failure
+
+
+def register(job_type, concurrency=1, max_attempts=3, on_failure=None):
+    """Decorator registering ``fn(payload) -> result`` for ``job_type``.
+    ``on_failure(payload)`` runs once the job has run out of attempts."""
+    def decorator(fn):
+        HANDLERS[job_type] = Handler(fn, concurrency, max_attempts, on_failure)
+        return fn
+    return decorator
+
+
+def spool(stream, suffix=""):
+    """Copy an upload to SPOOL_DIR so a worker can read it after the request
+    has finished; returns the path."""
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=SPOOL_DIR, suffix=suffix)
+    with os.fdopen(fd, "wb") as out:
+        shutil.copyfileobj(stream, out, 1024 * 1024)
+    return os.path.abspath(path)
+
+
+def enqueue(db, job_type, payload, created_by=None):
+    """Insert a queued job and return its id; the caller commits."""
+    handler = HANDLERS[job_type]
+    cur = db.execute(
+        "INSERT INTO jobs (type, payload, max_attempts, created_by) VALUES (?, ?, ?, ?)",
+        (job_type, json.dumps(payload), handler.max_attempts, created_by),
+    )
+    return cur.lastrowid
+
+
+def status(db, job_id):
+    row = db.execute(
+        "SELECT id, type, status, attempts, max_attempts, result, error, created_by,"
+        " created_at, started_at, finished_at FROM jobs WHERE id = ?", (job_id,)
+    ).fetchone()
+    if not row:
+        return None
+    return {
+        "id": row[0],
+        "type": row[1],
+        "status": row[2],
+        "attempts": row[3],
+        "max_attempts": row[4],
+        "result": json.loads(row[5]) if row[5] else None,
+        "error": row[6],
+        "created_by": row[7],
+        "created_at": row[8],
+        "started_at": row[9],
+        "finished_at": row[10],
+    }
+
+
+def result(db, job_id):
+    """The handler's return value once the job is done, else None."""
+    job = status(db, job_id)
+    return job["result"] if job and job["status"] == "done" else None
+
+
+def _requeue_stale(db):
+    db.execute(
+        "UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,"
+        " error = 'worker lost', locked_by = NULL, run_after = CURRENT_TIMESTAMP,"
+        " finished_at = CASE WHEN attempts >= max_attempts THEN CURRENT_TIMESTAMP END"
+        " WHERE status = 'running' AND started_at < datetime('now', ?)",
+        (f"-{JOB_TIMEOUT} seconds",),
+    )
+
+
+def claim(db, worker_id):
+    """Atomically move the next runnable job to 'running' and return
+    (id, type, payload), or None when nothing is runnable."""
+    if db.in_transaction:
+        db.commit()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        _requeue_stale(db)
+        running = dict(db.execute("SELECT type, COUNT(*) FROM jobs WHERE status = 'running' GROUP BY type").fetchall())
+        types = [t for t, h in HANDLERS.items() if running.get(t, 0) < h.concurrency]
+        row = None
+        if types:
+            marks = ",".join("?" * len(types))
+            row = db.execute(
+                f"SELECT id, type, payload FROM jobs WHERE status = 'queued' AND type IN ({marks})"
+                " AND run_after <= CURRENT_TIMESTAMP ORDER BY run_after, id LIMIT 1", types
+            ).fetchone()
+        if row:
+            db.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_by = ?,"
+                " started_at = CURRENT_TIMESTAMP WHERE id = ?", (worker_id, row[0])
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return (row[0], row[1], json.loads(row[2])) if row else None
+
+
+def complete(db, job_id, value):
+    db.execute(
+        "UPDATE jobs SET status = 'done', result = ?, error = NULL, locked_by = NULL,"
+        " finished_at = CURRENT_TIMESTAMP WHERE id = ?", (json.dumps(value), job_id)
+    )
+    db.commit()
+
+
+def fail(db, job_id, error):
+    """Record a failed attempt: retry after an exponential backoff, or mark
+    the job failed once it is out of attempts. Returns True when retried."""
+    attempts, max_attempts = db.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if attempts < max_attempts:
+        delay = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+        db.execute(
+            "UPDATE jobs SET status = 'queued', error = ?, locked_by = NULL,"
+            " run_after = datetime('now', ?) WHERE id = ?", (error, f"+{delay} seconds", job_id)
+        )
+    else:
+        db.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, locked_by = NULL,"
+            " finished_at = CURRENT_TIMESTAMP WHERE id = ?", (error, job_id)
+        )
+    db.commit()
+    return attempts < max_attempts
+
+
+def run_one(app, worker_id):
+    """Claim and run a single job; returns False when the queue was idle."""
+    from db import get_db
+
+    with app.app_context():
+        job = claim(get_db(), worker_id)
+    if not job:
+        return False
+    job_id, job_type, payload = job
+    started = time.perf_counter()
+    try:
+        with app.app_context():
+            value = HANDLERS[job_type].fn(payload)
+    except Exception as e:
+        logging.exception(f"Job {job_id} ({job_type}) failed")
+        with app.app_context():
+            retried = fail(get_db(), job_id, f"{type(e).__name__}: {e}")
+        if not retried:
+            on_failure = HANDLERS[job_type].on_failure
+            if on_failure:
+                try:
+                    with app.app_context():
+                        on_failure(payload)
+                except Exception:
+                    logging.exception(f"Failure handler of job {job_id} ({job_type}) failed")
+            _cleanup(payload)
+        return True
+    with app.app_context():
+        complete(get_db(), job_id, value)
+    _cleanup(payload)
+    logging.info(f"Job {job_id} ({job_type}) done in {time.perf_counter() - started:.3f}s")
+    return True
+
+
+def _cleanup(payload):
+    # spooled inputs are only needed until the job can no longer be retried
+    path = payload.get("spool") if isinstance(payload, dict) else None
+    if path and os.path.exists(path):
+        os.unlink(path)
+
+
+def _work_loop(worker_id, poll_interval):
+    from app import app
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    signal.signal(signal.SIGINT, lambda *_: stopping.append(True))
+    while not stopping:
+        try:
+            busy = run_one(app, worker_id)
+        except Exception:
+            logging.exception("Job worker error")
+            busy = False
+        if not busy:
+            time.sleep(poll_interval)
+
+
+def run_workers(processes=2, poll_interval=POLL_INTERVAL):
+    """Run ``processes`` worker processes until SIGINT/SIGTERM."""
+    host = socket.gethostname()
+    workers = [
+        multiprocessing.Process(target=_work_loop, args=(f"{host}:{os.getpid()}:{i}", poll_interval), daemon=True)
+        for i in range(processes)
+    ]
+    for w in workers:
+        w.start()
+
+    def interrupt(*_):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        for w in workers:
+            w.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # workers finish their current job before exiting
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+        for w in workers:
+            w.join()
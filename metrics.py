@@ -0,0 +1,422 @@
+"""Request instrumentation and a Prometheus text-format /metrics endpoint.
+
+Every request records its route latency, how many SQL statements it ran and
+how long they took; storage calls record their duration and bytes moved.
+Requests slower than SLOW_REQUEST_MS are logged with their query list.
+
+The hot path is a couple of perf_counter() calls and a bisect per event under
+one lock, cheap enough to leave on in production. Values are per process: with
+several gunicorn workers each scrape sees the worker that answered it, so
+scrape every worker or rely on rate() across restarts as usual.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# bearer token required on /metrics; without it only admins may scrape
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# also let 127.0.0.1 scrape without the token; never set behind a local proxy
+METRICS_ALLOW_LOCALHOST = os.getenv("METRICS_ALLOW_LOCALHOST", "0") == "1"
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "500"))
+# statements remembered per request for the slow-request log
+MAX_LOGGED_QUERIES = int(os.getenv("SLOW_REQUEST_MAX_QUERIES", "100"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+slow_log = logging.getLogger("slow_requests")
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, size):
+        self.counts = [0] * (size + 1)
+        self.sum = 0.0
+
+
+class Registry:
+    """Counters and histograms keyed by label values, plus collectors that
+    report other modules' stats() at scrape time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        self._meta[name] = ("counter", help, labels, None)
+        self._counters[name] = {}
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help, labels, buckets)
+        self._histograms[name] = {}
+
+    def collector(self, fn):
+        """Register ``fn() -> [(name, help, {labels: value}[, kind])]``;
+        kind is "gauge" unless given."""
+        self._collectors.append(fn)
+        return fn
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            series = self._counters[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, value, labels=()):
+        buckets = self._meta[name][3]
+        i = bisect_left(buckets, value)
+        with self._lock:
+            series = self._histograms[name]
+            h = series.get(labels)
+            if h is None:
+                h = series[labels] = _Histogram(len(buckets))
+            h.counts[i] += 1
+            h.sum += value
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = {n: dict(s) for n, s in self._counters.items()}
+            histograms = {n: {k: (list(h.counts), h.sum) for k, h in s.items()} for n, s in self._histograms.items()}
+        for name, series in counters.items():
+            kind, help, labels, _ = self._meta[name]
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} counter"]
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{_labels(labels, key)} {_num(value)}")
+        for name, series in histograms.items():
+            kind, help, labels, buckets = self._meta[name]
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+            for key, (counts, total) in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else _num(bound)
+                    lines.append(f"{name}_bucket{_labels(labels + ('le',), key + (le,))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels, key)} {_num(total)}")
+                lines.append(f"{name}_count{_labels(labels, key)} {cumulative}")
+        for fn in self._collectors:
+            try:
+                gauges = fn()
+            except Exception:
+                logging.exception("metrics collector failed")
+                continue
+            for name, help, values, *kind in gauges:
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind[0] if kind else 'gauge'}"]
+                for labels, value in sorted(values.items()):
+                    lines.append(f"{name}{_labels(tuple(k for k, _ in labels), tuple(v for _, v in labels))} {_num(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _num(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+registry = Registry()
+registry.counter("http_requests_total", "Requests handled.", ("method", "route", "status"))
+registry.histogram("http_request_duration_seconds", "Time to build the response.", ("route",))
+registry.histogram("http_request_queries", "SQL statements per request.", ("route",), COUNT_BUCKETS)
+registry.counter("db_queries_total", "SQL statements executed.")
+registry.histogram("db_query_duration_seconds", "Time spent in execute()/executemany().")
+registry.counter("storage_operations_total", "Storage backend calls.", ("backend", "op"))
+registry.counter("storage_errors_total", "Storage backend calls that raised.", ("backend", "op"))
+registry.counter("storage_bytes_total", "Bytes moved to or from storage.", ("backend", "op"))
+registry.histogram("storage_operation_duration_seconds", "Time spent in storage backend calls.", ("backend", "op"))
+registry.counter("slow_requests_total", "Requests slower than SLOW_REQUEST_MS.", ("route",))
+
+
+class _RequestStats:
+    __slots__ = ("queries", "query_seconds", "log")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.log = []
+
+
+_current = ContextVar("metrics_request", default=None)
+
+
+def record_query(sql, seconds):
+    registry.inc("db_queries_total")
+    registry.observe("db_query_duration_seconds", seconds)
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.query_seconds += seconds
+        if len(stats.log) < MAX_LOGGED_QUERIES:
+            stats.log.append((sql, seconds))
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection factory that times execute() and executemany(),
+    on the connection and on its cursors.
+
+    Rows a SELECT yields after the first are stepped lazily by fetch*(), so
+    the recorded time is the statement's start-up cost, which is where
+    scans and sorts show up.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+
+class InstrumentedStorage:
+    """Wraps a storage backend to time its calls and count bytes."""
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._name = backend.name or type(backend).__name__
+
+    def __getattr__(self, attr):
+        return getattr(self._backend, attr)
+
+    def _timed(self, op, fn, *args, **kwargs):
+        labels = (self._name, op)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            registry.inc("storage_errors_total", labels)
+            raise
+        finally:
+            registry.inc("storage_operations_total", labels)
+            registry.observe("storage_operation_duration_seconds", time.perf_counter() - start, labels)
+
+    def put(self, key, stream, size=None, content_type=None, **kwargs):
+        result = self._timed("put", self._backend.put, key, stream, size=size, content_type=content_type, **kwargs)
+        sent = result.get("bytes") if isinstance(result, dict) else size
+        if sent:
+            registry.inc("storage_bytes_total", (self._name, "put"), sent)
+        return result
+
+    def head(self, key):
+        return self._timed("head", self._backend.head, key)
+
+    def delete(self, key):
+        return self._timed("delete", self._backend.delete, key)
+
+    def get_range(self, key, offset, length):
+        data = self._timed("get_range", self._backend.get_range, key, offset, length)
+        registry.inc("storage_bytes_total", (self._name, "get"), len(data))
+        return data
+
+    def get_stream(self, key, offset=0, length=None, etag=None):
+        chunks = self._timed("get", self._backend.get_stream, key, offset, length, etag)
+        return self._counted(chunks)
+
+    def _counted(self, chunks):
+        # only time spent inside the backend counts, not the consumer's
+        labels = (self._name, "get")
+        it = iter(chunks)
+        elapsed, total = 0.0, 0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                total += len(chunk)
+                yield chunk
+        finally:
+            registry.inc("storage_bytes_total", labels, total)
+            registry.observe("storage_operation_duration_seconds", elapsed, (self._name, "read"))
+
+
+    async def ahead(self, key):
+        labels = (self._name, "head")
+        start = time.perf_counter()
+        try:
+            return await self._backend.ahead(key)
+        except Exception:
+            registry.inc("storage_errors_total", labels)
+            raise
+        finally:
+            registry.inc("storage_operations_total", labels)
+            registry.observe("storage_operation_duration_seconds", time.perf_counter() - start, labels)
+
+    async def aput(self, key, stream, size=None, content_type=None):
+        labels = (self._name, "put")
+        start = time.perf_counter()
+        try:
+            result = await self._backend.aput(key, stream, size=size, content_type=content_type)
+        except Exception:
+            registry.inc("storage_errors_total", labels)
+            raise
+        finally:
+            registry.inc("storage_operations_total", labels)
+            registry.observe("storage_operation_duration_seconds", time.perf_counter() - start, labels)
+        sent = result.get("bytes") if isinstance(result, dict) else size
+        if sent:
+            registry.inc("storage_bytes_total", labels, sent)
+        return result
+
+    async def aget_stream(self, key, offset=0, length=None, etag=None):
+        # wall time of the whole stream: waiting on storage is the point here
+        registry.inc("storage_operations_total", (self._name, "get"))
+        start = time.perf_counter()
+        total = 0
+        try:
+            async for chunk in self._backend.aget_stream(key, offset, length, etag):
+                total += len(chunk)
+                yield chunk
+        except Exception:
+            registry.inc("storage_errors_total", (self._name, "get"))
+            raise
+        finally:
+            registry.inc("storage_bytes_total", (self._name, "get"), total)
+            registry.observe("storage_operation_duration_seconds", time.perf_counter() - start, (self._name, "read"))
+
+
+def record_sendfile(backend_name, size):
+    """Count bytes handed to the server's sendfile, which bypass get_stream."""
+    registry.inc("storage_bytes_total", (backend_name, "sendfile"), size)
+
+
+def _route(request):
+    rule = request.url_rule
+    return rule.rule if rule is not None else "unmatched"
+
+
+def begin_request():
+    """Start collecting for the current request; pass the returned token
+    to end_request()."""
+    return time.perf_counter(), _current.set(_RequestStats())
+
+
+def end_request(token, method, route, path, status):
+    start, var_token = token
+    elapsed = time.perf_counter() - start
+    stats = _current.get()
+    _current.reset(var_token)
+
+    registry.inc("http_requests_total", (method, route, str(status)))
+    registry.observe("http_request_duration_seconds", elapsed, (route,))
+    registry.observe("http_request_queries", stats.queries, (route,))
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        registry.inc("slow_requests_total", (route,))
+        lines = [f"  {ms * 1000:8.2f} ms  {' '.join(sql.split())[:300]}" for sql, ms in stats.log]
+        if stats.queries > len(stats.log):
+            lines.append(f"  ... {stats.queries - len(stats.log)} more")
+        slow_log.warning(
+            f"{method} {path} ({route}) took {elapsed * 1000:.1f} ms, "
+            f"{stats.queries} queries in {stats.query_seconds * 1000:.1f} ms\n" + "\n".join(lines)
+        )
+
+
+def cancel_request(token):
+    """Drop a request started with begin_request() without recording it."""
+    _current.reset(token[1])
+
+
+def _before_request():
+    from flask import g
+    g._metrics_token = begin_request()
+
+
+def _after_request(response):
+    from flask import g, request
+    token = g.pop("_metrics_token", None)
+    if token is not None:
+        end_request(token, request.method, _route(request), request.full_path.rstrip("?"), response.status_code)
+    return response
+
+
+def _teardown_request(exc=None):
+    # unhandled exceptions skip after_request; count them as 500s
+    from flask import Response, g
+    if "_metrics_token" in g:
+        _after_request(Response(status=500))
+
+
+def gauges(prefix, help, stats, counters=()):
+    """Gauges for the numeric values of a stats() dict, nested dicts
+    flattened into the name: gauges("db_pool", ..., {"idle": 3}). Keys in
+    ``counters`` only ever grow and are exported as ``<name>_total`` counters."""
+    out = []
+    for key, value in stats.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            out += gauges(name, help, value, counters)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            if key in counters:
+                out.append((f"{name}_total", help, {(): value}, "counter"))
+            else:
+                out.append((name, help, {(): value}))
+    return out
+
+
+def _allowed(request, session):
+    if METRICS_TOKEN:
+        return request.headers.get("Authorization") == f"Bearer {METRICS_TOKEN}"
+    if METRICS_ALLOW_LOCALHOST and request.remote_addr in ("127.0.0.1", "::1"):
+        return True
+    return session.get("role") == "admin"
+
+
+def _metrics_view():
+    from flask import Response, request, session
+    if not _allowed(request, session):
+        return "Forbidden", 403
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    if not METRICS_ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule("/metrics", "metrics", _metrics_view)
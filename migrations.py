@@ -0,0 +1,411 @@
+import logging
+import re
+import sqlite3
+from collections import Counter
+
+
+class MigrationError(Exception):
+    """A migration cannot be applied until an admin fixes the data."""
+
+
+def _add_column(cur, table, column, decl):
+    cols = [r[1] for r in cur.execute(f"PRAGMA table_info({table})")]
+    if column not in cols:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _base_schema(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS staff (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT,
+        password TEXT
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS students (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT,
+        password TEXT,
+        mentor_email TEXT
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS documents (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_email TEXT,
+        filename TEXT,
+        cert_type TEXT,
+        uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS admins (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT UNIQUE,
+        password TEXT
+    )
+    """)
+
+
+def _verification_columns(cur):
+    _add_column(cur, "documents", "verified", "INTEGER DEFAULT 0")
+    _add_column(cur, "documents", "verifier", "TEXT")
+    _add_column(cur, "documents", "verified_at", "TIMESTAMP")
+
+
+def _lookup_indexes(cur):
+    # admins.email is already covered by the UNIQUE constraint's autoindex
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_documents_student_uploaded ON documents (student_email, uploaded_at DESC)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_documents_uploaded ON documents (uploaded_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_students_mentor_email ON students (mentor_email, email)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_students_email ON students (email)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_staff_email ON staff (email)")
+
+
+def _documents_covering_index(cur):
+    # superset of idx_documents_student_uploaded that lets the mentor analytics
+    # queries run as index-only scans
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_documents_student_covering ON documents (student_email, uploaded_at DESC, cert_type, filename)")
+    cur.execute("DROP INDEX IF EXISTS idx_documents_student_uploaded")
+
+
+def _summary_tables(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS student_doc_stats (
+        student_email TEXT PRIMARY KEY,
+        mentor_email TEXT,
+        uploads INTEGER NOT NULL DEFAULT 0,
+        verified INTEGER NOT NULL DEFAULT 0,
+        latest_filename TEXT,
+        latest_uploaded_at TIMESTAMP
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS student_cert_stats (
+        student_email TEXT,
+        cert_type TEXT,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (student_email, cert_type)
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS student_keyword_stats (
+        student_email TEXT,
+        keyword TEXT,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (student_email, keyword)
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS mentor_keyword_stats (
+        mentor_email TEXT,
+        keyword TEXT,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (mentor_email, keyword)
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_mentor_keyword_stats_top ON mentor_keyword_stats (mentor_email, count DESC)")
+    _backfill_summary_tables(cur)
+
+
+# frozen copy of analytics.filename_keywords as released with migration 5;
+# later tokenizer changes go through "flask stats-rebuild", not this backfill
+_V5_STOPWORDS = frozenset(['the', 'and', 'of', 'in', 'a', 'an', 'for', 'to', 'on', 'by', 'with', 'cert',
+                           'certificate', 'doc', 'document', 'pdf', 'jpg', 'png'])
+_V5_TOKEN_RE = re.compile(r"[^A-Za-z0-9]+")
+
+
+def _backfill_summary_tables(cur):
+    cur.execute("""
+    INSERT INTO student_doc_stats (student_email, mentor_email, uploads, verified, latest_filename, latest_uploaded_at)
+    SELECT s.email, s.mentor_email, COUNT(*), SUM(CASE WHEN d.verified THEN 1 ELSE 0 END),
+        (SELECT l.filename FROM documents l WHERE l.student_email = s.email
+         ORDER BY COALESCE(l.uploaded_at, '') DESC, l.id DESC LIMIT 1),
+        MAX(COALESCE(d.uploaded_at, ''))
+    FROM students s JOIN documents d ON d.student_email = s.email
+    GROUP BY s.email
+    """)
+    cur.execute("""
+    INSERT INTO student_cert_stats (student_email, cert_type, count)
+    SELECT d.student_email, TRIM(d.cert_type, ' ' || char(9, 10, 11, 12, 13)), COUNT(*)
+    FROM documents d JOIN students s ON s.email = d.student_email
+    WHERE TRIM(COALESCE(d.cert_type, ''), ' ' || char(9, 10, 11, 12, 13)) != ''
+    GROUP BY 1, 2
+    """)
+    keywords, mentor_keywords = Counter(), Counter()
+    for email, mentor, filename in cur.execute(
+        "SELECT d.student_email, s.mentor_email, d.filename FROM documents d"
+        " JOIN students s ON s.email = d.student_email"
+    ).fetchall():
+        for k in _V5_TOKEN_RE.split((filename or '').lower()):
+            if k and k not in _V5_STOPWORDS and len(k) >= 2:
+                keywords[(email, k)] += 1
+                if mentor:
+                    mentor_keywords[(mentor, k)] += 1
+    cur.executemany("INSERT INTO student_keyword_stats (student_email, keyword, count) VALUES (?, ?, ?)",
+                    [(email, k, n) for (email, k), n in keywords.items()])
+    cur.executemany("INSERT INTO mentor_keyword_stats (mentor_email, keyword, count) VALUES (?, ?, ?)",
+                    [(mentor, k, n) for (mentor, k), n in mentor_keywords.items()])
+
+
+def _document_blob_key(cur):
+    # rows without a blob_key keep using their filename as the blob name
+    _add_column(cur, "documents", "blob_key", "TEXT")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_documents_blob_key ON documents (blob_key)")
+
+
+def _content_addressed_blobs(cur):
+    _add_column(cur, "documents", "content_hash", "TEXT")
+    _add_column(cur, "documents", "size", "INTEGER")
+    # identical uploads now share one blob key
+    cur.execute("DROP INDEX IF EXISTS idx_documents_blob_key")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_documents_blob_key ON documents (blob_key)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents (content_hash, student_email)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS blobs (
+        content_hash TEXT PRIMARY KEY,
+        blob_key TEXT NOT NULL,
+        size INTEGER,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        released_at TIMESTAMP
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_blobs_collectable ON blobs (refcount, released_at)")
+
+
+def _unique_account_emails(cur):
+    # earlier versions accepted duplicate accounts; which one is real is an
+    # admin's call, so stop with a report rather than deleting any of them
+    report = []
+    for table in ("students", "staff"):
+        for email, ids in cur.execute(
+            f"SELECT email, GROUP_CONCAT(id, ', ') FROM {table} GROUP BY email HAVING COUNT(*) > 1 ORDER BY email"
+        ).fetchall():
+            report.append(f"  {table} {email}: ids {ids}")
+    if report:
+        raise MigrationError(
+            f"{len(report)} emails belong to more than one account; merge or delete the extra rows"
+            " and run the migration again:\n" + "\n".join(report)
+        )
+    cur.execute("DROP INDEX IF EXISTS idx_students_email")
+    cur.execute("DROP INDEX IF EXISTS idx_staff_email")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_students_email ON students (email)")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_staff_email ON staff (email)")
+
+
+def _jobs_table(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        type TEXT NOT NULL,
+        payload TEXT,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 3,
+        run_after TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        locked_by TEXT,
+        result TEXT,
+        error TEXT,
+        created_by TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_runnable ON jobs (status, run_after, id)")
+
+
+def _cache_generations(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS cache_generations (
+        namespace TEXT PRIMARY KEY,
+        generation INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+
+
+def _documents_fts(cur):
+    # external-content index: the text lives in documents, FTS5 keeps only
+    # the inverted index
+    cur.execute("""
+    CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5 (
+        filename, cert_type, student_email, verifier,
+        content='documents', content_rowid='id'
+    )
+    """)
+    # filename, cert_type, student_email, verifier; search.RANK_WEIGHTS as released
+    cur.execute("INSERT INTO documents_fts (documents_fts, rank) VALUES ('rank', 'bm25(4.0, 2.0, 1.0, 1.0)')")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS documents_fts_insert AFTER INSERT ON documents BEGIN
+        INSERT INTO documents_fts (rowid, filename, cert_type, student_email, verifier)
+        VALUES (new.id, new.filename, new.cert_type, new.student_email, new.verifier);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS documents_fts_delete AFTER DELETE ON documents BEGIN
+        INSERT INTO documents_fts (documents_fts, rowid, filename, cert_type, student_email, verifier)
+        VALUES ('delete', old.id, old.filename, old.cert_type, old.student_email, old.verifier);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS documents_fts_update
+    AFTER UPDATE OF filename, cert_type, student_email, verifier ON documents BEGIN
+        INSERT INTO documents_fts (documents_fts, rowid, filename, cert_type, student_email, verifier)
+        VALUES ('delete', old.id, old.filename, old.cert_type, old.student_email, old.verifier);
+        INSERT INTO documents_fts (rowid, filename, cert_type, student_email, verifier)
+        VALUES (new.id, new.filename, new.cert_type, new.student_email, new.verifier);
+    END
+    """)
+    cur.execute("INSERT INTO documents_fts (documents_fts) VALUES ('rebuild')")
+
+
+def _profiles_table(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS profiles (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        route TEXT NOT NULL,
+        method TEXT,
+        path TEXT,
+        mode TEXT NOT NULL,
+        trigger TEXT,
+        status INTEGER,
+        duration_ms REAL,
+        samples INTEGER,
+        file TEXT NOT NULL,
+        created_by TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_profiles_route ON profiles (route, id)")
+
+
+def _reconcile_runs(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS reconcile_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        status TEXT NOT NULL DEFAULT 'running',
+        options TEXT,
+        marker TEXT,
+        last_key TEXT,
+        counts TEXT,
+        error TEXT,
+        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    """)
+    # the reconciler walks every key source in key order
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_blobs_key ON blobs (blob_key)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_documents_legacy_key ON documents (filename, id) WHERE blob_key IS NULL")
+
+
+def _upload_sessions(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS upload_sessions (
+        id TEXT PRIMARY KEY,
+        student_email TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        cert_type TEXT,
+        content_type TEXT,
+        blob_key TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        chunk_size INTEGER NOT NULL,
+        document_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_student ON upload_sessions (student_email)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions (updated_at)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS upload_chunks (
+        session_id TEXT NOT NULL,
+        idx INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        PRIMARY KEY (session_id, idx)
+    ) WITHOUT ROWID
+    """)
+
+
+def _blob_stored_flag(cur):
+    _add_column(cur, "blobs", "stored", "INTEGER NOT NULL DEFAULT 1")
+    # blobs whose store_blob job has not succeeded were never written
+    cur.execute("""
+    UPDATE blobs SET stored = 0 WHERE blob_key IN (
+        SELECT json_extract(payload, '$.key') FROM jobs WHERE type = 'store_blob' AND status != 'done'
+    )
+    """)
+
+
+def _upload_session_claims(cur):
+    _add_column(cur, "upload_sessions", "finalizing_at", "TIMESTAMP")
+
+
+# Numbered migrations, applied in order exactly once. Never edit or reorder a
+# released entry; append a new one instead.
+MIGRATIONS = [
+    (1, "base schema", _base_schema),
+    (2, "document verification columns", _verification_columns),
+    (3, "indexes on lookup columns", _lookup_indexes),
+    (4, "covering index for document analytics", _documents_covering_index),
+    (5, "materialized dashboard stats", _summary_tables),
+    (6, "document blob keys", _document_blob_key),
+    (7, "content-addressed blobs", _content_addressed_blobs),
+    (8, "unique account emails", _unique_account_emails),
+    (9, "background jobs", _jobs_table),
+    (10, "cache generations", _cache_generations),
+    (11, "document full-text index", _documents_fts),
+    (12, "request profiles", _profiles_table),
+    (13, "blob reconciliation runs", _reconcile_runs),
+    (14, "resumable upload sessions", _upload_sessions),
+    (15, "blob stored flag", _blob_stored_flag),
+    (16, "upload session finalize claims", _upload_session_claims),
+]
+
+
+def current_version(db):
+    db.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, name TEXT, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+    row = db.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def schema_is_current(db):
+    """True when every migration has been applied. Read-only, unlike
+    current_version(), so it is safe to call from request handlers."""
+    try:
+        row = db.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        return False
+    return (row[0] or 0) >= MIGRATIONS[-1][0]
+
+
+def run_migrations(db):
+    """Apply any pending migrations and return the resulting schema version.
+
+    Runs under BEGIN IMMEDIATE so that workers booting at the same time
+    serialize here and only the first one does any DDL.
+    """
+    isolation_level = db.isolation_level
+    db.isolation_level = None
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            version = current_version(db)
+            cur = db.cursor()
+            for number, name, apply in MIGRATIONS:
+                if number <= version:
+                    continue
+                logging.info(f"Applying migration {number}: {name}")
+                apply(cur)
+                cur.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (number, name))
+                version = number
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    finally:
+        db.isolation_level = isolation_level
+    return version
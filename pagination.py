@@ -0,0 +1,160 @@
+"""Keyset (cursor) pagination for the document and user listings.
+
+Pages are ordered by a unique key -- (uploaded_at, id) for documents,
+(email, id) for users -- and the cursor is the key of the last row shown, so
+every page is an index range scan no matter how deep the user pages.
+"""
+import base64
+import json
+
+from flask import request, url_for
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+DOCUMENT_COLUMNS = "d.id, d.student_email, d.filename, d.cert_type, d.uploaded_at, d.verified, d.verifier, d.verified_at"
+DOCUMENT_SORTS = {
+    "newest": (("d.uploaded_at", "d.id"), True),
+    "oldest": (("d.uploaded_at", "d.id"), False),
+}
+USER_SORT = (("email", "id"), False)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class Page:
+    def __init__(self, items, columns, next_cursor, truncated=False):
+        self.items = items
+        self.columns = columns
+        self.next_cursor = next_cursor
+        # True when the listing only covers part of the matching rows
+        self.truncated = truncated
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def to_json(self):
+        return {
+            "items": [dict(zip(self.columns, row)) for row in self.items],
+            "next_cursor": self.next_cursor,
+            "truncated": self.truncated,
+        }
+
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token, length):
+    """The ``length`` sort-key values in ``token``; they are bound straight
+    into SQL, so anything but scalars is rejected."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        raise InvalidCursor("invalid cursor")
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursor("invalid cursor")
+    if not all(v is None or (isinstance(v, (str, int, float)) and not isinstance(v, bool)) for v in values):
+        raise InvalidCursor("invalid cursor")
+    return values
+
+
+def page_size(args):
+    try:
+        size = int(args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        size = DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def wants_json(args):
+    return args.get("format") == "json"
+
+
+def fetch_page(db, select_sql, where, params, sort, args, key_index):
+    """Run ``select_sql`` with the filters in ``where`` and return one Page.
+
+    ``sort`` is ((column, ...), descending) and ``key_index`` gives the
+    positions of those columns in each result row, used to build the cursor.
+    """
+    columns, descending = sort
+    where = list(where)
+    params = list(params)
+    cursor = decode_cursor(args.get("cursor"), len(columns))
+    if cursor is not None:
+        op = "<" if descending else ">"
+        where.append(f"({', '.join(columns)}) {op} ({', '.join('?' * len(columns))})")
+        params.extend(cursor)
+
+    limit = page_size(args)
+    direction = " DESC" if descending else ""
+    sql = select_sql
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY " + ", ".join(c + direction for c in columns) + " LIMIT ?"
+    cur = db.execute(sql, params + [limit + 1])
+    names = [d[0] for d in cur.description]
+    rows = cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][i] for i in key_index)
+    return Page(rows, names, next_cursor)
+
+
+def document_filters(args, where=None, params=None):
+    """Translate cert_type/verified/from/to query args into SQL on ``d``."""
+    where = list(where or [])
+    params = list(params or [])
+    cert_type = args.get("cert_type")
+    if cert_type:
+        where.append("d.cert_type = ?")
+        params.append(cert_type)
+    verified = args.get("verified")
+    if verified in ("0", "1"):
+        where.append("COALESCE(d.verified, 0) = ?")
+        params.append(int(verified))
+    date_from = args.get("from")
+    if date_from:
+        where.append("d.uploaded_at >= date(?)")
+        params.append(date_from)
+    date_to = args.get("to")
+    if date_to:
+        # inclusive of the whole "to" day
+        where.append("d.uploaded_at < date(?, '+1 day')")
+        params.append(date_to)
+    return where, params
+
+
+def document_page(db, args, from_sql="FROM documents d", where=None, params=None):
+    where, params = document_filters(args, where, params)
+    sort = DOCUMENT_SORTS.get(args.get("sort"), DOCUMENT_SORTS["newest"])
+    return fetch_page(db, f"SELECT {DOCUMENT_COLUMNS} {from_sql}", where, params, sort, args, key_index=(4, 0))
+
+
+def user_page(db, table, columns, args, where=None, params=None):
+    where = list(where or [])
+    params = list(params or [])
+    q = args.get("q")
+    if q:
+        # prefix match keeps the email index usable
+        where.append("email >= ? AND email < ?")
+        params.extend([q, q + "\uffff"])
+    return fetch_page(db, f"SELECT {columns} FROM {table}", where, params, USER_SORT, args, key_index=(1, 0))
+
+
+def page_url(cursor):
+    """URL of the current listing with the same filters and a new cursor."""
+    args = request.args.to_dict()
+    args["cursor"] = cursor
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
@@ -0,0 +1,264 @@
+"""Thumbnail previews of uploaded certificates.
+
+A preview is a small JPEG of the image or of a PDF's first page. Previews are
+derived artifacts: they are rendered once (after upload when background jobs
+are enabled, otherwise on first request), stored next to the originals under
+``previews/`` and never change, so they are served with long-lived cache
+headers. A size-bounded local disk cache with LRU eviction sits in front of
+blob storage so hot thumbnails are served without a storage round trip.
+
+Rendering needs Pillow (and pypdfium2 for PDFs); without them previews fall
+back to a generic icon. What a source is gets decided from its size, content
+type and first bytes before it is downloaded; a source that cannot be
+previewed gets an empty ``none`` marker next to the previews, so it is not
+fetched again on every listing.
+"""
+import hashlib
+import importlib.util
+import io
+import logging
+import os
+import tempfile
+import threading
+
+from storage import StorageNotFound
+
+PREVIEW_WIDTHS = (160, 320, 640)
+DEFAULT_WIDTH = 320
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "80"))
+# sources larger than this are not rendered, only shown as an icon
+PREVIEW_MAX_SOURCE_BYTES = int(os.getenv("PREVIEW_MAX_SOURCE_BYTES", str(50 * 1024 * 1024)))
+PREVIEW_CACHE_DIR = os.getenv("PREVIEW_CACHE_DIR", "preview_cache")
+PREVIEW_CACHE_MAX_BYTES = int(os.getenv("PREVIEW_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+PLACEHOLDER_SVG = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="160" height="200" viewBox="0 0 160 200">'
+    '<rect width="160" height="200" rx="8" fill="#eef2ff"/>'
+    '<path d="M50 40h45l25 25v95H50z" fill="#fff" stroke="#2563eb" stroke-width="4"/>'
+    '<path d="M95 40v25h25" fill="none" stroke="#2563eb" stroke-width="4"/></svg>'
+)
+
+
+NO_PREVIEW = "none"
+# leading bytes of the image formats Pillow reads
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG", b"GIF8", b"BM", b"II*\x00", b"MM\x00*", b"RIFF")
+
+
+def artifact_key(doc_id, content_hash, width):
+    # content-addressed documents share previews like they share blobs
+    if content_hash:
+        return f"previews/sha256/{content_hash}/w{width}.jpg"
+    return f"previews/doc/{doc_id}/w{width}.jpg"
+
+
+def marker_key(doc_id, content_hash):
+    """Key of the marker saying the source cannot be previewed."""
+    return artifact_key(doc_id, content_hash, 0).rsplit("/", 1)[0] + "/" + NO_PREVIEW
+
+
+def artifact_keys(content_hash):
+    return [artifact_key(None, content_hash, w) for w in PREVIEW_WIDTHS] + [marker_key(None, content_hash)]
+
+
+def source_kind(head, content_type=None):
+    """"pdf", "image" or None for a source starting with ``head``."""
+    if head.startswith(b"%PDF-"):
+        return "pdf"
+    if head.startswith(IMAGE_SIGNATURES) or (content_type or "").startswith("image/"):
+        return "image"
+    return None
+
+
+def can_render(kind):
+    """Whether this install has what rendering ``kind`` needs."""
+    if importlib.util.find_spec("PIL") is None:
+        return False
+    return kind != "pdf" or importlib.util.find_spec("pypdfium2") is not None
+
+
+class DiskCache:
+    """Size-bounded directory of small files with LRU eviction.
+
+    Recency is the file mtime, refreshed on every hit, so the cache survives
+    restarts and is shared by all workers on the host. Writes are atomic
+    renames; eviction runs when this process has written more than a tenth
+    of the budget since it last looked.
+    """
+
+    def __init__(self, root=PREVIEW_CACHE_DIR, max_bytes=PREVIEW_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._written = max_bytes  # scan once on first write
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._stats["misses"] += 1
+            return None
+        with self._lock:
+            self._stats["hits"] += 1
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._written += len(data)
+            due = self._written >= self.max_bytes // 10
+            if due:
+                self._written = 0
+        if due:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used files until the cache is at 90% of
+        its budget."""
+        entries, total = [], 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        target = self.max_bytes * 9 // 10
+        removed = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        with self._lock:
+            self._stats["evictions"] += removed
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+disk_cache = DiskCache()
+
+
+def _read_source(storage, key):
+    buf = io.BytesIO()
+    for chunk in storage.get_stream(key):
+        buf.write(chunk)
+    buf.seek(0)
+    return buf
+
+
+def render(source, width):
+    """JPEG bytes of a ``width``-pixel-wide preview of ``source`` (a binary
+    file object), or None when it cannot be rendered here."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+
+    head = source.read(5)
+    source.seek(0)
+    if head == b"%PDF-":
+        try:
+            import pypdfium2
+        except ImportError:
+            return None
+        pdf = pypdfium2.PdfDocument(source)
+        try:
+            page = pdf[0]
+            image = page.render(scale=width / page.get_width()).to_pil()
+        finally:
+            pdf.close()
+    else:
+        try:
+            image = Image.open(source)
+            # let the JPEG decoder downscale while decoding large scans
+            image.draft("RGB", (width, width * 2))
+            image = ImageOps.exif_transpose(image)
+        except (OSError, Image.DecompressionBombError):
+            return None
+
+    image.thumbnail((width, width * 2))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=PREVIEW_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def _cached(storage, key):
+    data = disk_cache.get(key)
+    if data is None:
+        try:
+            data = b"".join(storage.get_stream(key))
+        except StorageNotFound:
+            return None
+        disk_cache.put(key, data)
+    return data
+
+
+def get_preview(storage, doc_id, source_key, content_hash, width=DEFAULT_WIDTH):
+    """Return (key, JPEG bytes) for a document, rendering and storing the
+    preview on a miss. The bytes are None when no preview is possible; the
+    key is then the marker's if the source can never be previewed."""
+    key = artifact_key(doc_id, content_hash, width)
+    data = _cached(storage, key)
+    if data is not None:
+        return key, data
+    marker = marker_key(doc_id, content_hash)
+    if _cached(storage, marker) is not None:
+        return marker, None
+    data = generate(storage, key, source_key, width)
+    if data is NO_PREVIEW:
+        storage.put(marker, io.BytesIO(b""), size=0, content_type="text/plain")
+        disk_cache.put(marker, b"")
+        return marker, None
+    if data is not None:
+        disk_cache.put(key, data)
+    return key, data
+
+
+def generate(storage, key, source_key, width):
+    """Render and store the preview at ``key``. Returns its bytes, None when
+    this install cannot render the source, or NO_PREVIEW when it is not
+    previewable at all."""
+    info = storage.head(source_key)
+    if info.size > PREVIEW_MAX_SOURCE_BYTES:
+        return NO_PREVIEW
+    kind = source_kind(storage.get_range(source_key, 0, 8), info.content_type)
+    if kind is None:
+        return NO_PREVIEW
+    if not can_render(kind):
+        return None
+    try:
+        data = render(_read_source(storage, source_key), width)
+    except Exception:
+        logging.exception(f"Failed to render preview for {source_key}")
+        return NO_PREVIEW
+    if data is None:
+        return NO_PREVIEW
+    storage.put(key, io.BytesIO(data), size=len(data), content_type="image/jpeg")
+    return data
@@ -0,0 +1,213 @@
+"""On-demand profiling of individual requests.
+
+A request is profiled when an admin asks for it with an ``X-Profile`` header
+or a ``_profile`` query flag (``cprofile`` or ``sample``), or at random with
+probability PROFILE_SAMPLE_RATE.
+
+* ``cprofile`` records every call and is saved as a .pstats file for
+  pstats, snakeviz and friends.
+* ``sample`` snapshots the request thread's stack every PROFILE_INTERVAL_MS
+  from a helper thread and is saved as collapsed stacks (.folded) for
+  flamegraph.pl or speedscope. Its cost does not grow with the number of
+  calls the request makes, which is why random sampling uses it by default.
+  The helper needs the GIL to take a sample, so the effective interval is
+  at least the interpreter's switch interval (5 ms by default).
+
+Each profile gets a row in the ``profiles`` table; only the newest
+PROFILE_KEEP_PER_ROUTE per route are kept.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+import db as db_pool
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SAMPLE_MODE = os.getenv("PROFILE_SAMPLE_MODE", "sample")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_KEEP_PER_ROUTE = int(os.getenv("PROFILE_KEEP_PER_ROUTE", "20"))
+
+MODES = ("cprofile", "sample")
+EXTENSIONS = {"cprofile": "pstats", "sample": "folded"}
+
+
+class CallProfiler:
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.samples = 0
+
+    def start(self):
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+
+    def dump(self, path):
+        self.profiler.dump_stats(path)
+        self.samples = pstats.Stats(path).total_calls
+
+
+class StackSampler:
+    """Counts the stacks of one thread, sampled from a helper thread."""
+
+    def __init__(self, thread_id, interval_ms=PROFILE_INTERVAL_MS):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000
+        self.stacks = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                # co_qualname is 3.11+; deploys run 3.10
+                name = getattr(frame.f_code, "co_qualname", frame.f_code.co_name)
+                stack.append(f"{frame.f_globals.get('__name__', '?')}:{name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def requested(request, session):
+    """(mode, trigger) when this request should be profiled, else (None, None)."""
+    asked = request.headers.get("X-Profile") or request.args.get("_profile")
+    if asked and session.get("role") == "admin":
+        return (asked if asked in MODES else "cprofile"), "admin"
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        return PROFILE_SAMPLE_MODE, "sampled"
+    return None, None
+
+
+def start(mode):
+    profiler = CallProfiler() if mode == "cprofile" else StackSampler(threading.get_ident())
+    profiler.start()
+    return profiler
+
+
+def save(profiler, mode, trigger, route, method, path, status, duration_ms, created_by=None):
+    """Write the profile to PROFILE_DIR, record it and prune old ones for
+    the route. Returns the profile id."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:12]}.{EXTENSIONS[mode]}"
+    profiler.dump(os.path.join(PROFILE_DIR, name))
+
+    # not the request's connection: it may still hold the route's transaction
+    conn = db_pool.pool.acquire()
+    try:
+        cur = conn.execute(
+            "INSERT INTO profiles (route, method, path, mode, trigger, status, duration_ms, samples, file, created_by)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (route, method, path, mode, trigger, status, round(duration_ms, 3), profiler.samples, name, created_by),
+        )
+        stale = conn.execute(
+            "SELECT id, file FROM profiles WHERE route = ? ORDER BY id DESC LIMIT -1 OFFSET ?",
+            (route, PROFILE_KEEP_PER_ROUTE),
+        ).fetchall()
+        conn.executemany("DELETE FROM profiles WHERE id = ?", [(row[0],) for row in stale])
+        conn.commit()
+    finally:
+        db_pool.pool.release(conn)
+    for _, file in stale:
+        try:
+            os.unlink(os.path.join(PROFILE_DIR, file))
+        except FileNotFoundError:
+            pass
+    return cur.lastrowid
+
+
+def recent(db, per_route=10):
+    """Newest profiles grouped by route, busiest routes first."""
+    rows = db.execute(
+        "SELECT id, route, method, path, mode, trigger, status, duration_ms, samples, created_by, created_at"
+        " FROM (SELECT p.*, ROW_NUMBER() OVER (PARTITION BY route ORDER BY id DESC) AS n FROM profiles p)"
+        " WHERE n <= ? ORDER BY route, id DESC",
+        (per_route,),
+    ).fetchall()
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row[1], []).append(row)
+    return sorted(grouped.items(), key=lambda item: -len(item[1]))
+
+
+def artifact(db, profile_id):
+    """(path, mode, download name) of a stored profile, or None."""
+    row = db.execute("SELECT file, mode FROM profiles WHERE id = ?", (profile_id,)).fetchone()
+    if not row:
+        return None
+    path = os.path.join(PROFILE_DIR, row[0])
+    return (path, row[1], f"profile-{profile_id}.{EXTENSIONS[row[1]]}") if os.path.exists(path) else None
+
+
+def text_report(path, limit=60):
+    """Top functions of a .pstats file by cumulative time."""
+    out = io.StringIO()
+    stats = pstats.Stats(path, stream=out)
+    stats.sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+def _before_request():
+    from flask import g, request, session
+    mode, trigger = requested(request, session)
+    if mode:
+        g._profile = (start(mode), mode, trigger, time.perf_counter())
+
+
+def _finish(status, response=None):
+    from flask import g, request, session
+    profiler, mode, trigger, started = g.pop("_profile")
+    profiler.stop()
+    duration_ms = (time.perf_counter() - started) * 1000
+    rule = request.url_rule
+    try:
+        profile_id = save(profiler, mode, trigger, rule.rule if rule is not None else "unmatched", request.method,
+                          request.full_path.rstrip("?"), status, duration_ms, session.get("email"))
+    except Exception:
+        logging.exception("Failed to save request profile")
+        return
+    if response is not None:
+        response.headers["X-Profile-Id"] = str(profile_id)
+
+
+def _after_request(response):
+    from flask import g
+    if "_profile" in g:
+        _finish(response.status_code, response)
+    return response
+
+
+def _teardown_request(exc=None):
+    from flask import g
+    if "_profile" in g:
+        _finish(500)
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,402 @@
+"""Reconcile the blob container with the database.
+
+The container listing and the database's key sources (documents.blob_key,
+the filename of legacy rows, blobs.blob_key) are each walked in key order
+and merged, so a run holds a page of each in memory however large the
+container is. The listing runs on a helper thread a couple of pages ahead
+of the merge. Findings:
+
+* orphan    -- a blob nothing refers to, e.g. left behind when the insert
+  after an upload failed, or by a document deleted outside the app
+* missing   -- a document (or blobs row) whose blob is not in the container
+* ownerless -- a document whose student account has been deleted
+
+Anything younger than the minimum age is skipped, so uploads in flight and
+blobs waiting on a store_blob job are left alone. Deletes are opt-in; each
+finding is re-checked right before it is removed. Deleting a document
+releases its content reference, so collect_garbage() removes the shared
+blob once the last reference is gone; a legacy or direct-upload blob shows up
+as an orphan on the next run.
+
+Progress is checkpointed in ``reconcile_runs`` after every page, and a run
+can be resumed from its last checkpoint. Listing and deletes are rate
+limited so a run can go on during business hours.
+"""
+import heapq
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import dedup
+import stats
+from storage import LIST_PAGE_SIZE, StorageNotFound
+
+RECONCILE_MIN_AGE_HOURS = float(os.getenv("RECONCILE_MIN_AGE_HOURS", "24"))
+# blobs listed per second and blobs or rows deleted per second; 0 is unlimited
+RECONCILE_RATE = float(os.getenv("RECONCILE_RATE", "0"))
+RECONCILE_DELETE_RATE = float(os.getenv("RECONCILE_DELETE_RATE", "0"))
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", "8"))
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "100"))
+
+MAX_ID = 2 ** 63 - 1
+
+_DOCUMENT_COLUMNS = "d.id, d.student_email, d.uploaded_at, d.content_hash, s.id IS NULL"
+
+# each query pages through one key source in (key, id) order; the key comes first
+SOURCES = [
+    ("document",
+     f"SELECT d.blob_key, {_DOCUMENT_COLUMNS} FROM documents d LEFT JOIN students s ON s.email = d.student_email"
+     " WHERE d.blob_key IS NOT NULL AND d.blob_key >= ? AND (d.blob_key > ? OR d.id > ?)"
+     " ORDER BY d.blob_key, d.id LIMIT ?"),
+    ("document",
+     f"SELECT d.filename, {_DOCUMENT_COLUMNS} FROM documents d INDEXED BY idx_documents_legacy_key"
+     " LEFT JOIN students s ON s.email = d.student_email"
+     " WHERE d.blob_key IS NULL AND d.filename >= ? AND (d.filename > ? OR d.id > ?)"
+     " ORDER BY d.filename, d.id LIMIT ?"),
+    ("blob",
+     "SELECT blob_key, rowid, content_hash, refcount, created_at FROM blobs"
+     " WHERE blob_key >= ? AND (blob_key > ? OR rowid > ?) ORDER BY blob_key, rowid LIMIT ?"),
+]
+
+_PREVIEW_KEY = re.compile(r"previews/(?:sha256/([0-9a-f]{64})|doc/(\d+))/(?:w\d+\.jpg|none)")
+
+COUNTS = ("blobs", "bytes", "orphans", "orphan_bytes", "missing", "ownerless", "skipped_recent",
+          "deleted_blobs", "deleted_rows", "errors")
+
+
+class ReconcileError(Exception):
+    pass
+
+
+class Throttle:
+    """Spaces work out to at most ``rate`` units per second (0: unlimited).
+    Safe to share between threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self, units=1):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + units * self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def _source(db, kind, sql, after, page_size):
+    last = (after, MAX_ID) if after is not None else ("", -1)
+    while True:
+        rows = db.execute(sql, (last[0], last[0], last[1], page_size)).fetchall()
+        for row in rows:
+            yield row[0], kind, row
+        if len(rows) < page_size:
+            return
+        last = (rows[-1][0], rows[-1][1])
+
+
+def _in_order(items, what):
+    prev = None
+    for item in items:
+        if prev is not None and item[0] < prev:
+            raise ReconcileError(f"{what} is not in key order ({item[0]!r} after {prev!r})")
+        prev = item[0]
+        yield item
+
+
+def _prefetch(pages, depth=2):
+    """Iterate ``pages`` on a helper thread, at most ``depth`` pages ahead."""
+    q = queue.Queue(depth)
+    done = object()
+
+    def run():
+        try:
+            for page in pages:
+                q.put(page)
+            q.put(done)
+        except BaseException as e:
+            q.put(e)
+
+    threading.Thread(target=run, name="reconcile-list", daemon=True).start()
+    while True:
+        item = q.get()
+        if item is done:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+class Reconciler:
+    def __init__(self, db, storage, delete_orphans=False, delete_dangling=False,
+                 min_age_hours=RECONCILE_MIN_AGE_HOURS, rate=RECONCILE_RATE, delete_rate=RECONCILE_DELETE_RATE,
+                 concurrency=RECONCILE_CONCURRENCY, batch_size=RECONCILE_BATCH_SIZE, page_size=LIST_PAGE_SIZE,
+                 report=None):
+        self.db = db
+        self.storage = storage
+        self.delete_orphans = delete_orphans
+        self.delete_dangling = delete_dangling
+        self.min_age_hours = min_age_hours
+        self.list_throttle = Throttle(rate)
+        self.delete_throttle = Throttle(delete_rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.report = report
+        self.counts = dict.fromkeys(COUNTS, 0)
+        self.run_id = None
+        self.marker = None
+        self.last_key = None
+
+    def options(self):
+        return {"delete_orphans": self.delete_orphans, "delete_dangling": self.delete_dangling,
+                "min_age_hours": self.min_age_hours}
+
+    # -- runs ------------------------------------------------------------------
+
+    def run(self, resume=False):
+        """Reconcile the whole container and return the counts. With
+        ``resume`` the latest unfinished run continues from its checkpoint."""
+        row = None
+        if resume:
+            row = self.db.execute(
+                "SELECT id, marker, last_key, counts FROM reconcile_runs"
+                " WHERE status IN ('running', 'failed') ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+        if row:
+            self.run_id, self.marker, self.last_key = row[0], row[1], row[2]
+            self.counts.update(json.loads(row[3] or "{}"))
+            logging.info(f"Resuming reconcile run {self.run_id} after {self.last_key!r}")
+        else:
+            cur = self.db.execute("INSERT INTO reconcile_runs (options, counts) VALUES (?, ?)",
+                                  (json.dumps(self.options()), json.dumps(self.counts)))
+            self.db.commit()
+            self.run_id = cur.lastrowid
+
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=self.min_age_hours)
+        self.cutoff = cutoff
+        self.cutoff_text = cutoff.strftime("%Y-%m-%d %H:%M:%S")
+        self.pool = ThreadPoolExecutor(self.concurrency, thread_name_prefix="reconcile")
+        try:
+            self._scan()
+        except BaseException as e:
+            self.db.rollback()
+            self._save("failed", error=repr(e))
+            raise
+        finally:
+            self.pool.shutdown()
+        self._save("done")
+        return self.counts
+
+    def _save(self, status="running", error=None):
+        self.db.execute(
+            "UPDATE reconcile_runs SET status = ?, marker = ?, last_key = ?, counts = ?, error = ?,"
+            " updated_at = CURRENT_TIMESTAMP,"
+            " finished_at = CASE WHEN ? = 'done' THEN CURRENT_TIMESTAMP END WHERE id = ?",
+            (status, self.marker, self.last_key, json.dumps(self.counts), error, status, self.run_id),
+        )
+        self.db.commit()
+
+    # -- the merge -------------------------------------------------------------
+
+    def _scan(self):
+        sources = [_source(self.db, kind, sql, self.last_key, self.page_size) for kind, sql in SOURCES]
+        rows = _in_order(heapq.merge(*sources, key=lambda item: item[0]), "database key stream")
+        row = next(rows, None)
+        prev = self.last_key
+
+        pages = self.storage.list_pages(marker=self.marker, page_size=self.page_size)
+        for page, marker in _prefetch(pages):
+            self.list_throttle.wait(len(page))
+            findings = []
+            previews = []
+            for info in page:
+                # listings resumed from a marker may repeat part of a checkpointed page
+                if self.last_key is not None and info.name <= self.last_key:
+                    continue
+                if prev is not None and info.name <= prev:
+                    raise ReconcileError(f"storage listing is not in key order ({info.name!r} after {prev!r})")
+                prev = info.name
+
+                while row is not None and row[0] < info.name:
+                    self._check_row(row, findings, missing=True)
+                    row = next(rows, None)
+                referenced = False
+                while row is not None and row[0] == info.name:
+                    self._check_row(row, findings, missing=False)
+                    referenced = True
+                    row = next(rows, None)
+
+                self.counts["blobs"] += 1
+                self.counts["bytes"] += info.size or 0
+                if referenced:
+                    continue
+                if info.last_modified is not None and info.last_modified > self.cutoff:
+                    self.counts["skipped_recent"] += 1
+                elif info.name.startswith("previews/"):
+                    previews.append(info)
+                else:
+                    findings.append({"type": "orphan", "key": info.name, "size": info.size})
+
+            owned = self._owned_previews([info.name for info in previews])
+            findings += [{"type": "orphan", "key": info.name, "size": info.size}
+                         for info in previews if info.name not in owned]
+            self._settle(findings)
+            self.marker, self.last_key = marker, prev
+            self._save()
+            logging.info(f"Reconcile run {self.run_id}: {self.counts['blobs']} blobs scanned, "
+                         f"{self.counts['orphans']} orphans, {self.counts['missing']} missing, "
+                         f"{self.counts['ownerless']} ownerless")
+
+        # every key left on the database side sorts after the last blob
+        if row is not None and self.delete_dangling and not self.counts["blobs"]:
+            raise ReconcileError("the container listing is empty; refusing to delete documents")
+        findings = []
+        while row is not None:
+            self._check_row(row, findings, missing=True)
+            row = next(rows, None)
+        self._settle(findings)
+
+    def _check_row(self, item, findings, missing):
+        key, kind, row = item
+        if kind == "blob":
+            # unreferenced blobs rows are collect_garbage()'s to clean up
+            if missing and row[3] > 0 and not (row[4] and row[4] > self.cutoff_text):
+                findings.append({"type": "missing", "key": key, "content_hash": row[2], "refcount": row[3]})
+            return
+        _, doc_id, email, uploaded_at, _, ownerless = row
+        if uploaded_at and uploaded_at > self.cutoff_text:
+            return
+        if missing or ownerless:
+            findings.append({"type": "missing" if missing else "ownerless", "key": key, "document": doc_id,
+                             "student": email, "uploaded_at": uploaded_at})
+
+    # -- findings --------------------------------------------------------------
+
+    def _settle(self, findings):
+        """Count, delete (when asked) and report one page of findings."""
+        for finding in findings:
+            if finding["type"] == "orphan":
+                self.counts["orphans"] += 1
+                self.counts["orphan_bytes"] += finding["size"] or 0
+            else:
+                self.counts[finding["type"]] += 1
+        if self.delete_orphans:
+            self._delete_blobs([f for f in findings if f["type"] == "orphan"])
+        if self.delete_dangling:
+            self._delete_rows([f for f in findings if "document" in f])
+        if self.report and findings:
+            with open(self.report, "a") as out:
+                for finding in findings:
+                    out.write(json.dumps(finding) + "\n")
+
+    def _owned_previews(self, keys):
+        """The preview keys whose document or content still exists."""
+        by_hash, by_id = {}, {}
+        for key in keys:
+            m = _PREVIEW_KEY.fullmatch(key)
+            if m and m.group(1):
+                by_hash.setdefault(m.group(1), []).append(key)
+            elif m:
+                by_id.setdefault(int(m.group(2)), []).append(key)
+        owned = set()
+        hashes, ids = list(by_hash), list(by_id)
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            for (digest,) in self.db.execute(
+                f"SELECT content_hash FROM blobs WHERE content_hash IN ({marks})"
+                f" UNION SELECT content_hash FROM documents WHERE content_hash IN ({marks})", chunk * 2
+            ).fetchall():
+                owned.update(by_hash[digest])
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for (doc_id,) in self.db.execute(
+                f"SELECT id FROM documents WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall():
+                owned.update(by_id[doc_id])
+        return owned
+
+    def _referenced(self, keys):
+        """The keys a document or blobs row refers to now."""
+        marks = ",".join("?" * len(keys))
+        rows = self.db.execute(
+            f"SELECT blob_key FROM documents WHERE blob_key IN ({marks})"
+            f" UNION SELECT filename FROM documents WHERE blob_key IS NULL AND filename IN ({marks})"
+            f" UNION SELECT blob_key FROM blobs WHERE blob_key IN ({marks})",
+            keys * 3,
+        ).fetchall()
+        return {row[0] for row in rows} | self._owned_previews(keys)
+
+    def _delete_blob(self, key):
+        self.delete_throttle.wait()
+        try:
+            self.storage.delete(key)
+        except StorageNotFound:
+            pass
+        except Exception:
+            logging.exception(f"Failed to delete orphan blob {key}")
+            return False
+        return True
+
+    def _delete_blobs(self, findings):
+        for i in range(0, len(findings), self.batch_size):
+            batch = findings[i:i + self.batch_size]
+            # a document may have been recorded since the page was merged
+            referenced = self._referenced([f["key"] for f in batch])
+            batch = [f for f in batch if f["key"] not in referenced]
+            for finding, ok in zip(batch, self.pool.map(self._delete_blob, [f["key"] for f in batch])):
+                finding["deleted"] = ok
+                self.counts["deleted_blobs" if ok else "errors"] += 1
+
+    def _blob_missing(self, key):
+        try:
+            self.storage.head(key)
+            return False
+        except StorageNotFound:
+            return True
+
+    def _delete_rows(self, findings):
+        for i in range(0, len(findings), self.batch_size):
+            batch = findings[i:i + self.batch_size]
+            missing = [f for f in batch if f["type"] == "missing"]
+            gone = self.pool.map(self._blob_missing, [f["key"] for f in missing])
+            confirmed = [f["document"] for f, is_gone in zip(missing, gone) if is_gone]
+            ownerless = [f["document"] for f in batch if f["type"] == "ownerless"]
+            deleted = self._delete_documents(confirmed, ownerless)
+            for finding in batch:
+                finding["deleted"] = finding["document"] in deleted
+            self.counts["deleted_rows"] += len(deleted)
+
+    def _delete_documents(self, missing_ids, ownerless_ids):
+        """Delete the documents, re-checking that ownerless ones still have no
+        student; returns the ids deleted."""
+        rows = []
+        for ids, extra in ((missing_ids, ""), (ownerless_ids, " AND student_email NOT IN (SELECT email FROM students)")):
+            if ids:
+                marks = ",".join("?" * len(ids))
+                rows += self.db.execute(
+                    f"SELECT id, student_email, content_hash FROM documents WHERE id IN ({marks}){extra}", ids
+                ).fetchall()
+        if not rows:
+            return set()
+        self.delete_throttle.wait(len(rows))
+        ids = [row[0] for row in rows]
+        for _, _, content_hash in rows:
+            dedup.release_ref(self.db, content_hash)
+        self.db.execute(f"DELETE FROM documents WHERE id IN ({','.join('?' * len(ids))})", ids)
+        for email in {row[1] for row in rows}:
+            stats.refresh_student(self.db, email)
+        self.db.commit()
+        return set(ids)
+
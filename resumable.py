@@ -0,0 +1,244 @@
+"""Resumable chunked uploads for large files on unreliable connections.
+
+A student opens a session with the file's size, PUTs it as numbered chunks
+of ``chunk_size`` bytes, each with its SHA-256, and finalizes once every
+chunk has arrived. Each chunk is staged as a block of the final blob, so a
+dropped connection costs only the chunk in flight: the client asks the
+session what it already has and carries on from there. The block list is
+committed and the documents row written only on finalize.
+
+Sessions left untouched for SESSION_TTL seconds are removed together with
+their staged blocks by collect_expired() ("flask upload-sessions-gc").
+"""
+import hashlib
+import logging
+import math
+import os
+import uuid
+
+import direct_upload
+import upload_pipeline
+from storage import StorageNotFound
+
+CHUNK_SIZE = int(os.getenv("RESUMABLE_CHUNK_SIZE", str(upload_pipeline.BLOCK_SIZE)))
+MIN_CHUNK_SIZE = 256 * 1024
+SESSION_TTL = int(os.getenv("RESUMABLE_SESSION_TTL", str(24 * 3600)))
+MAX_OPEN_SESSIONS = int(os.getenv("RESUMABLE_MAX_OPEN_SESSIONS", "5"))
+# a finalize claim older than this belongs to a worker that died mid-commit
+FINALIZE_TIMEOUT = 300
+
+# a session whose finalize claim is absent or stale; takes FINALIZE_TIMEOUT
+# as "-N seconds"
+_UNCLAIMED = "(finalizing_at IS NULL OR finalizing_at <= datetime('now', ?))"
+
+SESSION_COLUMNS = ("id, student_email, filename, cert_type, content_type, blob_key, size, chunk_size, document_id,"
+                   " finalizing_at")
+
+
+class SessionError(ValueError):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def chunk_count(size, chunk_size):
+    return math.ceil(size / chunk_size)
+
+
+def chunk_length(session, index):
+    """Bytes expected in chunk ``index``; every chunk but the last is full."""
+    if not 0 <= index < chunk_count(session["size"], session["chunk_size"]):
+        raise SessionError("chunk index out of range", 416)
+    return min(session["chunk_size"], session["size"] - index * session["chunk_size"])
+
+
+def create(db, email, filename, size, cert_type=None, content_type=None, chunk_size=None):
+    """Open a session and commit; returns its row as a dict."""
+    if not isinstance(filename, str) or not filename:
+        raise SessionError("filename must be a non-empty string")
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        raise SessionError("size must be a positive integer")
+    for name, value in (("cert_type", cert_type), ("content_type", content_type)):
+        if value is not None and not isinstance(value, str):
+            raise SessionError(f"{name} must be a string")
+    if size > direct_upload.MAX_UPLOAD_SIZE:
+        raise SessionError(f"size must be at most {direct_upload.MAX_UPLOAD_SIZE} bytes", 413)
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    if (not isinstance(chunk_size, int) or isinstance(chunk_size, bool)
+            or not MIN_CHUNK_SIZE <= chunk_size <= CHUNK_SIZE):
+        raise SessionError(f"chunk_size must be between {MIN_CHUNK_SIZE} and {CHUNK_SIZE} bytes")
+    open_sessions = db.execute(
+        "SELECT COUNT(*) FROM upload_sessions WHERE student_email = ? AND document_id IS NULL", (email,)
+    ).fetchone()[0]
+    if open_sessions >= MAX_OPEN_SESSIONS:
+        raise SessionError("too many unfinished uploads; finish or cancel one first", 429)
+
+    session_id = uuid.uuid4().hex
+    db.execute(
+        "INSERT INTO upload_sessions (id, student_email, filename, cert_type, content_type, blob_key, size, chunk_size)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (session_id, email, filename, cert_type, content_type, direct_upload.new_blob_key(filename), size, chunk_size),
+    )
+    db.commit()
+    return get(db, session_id, email)
+
+
+def get(db, session_id, email):
+    """The session ``session_id`` if it belongs to ``email``, else None."""
+    row = db.execute(f"SELECT {SESSION_COLUMNS} FROM upload_sessions WHERE id = ? AND student_email = ?",
+                     (session_id, email)).fetchone()
+    if row is None:
+        return None
+    return dict(zip([c.strip() for c in SESSION_COLUMNS.split(",")], row))
+
+
+def progress(db, session):
+    """What the server holds: chunks received, the contiguous byte offset a
+    sequential client resumes from, and the chunks still missing."""
+    total = chunk_count(session["size"], session["chunk_size"])
+    received = {idx for (idx,) in db.execute("SELECT idx FROM upload_chunks WHERE session_id = ?", (session["id"],))}
+    if session["document_id"] is not None:
+        received = set(range(total))
+    missing = [i for i in range(total) if i not in received]
+    contiguous = missing[0] if missing else total
+    return {
+        "id": session["id"],
+        "filename": session["filename"],
+        "size": session["size"],
+        "chunk_size": session["chunk_size"],
+        "chunks": total,
+        "received": len(received),
+        "offset": min(session["size"], contiguous * session["chunk_size"]),
+        "missing": missing,
+        "document_id": session["document_id"],
+    }
+
+
+def store_chunk(db, storage, session, index, data, checksum):
+    """Verify chunk ``index`` against its SHA-256 and stage it. Returns False
+    when the same bytes were already staged, as after a lost response."""
+    if session["document_id"] is not None:
+        raise SessionError("upload already finalized", 409)
+    if len(data) != chunk_length(session, index):
+        raise SessionError(f"chunk {index} must be {chunk_length(session, index)} bytes")
+    digest = hashlib.sha256(data).hexdigest()
+    if digest != (checksum or "").lower():
+        raise SessionError(f"checksum mismatch for chunk {index}")
+
+    row = db.execute("SELECT sha256 FROM upload_chunks WHERE session_id = ? AND idx = ?",
+                     (session["id"], index)).fetchone()
+    if row and row[0] == digest:
+        return False
+    # checked against the row, not ``session``: a finalize may have claimed
+    # the session since it was read
+    cur = db.execute(
+        "UPDATE upload_sessions SET updated_at = CURRENT_TIMESTAMP"
+        f" WHERE id = ? AND document_id IS NULL AND {_UNCLAIMED}",
+        (session["id"], f"-{FINALIZE_TIMEOUT} seconds"),
+    )
+    db.commit()
+    if not cur.rowcount:
+        raise SessionError("upload is being finalized", 409)
+    # a resent block with the same id replaces the staged one
+    storage.block_client(session["blob_key"]).stage_block(upload_pipeline.block_id(index), data, length=len(data))
+    # and again here, so a chunk staged while a finalize took the session is
+    # not counted towards it
+    cur = db.execute(
+        "INSERT INTO upload_chunks (session_id, idx, size, sha256) SELECT ?, ?, ?, ?"
+        f" WHERE EXISTS (SELECT 1 FROM upload_sessions WHERE id = ? AND document_id IS NULL AND {_UNCLAIMED})"
+        " ON CONFLICT (session_id, idx) DO UPDATE SET size = excluded.size, sha256 = excluded.sha256",
+        (session["id"], index, len(data), digest, session["id"], f"-{FINALIZE_TIMEOUT} seconds"),
+    )
+    db.commit()
+    if not cur.rowcount:
+        raise SessionError("upload is being finalized", 409)
+    return True
+
+
+def claim(db, session_id, email):
+    """Mark the session as finalizing and commit, so the storage calls of
+    finalize run outside any transaction. Returns the session, or None when
+    it does not exist, is finalized or another finalize holds it."""
+    cur = db.execute(
+        "UPDATE upload_sessions SET finalizing_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP"
+        f" WHERE id = ? AND student_email = ? AND document_id IS NULL AND {_UNCLAIMED}",
+        (session_id, email, f"-{FINALIZE_TIMEOUT} seconds"),
+    )
+    db.commit()
+    return get(db, session_id, email) if cur.rowcount else None
+
+
+def unclaim(db, session_id):
+    db.execute("UPDATE upload_sessions SET finalizing_at = NULL WHERE id = ?", (session_id,))
+    db.commit()
+
+
+def commit(db, storage, session):
+    """Commit the staged blocks as the session's blob and return its size.
+    Call with the session claimed and no transaction open."""
+    total = chunk_count(session["size"], session["chunk_size"])
+    received = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM upload_chunks WHERE session_id = ?",
+                          (session["id"],)).fetchone()
+    if received[0] != total or received[1] != session["size"]:
+        raise SessionError(f"{total - received[0]} chunks missing", 409)
+    try:
+        # an earlier finalize committed the blocks and then failed to record
+        # the document; the staged blocks are gone, the blob is there
+        info = storage.head(session["blob_key"])
+    except StorageNotFound:
+        upload_pipeline.commit_blocks(storage.block_client(session["blob_key"]), total, session["content_type"])
+        info = storage.head(session["blob_key"])
+    if info.size != session["size"]:
+        storage.delete(session["blob_key"])
+        raise SessionError("uploaded size does not match", 409)
+    return info.size
+
+
+def close(db, session_id, document_id):
+    """Mark the session finalized; the caller commits. The row stays until
+    it expires so a retried finalize gets the same document back."""
+    db.execute("UPDATE upload_sessions SET document_id = ?, finalizing_at = NULL, updated_at = CURRENT_TIMESTAMP"
+               " WHERE id = ?", (document_id, session_id))
+    db.execute("DELETE FROM upload_chunks WHERE session_id = ?", (session_id,))
+
+
+def abort(db, storage, session):
+    """Drop a session and, if unfinished, its staged blocks, and commit.
+    Refused while a finalize holds the session."""
+    cur = db.execute(f"DELETE FROM upload_sessions WHERE id = ? AND {_UNCLAIMED}",
+                     (session["id"], f"-{FINALIZE_TIMEOUT} seconds"))
+    if not cur.rowcount:
+        db.commit()
+        raise SessionError("upload is being finalized", 409)
+    db.execute("DELETE FROM upload_chunks WHERE session_id = ?", (session["id"],))
+    db.commit()
+    if session["document_id"] is None:
+        storage.discard_staged(session["blob_key"])
+
+
+def collect_expired(db, storage, ttl=SESSION_TTL, limit=500):
+    """Remove sessions not touched for ``ttl`` seconds, discarding the staged
+    blocks of unfinished ones. Returns how many were removed."""
+    cutoff = f"-{int(ttl)} seconds"
+    expired = db.execute(
+        "SELECT id, blob_key, document_id FROM upload_sessions WHERE updated_at <= datetime('now', ?) LIMIT ?",
+        (cutoff, limit),
+    ).fetchall()
+    removed = 0
+    for session_id, blob_key, document_id in expired:
+        # re-checked in the delete, so a chunk that just arrived keeps it alive
+        cur = db.execute("DELETE FROM upload_sessions WHERE id = ? AND updated_at <= datetime('now', ?)",
+                         (session_id, cutoff))
+        if not cur.rowcount:
+            continue
+        db.execute("DELETE FROM upload_chunks WHERE session_id = ?", (session_id,))
+        db.commit()
+        removed += 1
+        if document_id is None:
+            try:
+                storage.discard_staged(blob_key)
+            except Exception:
+                logging.exception(f"Failed to discard staged blocks of upload session {session_id}")
+    db.commit()
+    return removed
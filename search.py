@@ -0,0 +1,75 @@
+"""Full-text document search backed by the documents_fts FTS5 index.
+
+documents_fts indexes filename, cert_type, student_email and verifier of every
+document and is kept in sync by triggers on documents (see migrations.py).
+Relevance is bm25 weighted towards filename matches, computed over the newest
+SEARCH_MAX_RANKED matches only: FTS5 streams matches in rowid order and scores
+them lazily, so a word that appears in half the corpus costs the same as a
+rare one. Older matches are left out of a relevance listing, which is then
+marked truncated; newest/oldest follow upload order (the rowid) and reach
+every match. Results page with the listings' keyset cursors.
+"""
+import os
+import re
+
+from pagination import DOCUMENT_COLUMNS, document_filters, fetch_page
+
+# column weights for bm25: filename, cert_type, student_email, verifier
+RANK_WEIGHTS = (4.0, 2.0, 1.0, 1.0)
+MAX_QUERY_TERMS = 8
+SEARCH_MAX_RANKED = int(os.getenv("SEARCH_MAX_RANKED", "1000"))
+_TERM_RE = re.compile(r"[^\W_]+")
+
+SEARCH_FROM = "FROM documents_fts JOIN documents d ON d.id = documents_fts.rowid"
+RELEVANCE_SORT = (("c.rank", "d.id"), False)
+SEARCH_SORTS = {
+    "newest": (("documents_fts.rowid",), True),
+    "oldest": (("documents_fts.rowid",), False),
+}
+
+
+def match_query(text):
+    """Turn free text into an FTS5 query where every term must match as a
+    prefix, e.g. ``sem fin`` -> ``"sem"* "fin"*``. Returns None when the text
+    has no searchable terms. User input never reaches FTS5 query syntax."""
+    terms = _TERM_RE.findall((text or "").lower())[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    return " ".join(f'"{t}"*' for t in terms)
+
+
+def search_page(db, args, mentor=None):
+    """One page of documents matching ``args['q']``, restricted to the
+    students of ``mentor`` when given. Accepts the listing filters and
+    sort=relevance|newest|oldest."""
+    query = match_query(args.get("q"))
+    if query is None:
+        return None
+    from_sql = SEARCH_FROM
+    where, params = ["documents_fts MATCH ?"], [query]
+    if mentor:
+        from_sql += " JOIN students s ON s.email = d.student_email"
+        where.append("s.mentor_email = ?")
+        params.append(mentor)
+    where, params = document_filters(args, where, params)
+
+    if args.get("sort") in SEARCH_SORTS:
+        select = f"SELECT {DOCUMENT_COLUMNS} {from_sql}"
+        return fetch_page(db, select, where, params, SEARCH_SORTS[args["sort"]], args, key_index=(0,))
+
+    candidates = (
+        f"SELECT documents_fts.rowid AS id, documents_fts.rank AS rank {from_sql}"
+        f" WHERE {' AND '.join(where)} ORDER BY documents_fts.rowid DESC LIMIT {SEARCH_MAX_RANKED}"
+    )
+    select = f"SELECT {DOCUMENT_COLUMNS}, c.rank AS rank FROM ({candidates}) c JOIN documents d ON d.id = c.id"
+    page = fetch_page(db, select, [], params, RELEVANCE_SORT, args, key_index=(8, 0))
+    page.truncated = db.execute(
+        f"SELECT 1 {from_sql} WHERE {' AND '.join(where)} LIMIT 1 OFFSET {SEARCH_MAX_RANKED}", params
+    ).fetchone() is not None
+    return page
+
+
+def rebuild(db):
+    """Re-index every document, e.g. after restoring documents from a backup."""
+    db.execute("INSERT INTO documents_fts (documents_fts) VALUES ('rebuild')")
+    db.commit()
@@ -0,0 +1,192 @@
+"""Summary tables behind the mentor dashboards.
+
+student_doc_stats, student_cert_stats and student_keyword_stats hold
+per-student totals; mentor_keyword_stats holds the keyword totals of every
+student currently mapped to a mentor. Only documents of existing students
+are counted. Writers call the hooks below in the same transaction as the
+change they describe; rebuild() and check() recompute from documents.
+"""
+from collections import Counter
+
+from analytics import filename_keywords
+
+
+def _bump_keywords(db, student_email, mentor_email, keywords, sign=1):
+    if not keywords:
+        return
+    rows = [(student_email, k, sign * n) for k, n in keywords.items()]
+    db.executemany(
+        "INSERT INTO student_keyword_stats (student_email, keyword, count) VALUES (?, ?, ?)"
+        " ON CONFLICT (student_email, keyword) DO UPDATE SET count = count + excluded.count",
+        rows,
+    )
+    if mentor_email:
+        db.executemany(
+            "INSERT INTO mentor_keyword_stats (mentor_email, keyword, count) VALUES (?, ?, ?)"
+            " ON CONFLICT (mentor_email, keyword) DO UPDATE SET count = count + excluded.count",
+            [(mentor_email, k, n) for _, k, n in rows],
+        )
+    db.execute("DELETE FROM student_keyword_stats WHERE student_email = ? AND count <= 0", (student_email,))
+    if mentor_email:
+        db.execute("DELETE FROM mentor_keyword_stats WHERE mentor_email = ? AND count <= 0", (mentor_email,))
+
+
+def record_upload(db, doc_id):
+    """Count a newly inserted document."""
+    row = db.execute(
+        "SELECT d.student_email, d.filename, d.cert_type, d.uploaded_at, s.mentor_email FROM documents d"
+        " JOIN students s ON s.email = d.student_email WHERE d.id = ?", (doc_id,)
+    ).fetchone()
+    if not row:
+        return
+    email, filename, cert_type, uploaded_at, mentor = row
+    db.execute(
+        "INSERT INTO student_doc_stats (student_email, mentor_email, uploads, verified, latest_filename, latest_uploaded_at)"
+        " VALUES (?, ?, 1, 0, ?, ?)"
+        " ON CONFLICT (student_email) DO UPDATE SET uploads = uploads + 1,"
+        " latest_filename = CASE WHEN excluded.latest_uploaded_at >= COALESCE(latest_uploaded_at, '') THEN excluded.latest_filename ELSE latest_filename END,"
+        " latest_uploaded_at = MAX(COALESCE(latest_uploaded_at, ''), excluded.latest_uploaded_at)",
+        (email, mentor, filename, uploaded_at),
+    )
+    ct = (cert_type or '').strip()
+    if ct:
+        db.execute(
+            "INSERT INTO student_cert_stats (student_email, cert_type, count) VALUES (?, ?, 1)"
+            " ON CONFLICT (student_email, cert_type) DO UPDATE SET count = count + 1",
+            (email, ct),
+        )
+    # the stats row remembers which mentor's keyword totals include this student
+    mentor = db.execute("SELECT mentor_email FROM student_doc_stats WHERE student_email = ?", (email,)).fetchone()[0]
+    _bump_keywords(db, email, mentor, Counter(filename_keywords(filename)))
+
+
+def record_verified(db, student_email, delta):
+    """Adjust a student's verified count after documents changed state."""
+    if delta:
+        db.execute("UPDATE student_doc_stats SET verified = verified + ? WHERE student_email = ?", (delta, student_email))
+
+
+def refresh_student(db, email):
+    """Recompute one student's rows from their documents.
+
+    Used when a student is deleted, renamed or moved between mentors; costs
+    O(that student's documents).
+    """
+    old = db.execute("SELECT mentor_email FROM student_doc_stats WHERE student_email = ?", (email,)).fetchone()
+    if old:
+        old_keywords = dict(db.execute(
+            "SELECT keyword, count FROM student_keyword_stats WHERE student_email = ?", (email,)
+        ).fetchall())
+        _bump_keywords(db, email, old[0], old_keywords, sign=-1)
+    db.execute("DELETE FROM student_doc_stats WHERE student_email = ?", (email,))
+    db.execute("DELETE FROM student_cert_stats WHERE student_email = ?", (email,))
+    db.execute("DELETE FROM student_keyword_stats WHERE student_email = ?", (email,))
+
+    student = db.execute("SELECT mentor_email FROM students WHERE email = ?", (email,)).fetchone()
+    if not student:
+        return
+    expected = _expected_for(db, " WHERE s.email = ?", (email,))
+    _write(db, expected)
+
+
+def refresh_new_students(db, emails):
+    """Pick up documents that were uploaded under an email before the student
+    account existed (e.g. a student re-created or imported after deletion)."""
+    emails = list(emails)
+    for i in range(0, len(emails), 500):
+        chunk = emails[i:i + 500]
+        marks = ",".join("?" * len(chunk))
+        for (email,) in db.execute(
+            f"SELECT DISTINCT student_email FROM documents WHERE student_email IN ({marks})", chunk
+        ).fetchall():
+            refresh_student(db, email)
+
+
+def _expected_for(db, where, params):
+    docs, certs, keywords, mentor_keywords = {}, Counter(), Counter(), Counter()
+    for email, mentor in db.execute("SELECT s.email, s.mentor_email FROM students s" + where, params):
+        docs.setdefault(email, [mentor, 0, 0, None, None])
+    for email, filename, cert_type, uploaded_at, verified in db.execute(
+        "SELECT d.student_email, d.filename, d.cert_type, d.uploaded_at, d.verified FROM documents d"
+        " JOIN students s ON s.email = d.student_email" + where + " ORDER BY d.id", params
+    ):
+        # replay in insert order so ties on uploaded_at resolve like record_upload
+        entry = docs[email]
+        entry[1] += 1
+        entry[2] += 1 if verified else 0
+        if entry[4] is None or (uploaded_at or '') >= entry[4]:
+            entry[3], entry[4] = filename, uploaded_at or ''
+        ct = (cert_type or '').strip()
+        if ct:
+            certs[(email, ct)] += 1
+        for k in filename_keywords(filename):
+            keywords[(email, k)] += 1
+            if entry[0]:
+                mentor_keywords[(entry[0], k)] += 1
+    docs = {email: e for email, e in docs.items() if e[1]}
+    return docs, certs, keywords, mentor_keywords
+
+
+def _write(db, expected):
+    docs, certs, keywords, mentor_keywords = expected
+    db.executemany(
+        "INSERT INTO student_doc_stats (student_email, mentor_email, uploads, verified, latest_filename, latest_uploaded_at)"
+        " VALUES (?, ?, ?, ?, ?, ?)",
+        [(email, *e) for email, e in docs.items()],
+    )
+    db.executemany(
+        "INSERT INTO student_cert_stats (student_email, cert_type, count) VALUES (?, ?, ?)",
+        [(email, ct, n) for (email, ct), n in certs.items()],
+    )
+    db.executemany(
+        "INSERT INTO student_keyword_stats (student_email, keyword, count) VALUES (?, ?, ?)",
+        [(email, k, n) for (email, k), n in keywords.items()],
+    )
+    db.executemany(
+        "INSERT INTO mentor_keyword_stats (mentor_email, keyword, count) VALUES (?, ?, ?)"
+        " ON CONFLICT (mentor_email, keyword) DO UPDATE SET count = count + excluded.count",
+        [(mentor, k, n) for (mentor, k), n in mentor_keywords.items()],
+    )
+
+
+def rebuild(db):
+    """Recompute every summary table from documents in one transaction."""
+    for table in ("student_doc_stats", "student_cert_stats", "student_keyword_stats", "mentor_keyword_stats"):
+        db.execute(f"DELETE FROM {table}")
+    _write(db, _expected_for(db, "", ()))
+    db.commit()
+
+
+def check(db):
+    """Return a list of (table, key, stored, expected) mismatches."""
+    docs, certs, keywords, mentor_keywords = _expected_for(db, "", ())
+    problems = []
+
+    def compare(table, stored, expected):
+        for key in stored.keys() | expected.keys():
+            if stored.get(key) != expected.get(key):
+                problems.append((table, key, stored.get(key), expected.get(key)))
+
+    compare(
+        "student_doc_stats",
+        {r[0]: list(r[1:]) for r in db.execute(
+            "SELECT student_email, mentor_email, uploads, verified, latest_filename, latest_uploaded_at FROM student_doc_stats"
+        )},
+        {email: [e[0], e[1], e[2], e[3], e[4]] for email, e in docs.items()},
+    )
+    compare(
+        "student_cert_stats",
+        {(r[0], r[1]): r[2] for r in db.execute("SELECT student_email, cert_type, count FROM student_cert_stats")},
+        dict(certs),
+    )
+    compare(
+        "student_keyword_stats",
+        {(r[0], r[1]): r[2] for r in db.execute("SELECT student_email, keyword, count FROM student_keyword_stats")},
+        dict(keywords),
+    )
+    compare(
+        "mentor_keyword_stats",
+        {(r[0], r[1]): r[2] for r in db.execute("SELECT mentor_email, keyword, count FROM mentor_keyword_stats")},
+        dict(mentor_keywords),
+    )
+    return problems
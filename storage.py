@@ -0,0 +1,609 @@
+"""Storage backends for certificate blobs.
+
+Every backend implements the same small interface (put / get_stream /
+get_range / head / delete / list / presign / block_client) so the routes do
+not care where bytes live:
+
+* ``azure``  -- Azure Blob Storage, the production backend
+* ``local``  -- files under LOCAL_STORAGE_ROOT, for on-prem campuses and
+  benchmarks; full downloads go out through ``send_file`` so gunicorn can
+  use ``os.sendfile`` and ranged reads are served from an mmap
+* ``memory`` -- a process-local dict, for tests and load generation
+
+The backend is picked by STORAGE_BACKEND and built lazily on first use.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import importlib.util
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote, urlencode
+
+from flask import current_app, url_for
+
+import metrics
+import upload_pipeline
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "azure")
+LOCAL_STORAGE_ROOT = os.getenv("LOCAL_STORAGE_ROOT", "blob_storage")
+PRESIGN_TTL = int(os.getenv("STORAGE_PRESIGN_TTL", "300"))
+READ_CHUNK_SIZE = int(os.getenv("BLOB_DOWNLOAD_CHUNK_SIZE", str(4 * 1024 * 1024)))
+LIST_PAGE_SIZE = int(os.getenv("STORAGE_LIST_PAGE_SIZE", "1000"))
+
+# the SDK's async transport; without it the async methods use threads
+AZURE_AIO = importlib.util.find_spec("aiohttp") is not None
+
+
+class StorageError(Exception):
+    pass
+
+
+class StorageNotFound(StorageError):
+    pass
+
+
+class BlobInfo:
+    def __init__(self, name, size, etag, last_modified=None, content_type=None):
+        self.name = name
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+
+
+class StorageBackend:
+    name = None
+
+    def config_error(self):
+        """Return a message if the backend is not usable, else None."""
+        return None
+
+    def block_client(self, key):
+        """Object with upload_blob/stage_block/commit_block_list for ``key``."""
+        raise NotImplementedError
+
+    def put(self, key, stream, size=None, content_type=None, **kwargs):
+        return upload_pipeline.upload_stream(self.block_client(key), stream, size=size,
+                                             content_type=content_type, **kwargs)
+
+    def head(self, key):
+        raise NotImplementedError
+
+    def get_stream(self, key, offset=0, length=None, etag=None):
+        """Iterate over the bytes of ``key`` in bounded chunks."""
+        raise NotImplementedError
+
+    def get_range(self, key, offset, length):
+        return b"".join(self.get_stream(key, offset, length))
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def list(self, prefix=""):
+        """Yield BlobInfo for every key under ``prefix`` in key order."""
+        raise NotImplementedError
+
+    def list_pages(self, prefix="", marker=None, page_size=LIST_PAGE_SIZE):
+        """Yield (infos, marker) pages of list(); passing a page's marker
+        back in resumes the listing after that page."""
+        page = []
+        for info in self.list(prefix):
+            if marker is not None and info.name <= marker:
+                continue
+            page.append(info)
+            if len(page) == page_size:
+                yield page, page[-1].name
+                page = []
+        if page:
+            yield page, page[-1].name
+
+    def discard_staged(self, key):
+        """Drop blocks staged for ``key`` that were never committed. Azure
+        discards uncommitted blocks by itself after a week."""
+
+    def local_path(self, key):
+        """Filesystem path for zero-copy serving, when the backend has one."""
+        return None
+
+    def presign(self, key, permission="r", expires_in=PRESIGN_TTL, content_type=None, download_name=None):
+        """Short-lived URL granting ``permission`` ("r" or "w") on ``key``.
+
+        With ``download_name`` a read URL is served as an attachment under
+        that name.
+        """
+        return _signed_app_url(key, permission, expires_in, download_name)
+
+    def upload_headers(self):
+        """Extra headers a client must send when PUTting to a write URL."""
+        return {}
+
+    def url(self, key):
+        """URL a browser can open to view ``key``."""
+        return self.presign(key)
+
+    # asyncio counterparts used by asgi.py; by default the blocking calls run
+    # on the event loop's executor, one chunk at a time
+
+    async def ahead(self, key):
+        return await asyncio.to_thread(self.head, key)
+
+    async def aget_stream(self, key, offset=0, length=None, etag=None):
+        chunks = iter(await asyncio.to_thread(self.get_stream, key, offset, length, etag))
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    async def aput(self, key, stream, size=None, content_type=None):
+        return await asyncio.to_thread(self.put, key, stream, size=size, content_type=content_type)
+
+
+# -- app-served signed URLs (local and memory backends) -----------------------
+
+def _signing_key():
+    key = os.getenv("STORAGE_SIGNING_KEY") or current_app.secret_key
+    return key.encode() if isinstance(key, str) else key
+
+
+def _signature(key, permission, expires, download_name=""):
+    msg = f"{permission}\n{key}\n{expires}\n{download_name}".encode()
+    return hmac.new(_signing_key(), msg, hashlib.sha256).hexdigest()
+
+
+def _signed_app_url(key, permission, expires_in, download_name=None):
+    expires = int(time.time()) + expires_in
+    params = {"perm": permission, "exp": expires}
+    if download_name:
+        params["dl"] = download_name
+    params["sig"] = _signature(key, permission, expires, download_name or "")
+    return url_for("main.storage_object", key=key) + "?" + urlencode(params)
+
+
+def verify_signed_request(key, args, permission):
+    try:
+        expires = int(args.get("exp", "0"))
+    except ValueError:
+        return False
+    if args.get("perm") != permission or expires < time.time():
+        return False
+    expected = _signature(key, permission, expires, args.get("dl", ""))
+    return hmac.compare_digest(expected, args.get("sig", ""))
+
+
+# -- Azure --------------------------------------------------------------------
+
+class AzureBlobStorage(StorageBackend):
+    name = "azure"
+
+    def __init__(self, account=None, key=None, container=None):
+        self.account = account or os.getenv("AZURE_STORAGE_ACCOUNT")
+        self.key = key or os.getenv("AZURE_STORAGE_KEY")
+        self.container = container or os.getenv("AZURE_CONTAINER")
+        self._service = None
+        self._aio = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def config_error(self):
+        if not self.container:
+            return "AZURE_CONTAINER not set"
+        if not self.account:
+            return "AZURE_STORAGE_ACCOUNT not set"
+        return None
+
+    @property
+    def service(self):
+        if self._pid != os.getpid():
+            # forked worker: the parent's HTTP connections must not be shared
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._service = None
+                    self._aio = {}
+                    self._pid = os.getpid()
+        if self._service is None:
+            with self._lock:
+                if self._service is None:
+                    from azure.storage.blob import BlobServiceClient
+                    self._service = BlobServiceClient(
+                        account_url=f"https://{self.account}.blob.core.windows.net",
+                        credential=self.key,
+                        # bound what a single download holds in memory, including the first GET
+                        max_single_get_size=READ_CHUNK_SIZE,
+                        max_chunk_get_size=READ_CHUNK_SIZE,
+                    )
+        return self._service
+
+    def block_client(self, key):
+        return self.service.get_blob_client(container=self.container, blob=key)
+
+    def _call(self, fn, *args, **kwargs):
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            return fn(*args, **kwargs)
+        except ResourceNotFoundError as e:
+            raise StorageNotFound(str(e))
+
+    def head(self, key):
+        props = self._call(self.block_client(key).get_blob_properties)
+        content_type = props.content_settings.content_type if props.content_settings else None
+        return BlobInfo(key, props.size, (props.etag or "").strip('"'), props.last_modified, content_type)
+
+    def get_stream(self, key, offset=0, length=None, etag=None):
+        kwargs = {}
+        if etag:
+            from azure.core import MatchConditions
+            # pin the read to the version the caller saw in head()
+            kwargs = {"etag": f'"{etag}"', "match_condition": MatchConditions.IfNotModified}
+        downloader = self._call(self.block_client(key).download_blob, offset=offset, length=length, **kwargs)
+        return downloader.chunks()
+
+    def delete(self, key):
+        self._call(self.block_client(key).delete_blob)
+
+    def list(self, prefix=""):
+        container = self.service.get_container_client(self.container)
+        for b in container.list_blobs(name_starts_with=prefix or None):
+            content_type = b.content_settings.content_type if b.content_settings else None
+            yield BlobInfo(b.name, b.size, (b.etag or "").strip('"'), b.last_modified, content_type)
+
+    def list_pages(self, prefix="", marker=None, page_size=LIST_PAGE_SIZE):
+        # the marker is the service's continuation token
+        container = self.service.get_container_client(self.container)
+        pages = container.list_blobs(name_starts_with=prefix or None, results_per_page=page_size)
+        pages = pages.by_page(continuation_token=marker)
+        for page in pages:
+            infos = []
+            for b in page:
+                content_type = b.content_settings.content_type if b.content_settings else None
+                infos.append(BlobInfo(b.name, b.size, (b.etag or "").strip('"'), b.last_modified, content_type))
+            if infos:
+                yield infos, pages.continuation_token
+
+    def presign(self, key, permission="r", expires_in=PRESIGN_TTL, content_type=None, download_name=None):
+        from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+        perms = BlobSasPermissions(read=True) if permission == "r" else BlobSasPermissions(create=True, write=True)
+        disposition = None
+        if download_name:
+            disposition = f'attachment; filename="{download_name}"'
+        sas = generate_blob_sas(
+            account_name=self.account,
+            container_name=self.container,
+            blob_name=key,
+            account_key=self.key,
+            permission=perms,
+            expiry=datetime.now(timezone.utc) + timedelta(seconds=expires_in),
+            # the SAS start time is backdated a little to tolerate clock skew
+            start=datetime.now(timezone.utc) - timedelta(minutes=5),
+            content_type=content_type,
+            content_disposition=disposition,
+        )
+        return f"{self.public_url(key)}?{sas}"
+
+    def _aio_service(self):
+        # aio clients are bound to the event loop that created them
+        loop = asyncio.get_running_loop()
+        service = self._aio.get(loop)
+        if service is None:
+            from azure.storage.blob.aio import BlobServiceClient
+            service = BlobServiceClient(
+                account_url=f"https://{self.account}.blob.core.windows.net",
+                credential=self.key,
+                max_single_get_size=READ_CHUNK_SIZE,
+                max_chunk_get_size=READ_CHUNK_SIZE,
+            )
+            self._aio[loop] = service
+        return service
+
+    def _aio_blob(self, key):
+        return self._aio_service().get_blob_client(container=self.container, blob=key)
+
+    async def ahead(self, key):
+        if not AZURE_AIO:
+            return await super().ahead(key)
+        from azure.core.exceptions import ResourceNotFoundError
+        try:
+            props = await self._aio_blob(key).get_blob_properties()
+        except ResourceNotFoundError as e:
+            raise StorageNotFound(str(e))
+        content_type = props.content_settings.content_type if props.content_settings else None
+        return BlobInfo(key, props.size, (props.etag or "").strip('"'), props.last_modified, content_type)
+
+    async def aget_stream(self, key, offset=0, length=None, etag=None):
+        if not AZURE_AIO:
+            async for chunk in super().aget_stream(key, offset, length, etag):
+                yield chunk
+            return
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceNotFoundError
+        kwargs = {"etag": f'"{etag}"', "match_condition": MatchConditions.IfNotModified} if etag else {}
+        try:
+            downloader = await self._aio_blob(key).download_blob(offset=offset, length=length, **kwargs)
+        except ResourceNotFoundError as e:
+            raise StorageNotFound(str(e))
+        async for chunk in downloader.chunks():
+            yield chunk
+
+    async def aput(self, key, stream, size=None, content_type=None):
+        if not AZURE_AIO:
+            return await super().aput(key, stream, size=size, content_type=content_type)
+        from azure.storage.blob import ContentSettings
+        start = time.perf_counter()
+        await self._aio_blob(key).upload_blob(
+            stream, length=size, overwrite=True, max_concurrency=upload_pipeline.MAX_CONCURRENCY,
+            content_settings=ContentSettings(content_type=content_type) if content_type else None,
+        )
+        return {"mode": "aio", "bytes": size, "seconds": round(time.perf_counter() - start, 4)}
+
+    def upload_headers(self):
+        return {"x-ms-blob-type": "BlockBlob"}
+
+    def public_url(self, key):
+        return f"https://{self.account}.blob.core.windows.net/{self.container}/{quote(key)}"
+
+
+# -- local filesystem ---------------------------------------------------------
+
+class _LocalBlockClient:
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        self.staging = os.path.join(storage.root, ".staging", digest)
+
+    def upload_blob(self, data, overwrite=True, content_settings=None, **kwargs):
+        if hasattr(data, "read"):
+            data = data.read()
+        self.storage._write_atomic(self.key, [data])
+
+    def stage_block(self, block_id, data, length=None, **kwargs):
+        os.makedirs(self.staging, exist_ok=True)
+        name = base64.urlsafe_b64encode(block_id.encode()).decode()
+        with open(os.path.join(self.staging, name), "wb") as f:
+            f.write(data)
+
+    def commit_block_list(self, block_list, content_settings=None, **kwargs):
+        def parts():
+            for b in block_list:
+                name = base64.urlsafe_b64encode(b.id.encode()).decode()
+                with open(os.path.join(self.staging, name), "rb") as f:
+                    while True:
+                        chunk = f.read(READ_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        yield chunk
+        self.storage._write_atomic(self.key, parts())
+        for name in os.listdir(self.staging):
+            os.unlink(os.path.join(self.staging, name))
+        os.rmdir(self.staging)
+
+
+class LocalDiskStorage(StorageBackend):
+    name = "local"
+
+    def __init__(self, root=LOCAL_STORAGE_ROOT):
+        self.root = os.path.abspath(root)
+
+    def config_error(self):
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root, exist_ok=True)
+            except OSError as e:
+                return f"LOCAL_STORAGE_ROOT not writable: {e}"
+        return None
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep) or key.startswith("."):
+            raise StorageError(f"invalid key {key!r}")
+        return path
+
+    def _write_atomic(self, key, chunks):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def block_client(self, key):
+        return _LocalBlockClient(self, key)
+
+    def head(self, key):
+        try:
+            st = os.stat(self._path(key))
+        except FileNotFoundError:
+            raise StorageNotFound(key)
+        etag = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+        return BlobInfo(key, st.st_size, etag, datetime.fromtimestamp(st.st_mtime, timezone.utc))
+
+    def get_stream(self, key, offset=0, length=None, etag=None):
+        try:
+            f = open(self._path(key), "rb")
+        except FileNotFoundError:
+            raise StorageNotFound(key)
+        return self._iter_mmap(f, offset, length)
+
+    @staticmethod
+    def _iter_mmap(f, offset, length):
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            end = size if length is None else min(size, offset + length)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                pos = offset
+                while pos < end:
+                    step = min(READ_CHUNK_SIZE, end - pos)
+                    yield m[pos:pos + step]
+                    pos += step
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            raise StorageNotFound(key)
+
+    def list(self, prefix=""):
+        names = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for filename in filenames:
+                if filename.startswith(".upload-"):
+                    continue
+                key = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    names.append(key)
+        for key in sorted(names):
+            try:
+                yield self.head(key)
+            except StorageNotFound:
+                continue
+
+    def discard_staged(self, key):
+        shutil.rmtree(self.block_client(key).staging, ignore_errors=True)
+
+    def local_path(self, key):
+        path = self._path(key)
+        return path if os.path.isfile(path) else None
+
+
+# -- in-memory ----------------------------------------------------------------
+
+class _MemoryBlockClient:
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+
+    def upload_blob(self, data, overwrite=True, content_settings=None, **kwargs):
+        if hasattr(data, "read"):
+            data = data.read()
+        self.storage._set(self.key, bytes(data), content_settings)
+
+    def stage_block(self, block_id, data, length=None, **kwargs):
+        with self.storage._lock:
+            self.storage._staged.setdefault(self.key, {})[block_id] = bytes(data)
+
+    def commit_block_list(self, block_list, content_settings=None, **kwargs):
+        with self.storage._lock:
+            staged = self.storage._staged.pop(self.key, {})
+        self.storage._set(self.key, b"".join(staged[b.id] for b in block_list), content_settings)
+
+
+class MemoryStorage(StorageBackend):
+    name = "memory"
+
+    def __init__(self, latency=0.0):
+        # simulated per-call latency, used by the benchmarks
+        self.latency = latency
+        self._blobs = {}
+        self._staged = {}
+        self._lock = threading.Lock()
+
+    def _set(self, key, data, content_settings=None):
+        time.sleep(self.latency)
+        self._store(key, data, getattr(content_settings, "content_type", None))
+
+    def _store(self, key, data, content_type=None):
+        info = BlobInfo(key, len(data), hashlib.md5(data).hexdigest(), datetime.now(timezone.utc), content_type)
+        with self._lock:
+            self._blobs[key] = (data, info)
+
+    def _get(self, key):
+        with self._lock:
+            try:
+                return self._blobs[key]
+            except KeyError:
+                raise StorageNotFound(key)
+
+    def block_client(self, key):
+        return _MemoryBlockClient(self, key)
+
+    def head(self, key):
+        return self._get(key)[1]
+
+    def get_stream(self, key, offset=0, length=None, etag=None):
+        data = self._get(key)[0]
+        end = len(data) if length is None else min(len(data), offset + length)
+        view = memoryview(data)
+
+        def chunks():
+            time.sleep(self.latency)
+            for pos in range(offset, end, READ_CHUNK_SIZE):
+                yield bytes(view[pos:min(end, pos + READ_CHUNK_SIZE)])
+        return chunks()
+
+    # the simulated latency is awaited rather than slept, so this backend
+    # stands in for a real async client in the benchmarks
+
+    async def ahead(self, key):
+        return self.head(key)
+
+    async def aget_stream(self, key, offset=0, length=None, etag=None):
+        data = self._get(key)[0]
+        end = len(data) if length is None else min(len(data), offset + length)
+        await asyncio.sleep(self.latency)
+        for pos in range(offset, end, READ_CHUNK_SIZE):
+            yield data[pos:min(end, pos + READ_CHUNK_SIZE)]
+
+    async def aput(self, key, stream, size=None, content_type=None):
+        data = stream.read()
+        await asyncio.sleep(self.latency)
+        self._store(key, data, content_type)
+        return {"mode": "single_put", "bytes": len(data)}
+
+    def discard_staged(self, key):
+        with self._lock:
+            self._staged.pop(key, None)
+
+    def delete(self, key):
+        with self._lock:
+            if self._blobs.pop(key, None) is None:
+                raise StorageNotFound(key)
+
+    def list(self, prefix=""):
+        with self._lock:
+            infos = [info for key, (_, info) in self._blobs.items() if key.startswith(prefix)]
+        return iter(sorted(infos, key=lambda i: i.name))
+
+
+BACKENDS = {
+    "azure": AzureBlobStorage,
+    "local": LocalDiskStorage,
+    "memory": MemoryStorage,
+}
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                try:
+                    backend = BACKENDS[STORAGE_BACKEND]()
+                except KeyError:
+                    raise StorageError(f"unknown STORAGE_BACKEND {STORAGE_BACKEND!r}")
+                _storage = metrics.InstrumentedStorage(backend) if metrics.METRICS_ENABLED else backend
+    return _storage
+
+
+def set_storage(backend):
+    """Replace the configured backend (benchmarks, tests, embedding)."""
+    global _storage
+    _storage = metrics.InstrumentedStorage(backend) if metrics.METRICS_ENABLED else backend
@@ -0,0 +1,164 @@
+"""Block upload pipeline for certificates.
+
+A stream is read sequentially in blocks; each block is staged on the blob
+while the next one is being read, with at most ``max_concurrency`` stage
+calls in flight, and the block list is committed at the end. Files at or
+below the single-put threshold skip staging and go up in one request.
+
+Works with anything shaped like an azure BlobClient (``upload_blob``,
+``stage_block``, ``commit_block_list``); every storage backend hands one
+out from ``block_client()``, so the memory backend doubles as a local
+stand-in for benchmarks and experiments without a storage account.
+"""
+import base64
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+BLOCK_SIZE = int(os.getenv("UPLOAD_BLOCK_SIZE", str(4 * 1024 * 1024)))
+MAX_CONCURRENCY = int(os.getenv("UPLOAD_MAX_CONCURRENCY", "4"))
+SINGLE_PUT_THRESHOLD = int(os.getenv("UPLOAD_SINGLE_PUT_THRESHOLD", str(BLOCK_SIZE)))
+# Azure caps a block blob at 50,000 committed blocks and 4000 MiB per block
+MAX_BLOCKS = 50000
+MAX_BLOCK_SIZE = 4000 * 1024 * 1024
+
+_totals_lock = threading.Lock()
+_totals = {"uploads": 0, "single_put": 0, "blocks": 0, "bytes": 0, "seconds": 0.0, "failures": 0}
+
+
+def block_id(index):
+    # block ids must be base64 and all the same length within one blob
+    return base64.b64encode(f"{index:08d}".encode()).decode()
+
+
+def tune(size, block_size=BLOCK_SIZE, max_concurrency=MAX_CONCURRENCY):
+    """Pick (block_size, concurrency) for a payload of ``size`` bytes (None if
+    unknown)."""
+    if size is None:
+        return block_size, max_concurrency
+    # grow blocks for very large files so they stay under the block limit
+    block_size = min(MAX_BLOCK_SIZE, max(block_size, math.ceil(size / MAX_BLOCKS)))
+    blocks = max(1, math.ceil(size / block_size))
+    return block_size, max(1, min(max_concurrency, blocks))
+
+
+def stream_size(stream):
+    """Remaining bytes in a seekable stream, or None."""
+    try:
+        pos = stream.tell()
+        end = stream.seek(0, os.SEEK_END)
+        stream.seek(pos)
+        return end - pos
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def upload_stream(blob_client, stream, size=None, content_type=None, block_size=BLOCK_SIZE,
+                  max_concurrency=MAX_CONCURRENCY, single_put_threshold=SINGLE_PUT_THRESHOLD,
+                  progress=None, overwrite=True):
+    """Upload ``stream`` to ``blob_client`` and return transfer metrics.
+
+    ``progress(sent, total)`` is called after every completed block (total is
+    None when the size is unknown).
+    """
+    if size is None:
+        size = stream_size(stream)
+    # imported here: the SDK takes a few hundred ms to import, too much for worker boot
+    from azure.storage.blob import ContentSettings
+
+    block_size, concurrency = tune(size, block_size, max_concurrency)
+    content_settings = ContentSettings(content_type=content_type) if content_type else None
+    start = time.perf_counter()
+    sent = 0
+    blocks = 0
+
+    try:
+        if size is not None and size <= single_put_threshold:
+            data = stream.read()
+            blob_client.upload_blob(data, overwrite=overwrite, content_settings=content_settings)
+            sent = len(data)
+            mode = "single_put"
+            if progress:
+                progress(sent, size)
+        else:
+            mode = "blocks"
+            sent, blocks = _stage_blocks(blob_client, stream, size, block_size, concurrency, progress)
+            commit_blocks(blob_client, blocks, content_type)
+    except Exception:
+        with _totals_lock:
+            _totals["failures"] += 1
+        raise
+
+    seconds = time.perf_counter() - start
+    result = {
+        "mode": mode,
+        "bytes": sent,
+        "blocks": blocks,
+        "block_size": block_size,
+        "concurrency": concurrency,
+        "seconds": round(seconds, 4),
+        "mb_per_s": round(sent / (1024 * 1024) / seconds, 2) if seconds > 0 else None,
+    }
+    with _totals_lock:
+        _totals["uploads"] += 1
+        _totals["single_put"] += 1 if mode == "single_put" else 0
+        _totals["blocks"] += blocks
+        _totals["bytes"] += sent
+        _totals["seconds"] += seconds
+    logging.info(f"Uploaded {sent} bytes via {mode} ({blocks} blocks) in {result['seconds']}s ({result['mb_per_s']} MB/s)")
+    return result
+
+
+def commit_blocks(blob_client, count, content_type=None):
+    """Commit the blocks staged as 0..count-1 under block_id() as the blob."""
+    from azure.storage.blob import BlobBlock, ContentSettings
+    content_settings = ContentSettings(content_type=content_type) if content_type else None
+    blob_client.commit_block_list([BlobBlock(block_id=block_id(i)) for i in range(count)],
+                                  content_settings=content_settings)
+
+
+def _stage_blocks(blob_client, stream, size, block_size, concurrency, progress):
+    # at most `concurrency` blocks are in flight and one more is being read,
+    # which bounds memory to (concurrency + 1) * block_size
+    slots = threading.BoundedSemaphore(concurrency)
+    sent_lock = threading.Lock()
+    state = {"sent": 0, "error": None}
+
+    def stage(index, chunk):
+        try:
+            if state["error"] is None:
+                blob_client.stage_block(block_id(index), chunk, length=len(chunk))
+                with sent_lock:
+                    state["sent"] += len(chunk)
+                    sent = state["sent"]
+                if progress:
+                    progress(sent, size)
+        except Exception as e:
+            state["error"] = e
+        finally:
+            slots.release()
+
+    index = 0
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="upload-block") as pool:
+        while state["error"] is None:
+            chunk = stream.read(block_size)
+            if not chunk:
+                break
+            slots.acquire()
+            pool.submit(stage, index, chunk)
+            index += 1
+    if state["error"] is not None:
+        raise state["error"]
+    return state["sent"], index
+
+
+def totals():
+    with _totals_lock:
+        data = dict(_totals)
+    data["seconds"] = round(data["seconds"], 4)
+    return data
+
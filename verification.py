@@ -0,0 +1,105 @@
+"""Bulk verify/unverify of documents.
+
+Targets are given as explicit ids or as a filter (student, cert_type and the
+listing filters). The targets are read and updated inside one BEGIN IMMEDIATE
+transaction together with the verified counters in student_doc_stats, so the
+counters can never drift from the rows they summarise.
+"""
+import os
+
+import stats
+from pagination import document_filters
+
+MAX_BATCH = int(os.getenv("VERIFY_MAX_BATCH", "5000"))
+ACTIONS = ("verify", "unverify")
+FILTER_KEYS = ("student", "cert_type", "verified", "from", "to")
+
+
+class BatchError(ValueError):
+    pass
+
+
+def _targets(db, ids, filters, mentor):
+    from_sql = "FROM documents d"
+    where, params = [], []
+    if mentor:
+        from_sql += " JOIN students s ON s.email = d.student_email"
+        where.append("s.mentor_email = ?")
+        params.append(mentor)
+    if ids is not None:
+        where.append(f"d.id IN ({','.join('?' * len(ids))})")
+        params.extend(ids)
+    else:
+        if filters.get("student"):
+            where.append("d.student_email = ?")
+            params.append(filters["student"])
+        where, params = document_filters(filters, where, params)
+    sql = f"SELECT d.id, d.student_email, COALESCE(d.verified, 0) {from_sql}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return db.execute(sql + f" LIMIT {MAX_BATCH + 1}", params).fetchall()
+
+
+def apply(db, action, verifier, ids=None, filters=None, mentor=None):
+    """Verify or unverify the matching documents; ``mentor`` restricts them
+    to that staff member's students. Returns a summary dict."""
+    if action not in ACTIONS:
+        raise BatchError("action must be 'verify' or 'unverify'")
+    if ids is not None:
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            raise BatchError("ids must be a list of integers")
+        ids = sorted(set(ids))
+        if len(ids) > MAX_BATCH:
+            raise BatchError(f"at most {MAX_BATCH} documents per request")
+    else:
+        if filters is not None and not isinstance(filters, dict):
+            raise BatchError("filter must be an object")
+        filters = {k: v for k, v in (filters or {}).items() if k in FILTER_KEYS and v not in (None, "")}
+        if not all(isinstance(v, str) for v in filters.values()):
+            raise BatchError("filter values must be strings")
+        # document_filters ignores any other value, which would widen the batch
+        if filters.get("verified") not in (None, "0", "1"):
+            raise BatchError("verified must be '0' or '1'")
+        if not filters.get("student") and not filters.get("cert_type"):
+            raise BatchError("filter needs a student or a cert_type")
+
+    target = 1 if action == "verify" else 0
+    if db.in_transaction:
+        db.commit()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        rows = _targets(db, ids, filters, mentor)
+        if len(rows) > MAX_BATCH:
+            raise BatchError(f"filter matches more than {MAX_BATCH} documents")
+        changed = [(doc_id, email) for doc_id, email, verified in rows if bool(verified) != bool(target)]
+        if target:
+            db.executemany(
+                "UPDATE documents SET verified=1, verifier=?, verified_at=CURRENT_TIMESTAMP WHERE id=?",
+                [(verifier, doc_id) for doc_id, _ in changed],
+            )
+        else:
+            db.executemany(
+                "UPDATE documents SET verified=0, verifier=NULL, verified_at=NULL WHERE id=?",
+                [(doc_id,) for doc_id, _ in changed],
+            )
+        deltas = {}
+        for _, email in changed:
+            deltas[email] = deltas.get(email, 0) + (1 if target else -1)
+        for email, delta in deltas.items():
+            stats.record_verified(db, email, delta)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    result = {
+        "action": action,
+        "matched": len(rows),
+        "changed": len(changed),
+        "unchanged": len(rows) - len(changed),
+        "students": len(deltas),
+    }
+    if ids is not None:
+        found = {r[0] for r in rows}
+        result["not_found"] = [i for i in ids if i not in found]
+    return result